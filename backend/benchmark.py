@@ -0,0 +1,394 @@
+"""
+后端基准测试 / 压测工具
+
+生成指定规模和目录深度的合成工作区（1KB ~ 50MB 的YAML文件），
+启动一个本地的Mihomo桩服务，然后通过FastAPI的ASGI应用并发调用
+文件列表、搜索、读取、保存、历史和Mihomo代理等接口，
+统计p50/p99延迟、吞吐量和进程内存(RSS)，结果写入JSON，便于在版本之间对比回归。
+
+用法示例：
+    python benchmark.py --files 200 --depth 3 --concurrency 16 --output result.json
+    python benchmark.py --compare baseline.json --fail-threshold 20
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SCENARIOS = ["list_files", "search", "search_content", "read_file", "save_file", "history", "mihomo_proxy"]
+
+PROXY_TEMPLATE = """  - name: "{region}-{index:06d}"
+    type: ss
+    server: node{index}.example.com
+    port: {port}
+    cipher: aes-128-gcm
+    password: "p{index:06d}"
+    udp: true
+"""
+
+REGIONS = ["HK", "JP", "SG", "US", "TW", "KR"]
+
+def parse_size(value):
+    """解析 1024 / 64KB / 50MB 形式的大小"""
+    value = value.strip().upper()
+    for suffix, factor in (("KB", 1024), ("MB", 1024 ** 2), ("GB", 1024 ** 3), ("K", 1024), ("M", 1024 ** 2), ("B", 1)):
+        if value.endswith(suffix):
+            return int(float(value[:-len(suffix)]) * factor)
+    return int(value)
+
+def yaml_document(size, seed):
+    """生成大约size字节、Mihomo配置结构的YAML文本"""
+    header = f"# benchmark seed={seed}\nport: 7890\nsocks-port: 7891\nmode: rule\nlog-level: info\nproxies:\n"
+    parts = [header]
+    length = len(header)
+    index = 0
+    while length < size:
+        block = PROXY_TEMPLATE.format(region=REGIONS[index % len(REGIONS)], index=index, port=10000 + index % 50000)
+        parts.append(block)
+        length += len(block)
+        index += 1
+    names = ", ".join(f'"{REGIONS[i % len(REGIONS)]}-{i:06d}"' for i in range(min(index, 20)))
+    parts.append(f"proxy-groups:\n  - name: auto\n    type: url-test\n    proxies: [{names}]\nrules:\n  - MATCH,auto\n")
+    return "".join(parts)
+
+def generate_workspace(root, files, depth, fanout, min_size, max_size, skew, seed):
+    """
+    在root下生成合成工作区，返回 (文件相对路径列表, 总字节数)
+    文件大小在[min_size, max_size]之间按 min*(max/min)^(u^skew) 分布，skew越大小文件越多
+    """
+    rng = random.Random(seed)
+    dirs = [""]
+    level = [""]
+    for _ in range(depth):
+        level = [f"{parent}dir{i}/" for parent in level for i in range(fanout)]
+        dirs.extend(level)
+    for rel_dir in dirs:
+        os.makedirs(os.path.join(root, rel_dir), exist_ok=True)
+
+    paths = []
+    total_bytes = 0
+    ratio = max_size / min_size
+    for i in range(files):
+        size = int(min_size * ratio ** (rng.random() ** skew))
+        if i == 0:
+            size = max_size  # 保证至少有一个最大尺寸的文件
+        rel_path = f"{rng.choice(dirs)}config_{i:05d}.yaml"
+        content = yaml_document(size, seed + i)
+        with open(os.path.join(root, rel_path), "w", encoding="utf-8", newline="\n") as f:
+            f.write(content)
+        paths.append(rel_path)
+        total_bytes += len(content)
+    return paths, total_bytes, len(dirs)
+
+def memory_usage():
+    """当前RSS和峰值RSS（字节），平台不支持时为None"""
+    current = None
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    peak = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin":
+            peak *= 1024  # Linux上单位为KB
+    return {"rss": current, "peak_rss": peak}
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (k - lower)
+
+class MihomoStub:
+    """在独立线程中运行的Mihomo API桩服务，可模拟上游延迟"""
+
+    def __init__(self, proxies=200, latency=0.0):
+        self.latency = latency
+        self.port = None
+        self._server = None
+        self._thread = None
+        self._proxies = json.dumps({
+            "proxies": {
+                f"{REGIONS[i % len(REGIONS)]}-{i:06d}": {"name": f"{REGIONS[i % len(REGIONS)]}-{i:06d}", "type": "Shadowsocks", "history": []}
+                for i in range(proxies)
+            }
+        }).encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        path = scope["path"]
+        if path == "/version":
+            body = b'{"version":"benchmark-stub","meta":true}'
+        elif path == "/proxies":
+            body = self._proxies
+        else:
+            body = b"{}"
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body})
+
+    def start(self):
+        import uvicorn
+        config = uvicorn.Config(self, host="127.0.0.1", port=0, lifespan="off", log_level="warning", access_log=False)
+        self._server = uvicorn.Server(config)
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+        self._thread.start()
+        deadline = time.time() + 10
+        while not self._server.started:
+            if time.time() > deadline:
+                raise RuntimeError("Mihomo桩服务启动超时")
+            time.sleep(0.01)
+        self.port = self._server.servers[0].sockets[0].getsockname()[1]
+        return f"127.0.0.1:{self.port}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.should_exit = True
+            self._thread.join(timeout=5)
+
+async def run_scenario(make_request, total, concurrency, warmup):
+    """以concurrency个并发worker执行total次请求，返回延迟统计"""
+    for i in range(warmup):
+        await make_request(-1 - i)
+
+    latencies = []
+    statuses = {}
+    counter = itertools.count()
+
+    async def worker():
+        while True:
+            i = next(counter)
+            if i >= total:
+                return
+            started = time.perf_counter()
+            try:
+                response = await make_request(i)
+                status = str(response.status_code)
+            except Exception as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    memory_before = memory_usage()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    errors = sum(count for status, count in statuses.items() if not status.startswith("2"))
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": ms(percentile(latencies, 50)),
+            "p90": ms(percentile(latencies, 90)),
+            "p99": ms(percentile(latencies, 99)),
+            "max": ms(latencies[-1]) if latencies else None,
+        },
+        "statuses": statuses,
+        "errors": errors,
+        "memory_before": memory_before,
+        "memory_after": memory_usage(),
+    }
+
+async def run_benchmark(args, workspace, paths):
+    import httpx
+    import main
+
+    # 配置写入临时文件，避免改动真实的 app_config.json
+    main.config_store = main.ConfigStore(os.path.join(workspace, ".benchmark_config.json"), {"workspace_dir": workspace})
+
+    stub = MihomoStub(proxies=args.mihomo_proxies, latency=args.mihomo_latency / 1000)
+    mihomo_address = stub.start()
+
+    results = {}
+    startup_started = time.perf_counter()
+    await main.app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            # 等待目录树和搜索索引建立完成（搜索索引在目录树之后建立），单独记录耗时
+            deadline = time.time() + args.index_timeout
+            while not main.search_index.content_ready and time.time() < deadline:
+                await asyncio.sleep(0.05)
+            results["startup"] = {
+                "index_seconds": round(time.perf_counter() - startup_started, 3),
+                "index_ready": main.search_index.content_ready,
+                "memory": memory_usage(),
+            }
+
+            response = await client.post("/api/login", json={"password": main.APP_PASSWORD})
+            response.raise_for_status()
+            headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+            response = await client.post("/api/config/mihomo", json={"address": mihomo_address}, headers=headers)
+            response.raise_for_status()
+
+            rng = random.Random(args.seed)
+            # 每个请求按序号确定性地选择文件，保证多次运行可复现
+            picks = [rng.choice(paths) for _ in range(args.requests + args.warmup)]
+            pick = lambda i: picks[i % len(picks)]
+            terms = [f"{REGIONS[i % len(REGIONS)]}-{rng.randrange(1000):06d}" for i in range(64)]
+
+            async def save(i):
+                path = pick(i)
+                read = await client.get(f"/api/file/{path}", headers=headers)
+                content = read.json()["content"] + f"# benchmark save {i}\n"
+                return await client.post(f"/api/file/{path}", json={"content": content}, headers=headers)
+
+            requests = {
+                "list_files": lambda i: client.get("/api/files", headers=headers),
+                "search": lambda i: client.get("/api/search", params={"q": f"config_{i % 100:02d}"}, headers=headers),
+                "search_content": lambda i: client.get("/api/search", params={"q": terms[i % len(terms)], "scope": "content"}, headers=headers),
+                "read_file": lambda i: client.get(f"/api/file/{pick(i)}", headers=headers),
+                "save_file": save,
+                "history": lambda i: client.get("/api/history", params={"file_path": pick(i)}, headers=headers),
+                "mihomo_proxy": lambda i: client.get("/api/mihomo/proxy/proxies" if i % 2 else "/api/mihomo/proxy/version", headers=headers),
+            }
+
+            results["scenarios"] = {}
+            for name in args.scenarios:
+                print(f"运行场景 {name} ...", file=sys.stderr)
+                results["scenarios"][name] = await run_scenario(requests[name], args.requests, args.concurrency, args.warmup)
+    finally:
+        await main.app.router.shutdown()
+        stub.stop()
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+def compare(current, baseline, threshold):
+    """打印与基线结果的对比，返回p99延迟或吞吐量退化超过threshold%的场景"""
+    regressions = []
+    print(f"{'场景':<16}{'p50(ms)':>22}{'p99(ms)':>22}{'吞吐(rps)':>22}")
+    for name, result in current.get("scenarios", {}).items():
+        base = baseline.get("scenarios", {}).get(name)
+        if base is None:
+            continue
+
+        def delta(new, old):
+            if not old or new is None:
+                return "n/a", 0.0
+            change = (new - old) / old * 100
+            return f"{old:.1f}->{new:.1f} ({change:+.0f}%)", change
+
+        p50, _ = delta(result["latency_ms"]["p50"], base["latency_ms"]["p50"])
+        p99, p99_change = delta(result["latency_ms"]["p99"], base["latency_ms"]["p99"])
+        rps, rps_change = delta(result["throughput_rps"], base["throughput_rps"])
+        print(f"{name:<16}{p50:>22}{p99:>22}{rps:>22}")
+        if threshold is not None and (p99_change > threshold or -rps_change > threshold):
+            regressions.append(name)
+    return regressions
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="YAML编辑器后端基准测试")
+    parser.add_argument("--files", type=int, default=200, help="生成的YAML文件数")
+    parser.add_argument("--depth", type=int, default=3, help="目录深度")
+    parser.add_argument("--fanout", type=int, default=3, help="每层子目录数")
+    parser.add_argument("--min-size", type=parse_size, default="1KB", help="最小文件大小")
+    parser.add_argument("--max-size", type=parse_size, default="50MB", help="最大文件大小")
+    parser.add_argument("--size-skew", type=float, default=6.0, help="文件大小分布的偏斜度，越大小文件越多")
+    parser.add_argument("--requests", type=int, default=200, help="每个场景的请求数")
+    parser.add_argument("--concurrency", type=int, default=16, help="并发请求数")
+    parser.add_argument("--warmup", type=int, default=5, help="每个场景不计入统计的预热请求数")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"要运行的场景，逗号分隔（{','.join(SCENARIOS)}）")
+    parser.add_argument("--mihomo-proxies", type=int, default=200, help="Mihomo桩服务返回的节点数")
+    parser.add_argument("--mihomo-latency", type=float, default=0.0, help="Mihomo桩服务模拟的上游延迟（毫秒）")
+    parser.add_argument("--index-timeout", type=float, default=600, help="等待索引建立的最长时间（秒）")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子")
+    parser.add_argument("--workspace", help="合成工作区目录（默认使用临时目录，结束后删除）")
+    parser.add_argument("--keep", action="store_true", help="保留生成的工作区")
+    parser.add_argument("--output", help="结果JSON的输出路径（默认输出到标准输出）")
+    parser.add_argument("--compare", help="用于对比的基线结果JSON")
+    parser.add_argument("--fail-threshold", type=float, help="p99延迟或吞吐量退化超过该百分比时以非零状态退出")
+    args = parser.parse_args(argv)
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知场景: {', '.join(sorted(unknown))}")
+
+    workspace = os.path.abspath(args.workspace or tempfile.mkdtemp(prefix="yaml-benchmark-"))
+    os.makedirs(workspace, exist_ok=True)
+    try:
+        print(f"生成合成工作区: {workspace}", file=sys.stderr)
+        generate_started = time.perf_counter()
+        paths, total_bytes, dir_count = generate_workspace(
+            workspace, args.files, args.depth, args.fanout,
+            args.min_size, args.max_size, args.size_skew, args.seed
+        )
+        generate_seconds = time.perf_counter() - generate_started
+
+        # main在导入时读取环境变量，必须先设置好工作目录
+        os.environ["WORKSPACE_DIR"] = workspace
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        results = asyncio.run(run_benchmark(args, workspace, paths))
+    finally:
+        if not args.keep and not args.workspace:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "fail_threshold")},
+        "workspace": {
+            "files": len(paths),
+            "directories": dir_count,
+            "bytes": total_bytes,
+            "generate_seconds": round(generate_seconds, 3),
+        },
+        **results,
+    }
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.fail_threshold)
+        if regressions:
+            print(f"性能退化超过 {args.fail_threshold}% 的场景: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
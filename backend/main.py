@@ -1,20 +1,76 @@
-from fastapi import FastAPI, HTTPException, Depends, Security, Request, Response
+from fastapi import FastAPI, HTTPException, Depends, Security, Request, Response, Query, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 from typing import List, Optional
 import yaml
 import os
+import sys
 import json
 import shutil
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
 from dotenv import load_dotenv
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-import platform
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from starlette.background import BackgroundTask
 import httpx
 from urllib.parse import urlparse
+import asyncio
+import threading
+import hashlib
+import posixpath
+import queue
+import time
+import functools
+import itertools
+import contextvars
+import concurrent.futures
+import multiprocessing
+import collections
+import array
+import zlib
+import email.utils
+import uuid
+import fnmatch
+import difflib
+import types
+import contextlib
+import re
+import errno
+import stat
+import bisect
+import weakref
+import base64
+import hmac
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:  # 未安装watchdog时使用轮询
+    Observer = None
+    FileSystemEventHandler = object
+
+try:
+    import brotli
+except ImportError:  # 未安装brotli时只支持gzip
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # 未安装zstandard时历史版本不压缩
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:  # Windows下不使用文件锁
+    fcntl = None
+
+try:
+    import websockets
+except ImportError:  # 未安装websockets时不支持转发Mihomo的WebSocket接口
+    websockets = None
 
 # 加载环境变量
 load_dotenv()
@@ -32,35 +88,29 @@ app.add_middleware(
 )
 
 # 安全配置
-security = HTTPBearer()
+security = HTTPBearer(auto_error=False)  # 未携带Authorization时不直接拒绝，交给authenticate统一返回错误
 APP_PASSWORD = os.getenv("APP_PASSWORD", "admin123")
 JWT_SECRET = os.getenv("JWT_SECRET", "your_jwt_secret_key")
 JWT_ALGORITHM = "HS256"
-JWT_EXPIRATION = 24  # token有效期（小时）
+JWT_EXPIRATION = float(os.getenv("JWT_EXPIRATION", "24"))  # token有效期（小时）
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "1024"))  # 已验证令牌的缓存条数
+SESSION_COOKIE = os.getenv("SESSION_COOKIE", "true").lower() == "true"  # 登录时下发会话Cookie（Mihomo面板的iframe依赖它认证）
+SESSION_COOKIE_NAME = "yaml_editor_session"
+SESSION_COOKIE_PATH = "/api/mihomo"  # Cookie只发给Mihomo面板的代理接口
 SKIP_AUTH = os.getenv("SKIP_AUTH", "false").lower() == "true"  # 开发环境可设置为true跳过认证
 
 # 工作目录配置
 WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "/app/workspace")
 CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config")
 CONFIG_FILE = os.path.join(CONFIG_DIR, "app_config.json")
+REVOKED_TOKENS_FILE = os.path.join(CONFIG_DIR, "revoked_tokens.json")  # 运行时状态，与配置文件分开保存
 
 def init_workspace():
+    """确保默认工作目录（WORKSPACE_DIR）存在"""
     try:
-        workspace_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "workspace")
-        
-        # 跨平台获取当前用户
-        if platform.system() == "Windows":
-            import getpass
-            current_user = getpass.getuser()
-        else:
-            current_user = str(os.getuid())
-            
-        user_workspace = os.path.join(workspace_dir, current_user)
-        
-        if not os.path.exists(user_workspace):
-            os.makedirs(user_workspace)
-            
-        return user_workspace
+        workspace_dir = os.path.normpath(WORKSPACE_DIR)
+        os.makedirs(workspace_dir, exist_ok=True)
+        return workspace_dir
     except Exception as e:
         print(f"初始化工作目录失败: {str(e)}")
         return None
@@ -70,7 +120,8 @@ init_workspace()
 
 # 挂载前端静态文件
 frontend_path = os.path.join(os.path.dirname(__file__), "..", "frontend", "dist")
-app.mount("/assets", StaticFiles(directory=os.path.join(frontend_path, "assets")), name="assets")
+if os.path.isdir(os.path.join(frontend_path, "assets")):  # 未构建前端时（如只运行后端测试）不挂载
+    app.mount("/assets", StaticFiles(directory=os.path.join(frontend_path, "assets")), name="assets")
 
 @app.get("/")
 async def read_root():
@@ -79,25 +130,147 @@ async def read_root():
 # 生成JWT token
 def create_access_token(data: dict):
     to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(hours=JWT_EXPIRATION)
-    to_encode.update({"exp": expire})
+    now = datetime.utcnow()
+    expire = now + timedelta(hours=JWT_EXPIRATION)
+    # jti用于吊销单个令牌
+    to_encode.update({"exp": expire, "iat": now, "jti": uuid.uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
+class TokenCache:
+    """
+    已验证令牌的LRU缓存，条目保留到令牌过期为止，
+    命中时认证只需一次字典查找，不必每个请求都重新做HMAC校验
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()  # token -> (过期时间戳, payload)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= time.time():
+                del self._entries[token]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, token, payload):
+        with self._lock:
+            self._entries[token] = (payload.get("exp", 0), payload)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+token_cache = TokenCache(AUTH_CACHE_SIZE)
+
+def token_id(token, payload):
+    """令牌的吊销标识：优先用jti，旧令牌没有jti时用令牌摘要"""
+    return payload.get("jti") or hashlib.sha256(token.encode()).hexdigest()[:32]
+
+def revoked_tokens():
+    # 吊销列表保存在单独的状态文件中，多进程部署时各进程都能看到
+    return revocation_store.snapshot().get("revoked_tokens") or {}
+
+def revoke_token(token, payload):
+    """吊销令牌直到其原本的过期时间，同时清理已过期的吊销记录"""
+    now = time.time()
+    revoked_id = token_id(token, payload)
+
+    def apply(config):
+        revoked = {
+            key: exp for key, exp in (config.get("revoked_tokens") or {}).items()
+            if exp > now
+        }
+        revoked[revoked_id] = payload.get("exp", now)
+        config["revoked_tokens"] = revoked
+
+    revocation_store.modify(apply)
+    token_cache.discard(token)
+
 # 验证JWT token
-async def verify_token(credentials: HTTPAuthorizationCredentials = Security(security)):
+def decode_access_token(token):
     # 开发环境可跳过认证
     if SKIP_AUTH:
         return {"sub": "dev_user"}
-        
-    try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+
+    if not token:
+        raise HTTPException(status_code=401, detail="未登录，请先登录")
+
+    payload = token_cache.get(token)
+    if payload is None:
+        try:
+            payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        except JWTError:
+            raise HTTPException(
+                status_code=401,
+                detail="登录已过期或无效，请重新登录"
+            )
+        token_cache.put(token, payload)
+
+    revoked = revoked_tokens()
+    if revoked and token_id(token, payload) in revoked:
+        token_cache.discard(token)
+        raise HTTPException(status_code=401, detail="登录已注销，请重新登录")
+    return payload
+
+def bearer_token(headers):
+    authorization = headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        return authorization[7:].strip()
+    return None
+
+def resolve_token(connection, token=None, prefer_cookie=False):
+    """
+    依次尝试Authorization请求头和token查询参数（EventSource和WebSocket无法设置请求头），
+    返回第一个有效令牌及其payload。
+    会话Cookie只在prefer_cookie为True（Mihomo面板代理接口）时接受并优先使用
+    （Mihomo面板会在Authorization中带上Mihomo自己的密钥）；
+    其他接口不认Cookie，避免同站的其他页面借浏览器自动携带的Cookie跨域读写工作区
+    """
+    if SKIP_AUTH:
+        return None, {"sub": "dev_user"}
+    candidates = [bearer_token(connection.headers), token]
+    if prefer_cookie and SESSION_COOKIE:
+        candidates.insert(0, connection.cookies.get(SESSION_COOKIE_NAME))
+
+    error = None
+    for candidate in candidates:
+        if not candidate:
+            continue
+        try:
+            return candidate, decode_access_token(candidate)
+        except HTTPException as e:
+            error = error or e
+    raise error or HTTPException(status_code=401, detail="未登录，请先登录")
+
+def authenticate(connection, token=None, prefer_cookie=False):
+    """验证令牌并选择本次请求的工作区（见 select_workspace），返回令牌的payload"""
+    with timed_stage("auth"):
+        payload = resolve_token(connection, token, prefer_cookie)[1]
+        select_workspace(connection, payload)
         return payload
-    except JWTError:
-        raise HTTPException(
-            status_code=401,
-            detail="登录已过期或无效，请重新登录"
-        )
+
+async def verify_token(request: Request, credentials: Optional[HTTPAuthorizationCredentials] = Security(security)):
+    # credentials仅用于在接口文档中声明Bearer认证，实际由authenticate统一读取请求头
+    return authenticate(request)
 
 # 路径规范化函数
 def normalize_path(path):
@@ -113,6 +286,182 @@ def system_path(path):
     """
     return os.path.normpath(path)
 
+def path_in_workspace(sys_path, sys_workspace_dir):
+    """检查系统路径是否位于工作目录内（按路径组成部分比较，/ws2 不属于 /ws）"""
+    with timed_stage("path"):
+        path = os.path.normcase(os.path.abspath(sys_path))
+        root = os.path.normcase(os.path.abspath(sys_workspace_dir))
+        return path == root or path.startswith(os.path.join(root, ""))
+
+# 路径解析
+WORKSPACE_SYMLINKS = os.getenv("WORKSPACE_SYMLINKS", "internal").lower()  # deny / internal（只允许指向工作区内） / follow
+PATH_CACHE_SIZE = int(os.getenv("PATH_CACHE_SIZE", "4096"))  # 每个工作区缓存的路径解析结果数
+PATH_CACHE_TTL = 5.0       # 解析结果的有效期（秒），目录监听不可用时外部新建的符号链接最迟在此之后生效
+PATH_MAX_SYMLINKS = 40     # 单个路径最多跟随的符号链接数
+OUTSIDE_WORKSPACE = "出于安全考虑，不允许访问工作目录之外的文件"
+TRASH_DIR = ".yaml-editor-trash"  # 工作区根目录下的回收目录，删除时先rename到这里（与工作区同一文件系统），不出现在文件树中也不能直接访问
+_OPENAT_SUPPORTED = (
+    os.open in os.supports_dir_fd and os.stat in os.supports_dir_fd
+    and hasattr(os, "O_NOFOLLOW") and hasattr(os, "O_DIRECTORY")
+)
+
+def canonical_relpath(path, sys_workspace_dir):
+    """
+    把请求中的路径规范为工作区内的相对路径（/分隔，不含 . 和 ..），工作区根目录为空字符串，
+    越出工作区时返回None；位于工作区内的绝对路径会转换为相对路径
+    """
+    path = normalize_path(path or "")
+    if "\x00" in path:
+        return None
+    if os.path.isabs(system_path(path)):
+        absolute = os.path.normpath(system_path(path))
+        if not path_in_workspace(absolute, sys_workspace_dir):
+            return None
+        path = normalize_path(os.path.relpath(absolute, sys_workspace_dir))
+    rel_path = posixpath.normpath(path)
+    if rel_path == ".":
+        return ""
+    if rel_path == ".." or rel_path.startswith("../") or rel_path.startswith("/"):
+        return None
+    return rel_path
+
+class WorkspacePathResolver:
+    """
+    工作区的路径解析：规范化、按组成部分检查是否在工作区内，并按WORKSPACE_SYMLINKS检查符号链接，
+    结果按请求中的原始路径缓存，目录结构变化（目录树索引的创建/删除事件）时清空
+    """
+
+    def __init__(self, root, size=PATH_CACHE_SIZE, policy=WORKSPACE_SYMLINKS):
+        self.root = root
+        self.size = size
+        self.policy = policy
+        self._real_root = None
+        self._cache = collections.OrderedDict()  # 请求路径 -> (解析时间, 相对路径, 系统路径)，越界时后两项为None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def on_tree_event(self, event_type, rel_path, is_dir):
+        if event_type != "modified":
+            with self._lock:
+                self._cache.clear()
+
+    def resolve(self, path):
+        """返回 (相对路径, 系统路径)，不在工作区内或违反符号链接策略时返回 (None, None)"""
+        with timed_stage("path"):
+            now = time.monotonic()
+            with self._lock:
+                entry = self._cache.get(path)
+                if entry is not None and now - entry[0] < PATH_CACHE_TTL:
+                    self._cache.move_to_end(path)
+                    self.hits += 1
+                    return entry[1], entry[2]
+                self.misses += 1
+
+            rel_path = canonical_relpath(path, self.root)
+            sys_path = None
+            if rel_path is not None and self._symlinks_allowed(rel_path):
+                sys_path = os.path.join(self.root, system_path(rel_path)) if rel_path else self.root
+            else:
+                rel_path = None
+
+            with self._lock:
+                self._cache[path] = (now, rel_path, sys_path)
+                self._cache.move_to_end(path)
+                while len(self._cache) > self.size:
+                    self._cache.popitem(last=False)
+            return rel_path, sys_path
+
+    def _symlinks_allowed(self, rel_path):
+        if self.policy == "follow" or not rel_path:
+            return True
+        try:
+            if _OPENAT_SUPPORTED:
+                return self._walk(rel_path)
+            # 不支持dir_fd的平台（Windows）：比较解析符号链接后的真实路径
+            sys_path = os.path.join(self.root, system_path(rel_path))
+            real_path = os.path.realpath(sys_path)
+            if self.policy == "deny":
+                return os.path.normcase(real_path) == os.path.normcase(os.path.join(os.path.realpath(self.root), system_path(rel_path)))
+            return path_in_workspace(real_path, os.path.realpath(self.root))
+        except OSError:
+            return False
+
+    def _walk(self, rel_path):
+        """
+        以openat方式（dir_fd + O_NOFOLLOW）从工作区根目录逐级打开目录，
+        遇到符号链接时按策略拒绝或在工作区内继续解析其目标；不存在的部分中不会有符号链接，不再检查
+        """
+        flags = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+        fd = os.open(self.root, os.O_RDONLY | os.O_DIRECTORY)
+        depth = 0  # 当前目录在工作区内的层数
+        hops = 0
+        pending = list(reversed(rel_path.split("/")))
+        try:
+            while pending:
+                name = pending.pop()
+                if name in ("", "."):
+                    continue
+                if name == "..":
+                    if depth == 0:
+                        return False
+                    parent = os.open("..", flags, dir_fd=fd)
+                    os.close(fd)
+                    fd = parent
+                    depth -= 1
+                    continue
+                try:
+                    st = os.stat(name, dir_fd=fd, follow_symlinks=False)
+                except (FileNotFoundError, NotADirectoryError):
+                    return True
+                if stat.S_ISLNK(st.st_mode):
+                    hops += 1
+                    if self.policy == "deny" or hops > PATH_MAX_SYMLINKS:
+                        return False
+                    target = os.readlink(name, dir_fd=fd)
+                    if os.path.isabs(target):
+                        # 绝对路径的目标：换算为工作区内的相对路径后从根目录重新解析
+                        if self._real_root is None:
+                            self._real_root = os.path.realpath(self.root)
+                        target = os.path.normpath(target)
+                        if path_in_workspace(target, self.root):
+                            base = self.root
+                        elif path_in_workspace(target, self._real_root):
+                            base = self._real_root
+                        else:
+                            return False
+                        root_fd = os.open(self.root, os.O_RDONLY | os.O_DIRECTORY)
+                        os.close(fd)
+                        fd = root_fd
+                        depth = 0
+                        target = normalize_path(os.path.relpath(target, base))
+                    pending.extend(reversed(target.split("/")))
+                    continue
+                if pending and stat.S_ISDIR(st.st_mode):
+                    child = os.open(name, flags, dir_fd=fd)
+                    os.close(fd)
+                    fd = child
+                    depth += 1
+                elif pending:
+                    # 中间部分是文件，后续的文件操作会失败，这里不必继续
+                    return True
+            return True
+        finally:
+            os.close(fd)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._cache), "max_size": self.size, "hits": self.hits, "misses": self.misses}
+
+def resolve_workspace_path(path, status_code=403, detail=OUTSIDE_WORKSPACE):
+    """把请求中的路径解析为当前工作区内的 (相对路径, 系统路径)，不在工作区内时抛出HTTPException"""
+    rel_path, sys_path = current_workspace().paths.resolve(path)
+    if sys_path is None:
+        raise HTTPException(status_code=status_code, detail=detail)
+    if rel_path == TRASH_DIR or rel_path.startswith(TRASH_DIR + "/"):
+        raise HTTPException(status_code=400, detail="回收目录不能直接访问")
+    return rel_path, sys_path
+
 # 数据模型
 class FileInfo(BaseModel):
     path: str
@@ -125,6 +474,7 @@ class HistoryFileInfo(BaseModel):
     history_path: str
     name: str
     timestamp: str
+    version: Optional[int] = None
     content: Optional[str] = None
 
 class YAMLContent(BaseModel):
@@ -140,412 +490,6167 @@ class FileMove(BaseModel):
 class MihomoConfig(BaseModel):
     address: str
 
-# 读取配置
-def get_config():
-    if os.path.exists(CONFIG_FILE):
+class TextEdit(BaseModel):
+    start_line: int
+    end_line: int
+    text: str = ""
+
+class YAMLValidate(BaseModel):
+    content: Optional[str] = None
+    base_hash: Optional[str] = None
+    edits: List[TextEdit] = []
+
+class FilePatch(BaseModel):
+    base_etag: Optional[str] = None
+    diff: Optional[str] = None
+    edits: Optional[List[TextEdit]] = None
+
+class BatchOperation(BaseModel):
+    op: str                       # read / save / patch / delete / move
+    path: str
+    target: Optional[str] = None  # move的目标路径
+    content: Optional[str] = None
+    base_etag: Optional[str] = None
+    diff: Optional[str] = None
+    edits: Optional[List[TextEdit]] = None
+    id: Optional[str] = None      # 调用方自定义的标识，原样返回
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
+    atomic: bool = False
+    concurrency: Optional[int] = None
+
+class HistoryRestore(BaseModel):
+    file_path: str
+    version: int
+
+# 运行指标
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # 设置后Prometheus可用该Bearer令牌抓取/metrics
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))  # 超过该耗时的请求打印分阶段耗时，0表示关闭
+LOOP_LAG_INTERVAL = 0.5  # 事件循环延迟的采样间隔（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # 标签值 -> [各桶计数..., 总和, 次数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(label_values, list(series)) for label_values, series in self._series.items()]
+        for label_values, series in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                labels = format_labels(self.labels + ("le",), label_values + (repr(float(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels + ("le",), label_values + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {series[-2]}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+class Gauge:
+    """
+    采集时调用fn取值，fn返回数值或 [(标签值元组, 数值)]
+    kind为counter时用于输出其他组件自己累计的计数
+    """
+
+    def __init__(self, name, help_text, fn, labels=(), kind="gauge"):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.labels = labels
+        self.kind = kind
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
         try:
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                config = json.load(f)
-                return config
+            value = self.fn()
         except Exception as e:
-            print(f"读取配置文件错误: {e}")
-    
-    # 默认配置
-    config = {
-        "workspace_dir": normalize_path(WORKSPACE_DIR)  # 使用规范化的路径
-    }
-    
-    # 保存默认配置
+            print(f"采集指标 {self.name} 失败: {e}")
+            return lines
+        samples = value if isinstance(value, list) else [((), value)]
+        for label_values, sample in samples:
+            if sample is not None:
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {sample}")
+        return lines
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class MetricsRegistry:
+    """进程内的指标注册表，按Prometheus文本格式输出"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        metric = Counter(self.prefix + name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(self.prefix + name, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, fn, labels=(), kind="gauge"):
+        metric = Gauge(self.prefix + name, help_text, fn, labels, kind)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry("yaml_editor_")
+http_request_seconds = metrics.histogram("http_request_duration_seconds", "HTTP请求耗时（到响应体发送完毕）", ("method", "route", "status"))
+http_requests_in_flight = 0
+file_read_bytes = metrics.counter("file_read_bytes_total", "从工作区读取的字节数")
+file_written_bytes = metrics.counter("file_written_bytes_total", "写入磁盘的字节数（含历史版本和配置）")
+yaml_parse_seconds = metrics.histogram("yaml_parse_seconds", "YAML校验解析耗时（未命中缓存时，含在解析池中的排队）")
+tree_scan_seconds = metrics.histogram("tree_scan_seconds", "目录树扫描耗时", ("kind",))
+mihomo_upstream_seconds = metrics.histogram("mihomo_upstream_seconds", "Mihomo上游返回响应头的耗时", ("status",))
+loop_lag_seconds = metrics.histogram("event_loop_lag_seconds", "事件循环调度延迟", buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+metrics.gauge("http_requests_in_flight", "正在处理的HTTP请求数", lambda: http_requests_in_flight)
+
+# 当前请求各阶段（auth、path、io、parse、queue）的累计耗时，供慢请求日志使用
+_request_stages = contextvars.ContextVar("request_stages", default=None)
+
+@contextlib.contextmanager
+def timed_stage(name):
+    stages = _request_stages.get()
+    if stages is None:
+        yield
+        return
+    started = time.perf_counter()
     try:
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(config, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"保存配置文件错误: {e}")
-    
-    return config
+        yield
+    finally:
+        stages[name] = stages.get(name, 0.0) + time.perf_counter() - started
 
-# 获取工作目录
-def get_workspace_dir():
-    return WORKSPACE_DIR  # 直接返回环境变量中的工作目录
+def add_stage_time(name, seconds):
+    stages = _request_stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
 
-# 获取历史文件目录
-def get_history_dir():
-    workspace_dir = get_workspace_dir()
-    history_dir = os.path.join(workspace_dir, "history")
-    
-    # 确保历史目录存在
-    sys_history_dir = system_path(history_dir)
-    os.makedirs(sys_history_dir, exist_ok=True)
-    
-    # 返回规范化的路径
-    return normalize_path(history_dir)
+class MetricsMiddleware:
+    """记录每个路由的请求耗时，超过SLOW_REQUEST_MS时打印分阶段耗时"""
+
+    def __init__(self, app):
+        self.app = app
+        self._route_names = None
+
+    def route_name(self, scope):
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if self._route_names is None:
+            names = {}
+            for route in scope["app"].routes:
+                target = getattr(route, "endpoint", None) or getattr(route, "app", None)
+                if target is not None:
+                    names.setdefault(target, route.path if hasattr(route, "endpoint") else route.path + "/*")
+            self._route_names = names
+        return self._route_names.get(endpoint, "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        global http_requests_in_flight
+        stages = {}
+        token = _request_stages.set(stages)
+        started = time.perf_counter()
+        status = 500
+        finished = False
+
+        def record():
+            nonlocal finished
+            if finished:
+                return
+            finished = True
+            elapsed = time.perf_counter() - started
+            route = self.route_name(scope)
+            http_request_seconds.observe(elapsed, scope["method"], route, str(status))
+            if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+                breakdown = " ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in sorted(stages.items()))
+                print(f"慢请求: {scope['method']} {scope['path']} -> {status} 耗时 {elapsed * 1000:.1f}ms [{breakdown or '无阶段记录'}]")
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                record()
+
+        http_requests_in_flight += 1
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_requests_in_flight -= 1
+            record()
+            _request_stages.reset(token)
+
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+async def monitor_loop_lag():
+    """定期睡眠固定间隔，实际醒来时间与预期之差即事件循环的调度延迟"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag_seconds.observe(max(0.0, loop.time() - expected))
+
+_loop_lag_task = None
 
-# 清理历史文件
-def clean_history_files(original_file_name, limit=5):
+@app.on_event("startup")
+async def start_loop_lag_monitor():
+    global _loop_lag_task
+    if METRICS_ENABLED:
+        _loop_lag_task = asyncio.ensure_future(monitor_loop_lag())
+
+@app.on_event("shutdown")
+async def stop_loop_lag_monitor():
+    if _loop_lag_task is not None:
+        _loop_lag_task.cancel()
+
+# 后台工作池
+IO_POOL_SIZE = int(os.getenv("IO_POOL_SIZE", "16"))  # 文件I/O线程数
+IO_POOL_MAX_PENDING = int(os.getenv("IO_POOL_MAX_PENDING", "0"))  # 等待队列上限，0表示不限制
+CPU_POOL_SIZE = int(os.getenv("CPU_POOL_SIZE", str(os.cpu_count() or 2)))  # YAML解析/校验并发数
+CPU_POOL_MAX_PENDING = int(os.getenv("CPU_POOL_MAX_PENDING", "0"))
+CPU_POOL_MODE = os.getenv("CPU_POOL_MODE", "thread").lower()  # thread / process
+BULK_POOL_SIZE = int(os.getenv("BULK_POOL_SIZE", str(os.cpu_count() or 2)))  # 批量校验等后台任务的并发数
+BULK_POOL_MODE = os.getenv("BULK_POOL_MODE", "process").lower()  # process / thread
+
+class WorkerPool:
     """
-    清理指定原始文件的历史版本，只保留最近的limit个版本
+    带并发上限的执行池，阻塞的文件操作和YAML解析都通过它离开事件循环
+    同时记录排队深度、运行数量和等待耗时等指标
     """
-    try:
-        history_dir = get_history_dir()
-        sys_history_dir = system_path(history_dir)
-        
-        # 获取所有历史文件
-        all_files = os.listdir(sys_history_dir)
-        
-        # 筛选出属于该原始文件的历史版本
-        file_name_without_ext, file_ext = os.path.splitext(original_file_name)
-        history_files = [f for f in all_files if f.startswith(file_name_without_ext + "_")]
-        
-        # 按时间戳排序（新的在前）
-        history_files.sort(key=lambda x: os.path.getmtime(os.path.join(sys_history_dir, x)), reverse=True)
-        
-        # 删除多余的历史文件
-        if len(history_files) > limit:
-            for old_file in history_files[limit:]:
-                try:
-                    os.remove(os.path.join(sys_history_dir, old_file))
-                except Exception as e:
-                    print(f"删除旧历史文件失败: {old_file}, 错误: {e}")
-    except Exception as e:
-        print(f"清理历史文件失败: {e}")
 
-# 保存历史文件
-def save_history_file(file_path, content):
-    try:
-        # 获取文件名和扩展名
-        file_name = os.path.basename(file_path)
-        file_name_without_ext, file_ext = os.path.splitext(file_name)
-        
-        # 创建带时间戳的文件名
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        history_file_name = f"{file_name_without_ext}_{timestamp}{file_ext}"
-        
-        # 获取历史目录
-        history_dir = get_history_dir()
-        history_file_path = os.path.join(history_dir, history_file_name)
-        
-        # 保存历史文件
-        with open(system_path(history_file_path), 'w', encoding='utf-8') as f:
-            f.write(content)
-        
-        # 清理旧的历史文件
-        clean_history_files(file_name)
-        
-        # 返回历史文件信息
+    def __init__(self, name, max_workers, max_pending=0, use_processes=False, stage=None):
+        self.name = name
+        self.stage = stage or name  # 慢请求日志中归入的阶段
+        self.max_workers = max(1, max_workers)
+        self.max_pending = max_pending
+        self.use_processes = use_processes
+        self._executor = None
+        self._semaphore = None
+        self.pending = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_pending_seen = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.use_processes:
+                # 服务进程里已有目录监听、索引等线程，fork出的子进程可能继承被占用的锁而死锁，支持时改用forkserver
+                context = multiprocessing.get_context("forkserver") if "forkserver" in multiprocessing.get_all_start_methods() else None
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix=f"{self.name}-pool"
+                )
+        return self._executor
+
+    async def run(self, fn, *args, **kwargs):
+        """在池中执行fn，超过并发上限时排队，排队超过上限时返回503"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        if self.max_pending and self._semaphore.locked() and self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="服务器繁忙，请稍后重试")
+
+        loop = asyncio.get_running_loop()
+        queued_at = time.perf_counter()
+        self.pending += 1
+        self.max_pending_seen = max(self.max_pending_seen, self.pending)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.pending -= 1
+        started_at = time.perf_counter()
+        self.wait_seconds += started_at - queued_at
+        add_stage_time("queue", started_at - queued_at)
+        self.active += 1
+        try:
+            if self.use_processes:
+                call = functools.partial(fn, *args, **kwargs)
+            else:
+                # 线程池中保留当前请求的上下文变量
+                call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+            result = await loop.run_in_executor(self._get_executor(), call)
+            self.completed += 1
+            return result
+        except BaseException:
+            self.failed += 1
+            raise
+        finally:
+            self.active -= 1
+            elapsed = time.perf_counter() - started_at
+            self.run_seconds += elapsed
+            add_stage_time(self.stage, elapsed)
+            self._semaphore.release()
+
+    def stats(self):
         return {
-            "original_path": file_path,
-            "history_path": normalize_path(os.path.join("history", history_file_name)),
-            "name": history_file_name,
-            "timestamp": timestamp
+            "name": self.name,
+            "mode": "process" if self.use_processes else "thread",
+            "max_workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "active": self.active,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "max_pending_seen": self.max_pending_seen,
+            "wait_seconds": round(self.wait_seconds, 6),
+            "run_seconds": round(self.run_seconds, 6)
         }
-    except Exception as e:
-        print(f"保存历史文件失败: {e}")
-        return None
 
-# 获取历史文件列表
-def get_history_files(file_path=None):
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._semaphore = None
+
+io_pool = WorkerPool("io", IO_POOL_SIZE, IO_POOL_MAX_PENDING)
+cpu_pool = WorkerPool("cpu", CPU_POOL_SIZE, CPU_POOL_MAX_PENDING, use_processes=CPU_POOL_MODE == "process", stage="parse")
+bulk_pool = WorkerPool("bulk", BULK_POOL_SIZE, use_processes=BULK_POOL_MODE == "process", stage="parse")
+
+def pool_samples(field):
+    return lambda: [((pool.name,), getattr(pool, field)) for pool in (io_pool, cpu_pool, bulk_pool)]
+
+metrics.gauge("pool_workers", "工作池的并发上限", pool_samples("max_workers"), ("pool",))
+metrics.gauge("pool_active", "工作池中正在执行的任务数", pool_samples("active"), ("pool",))
+metrics.gauge("pool_pending", "工作池中排队等待的任务数", pool_samples("pending"), ("pool",))
+metrics.gauge("pool_completed_total", "工作池累计完成的任务数", pool_samples("completed"), ("pool",), kind="counter")
+metrics.gauge("pool_rejected_total", "因排队过长被拒绝(503)的任务数", pool_samples("rejected"), ("pool",), kind="counter")
+metrics.gauge("pool_wait_seconds_total", "工作池累计排队耗时", pool_samples("wait_seconds"), ("pool",), kind="counter")
+metrics.gauge("pool_run_seconds_total", "工作池累计执行耗时", pool_samples("run_seconds"), ("pool",), kind="counter")
+
+@app.on_event("shutdown")
+async def shutdown_worker_pools():
+    io_pool.shutdown()
+    cpu_pool.shutdown()
+    bulk_pool.shutdown()
+
+def format_yaml_error(error_msg):
+    """把PyYAML的错误信息转换为友好的提示"""
+    if "found character '\\t'" in error_msg:
+        return "YAML文件中不能使用制表符(Tab)，请使用空格进行缩进"
+    elif "found unknown escape character" in error_msg:
+        return "YAML文件中包含无效的转义字符"
+    elif "could not find expected ':'" in error_msg:
+        return "YAML格式错误：缺少冒号(:)，请检查键值对格式"
+    elif "mapping values are not allowed here" in error_msg:
+        return "YAML格式错误：缩进不正确或在不允许的位置使用了冒号"
+    return f"YAML格式错误：{error_msg}"
+
+# 文件写入
+WRITE_FSYNC = os.getenv("WRITE_FSYNC", "file").lower()  # none：不同步 / file：同步文件内容 / dir：同时同步所在目录
+
+def fsync_dir(dir_path):
+    """同步目录项，保证重命名在崩溃后依然有效（Windows不支持目录同步）"""
+    if os.name == "nt":
+        return
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def atomic_write(path, data, pending=None):
     """
-    获取历史文件列表
-    如果指定了file_path，则只返回该文件的历史版本
-    否则返回所有文件的最新历史版本
+    先写入同目录下的临时文件再重命名替换，其他读取者和崩溃后都不会看到写了一半的文件
+    传入pending列表时只写临时文件并把 (临时文件, 目标文件) 加入列表，由GroupCommitter统一同步和重命名
     """
-    history_dir = get_history_dir()
-    history_files = []
-    
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
     try:
-        # 获取所有历史文件
-        files = os.listdir(system_path(history_dir))
-        
-        if file_path:
-            # 如果指定了文件路径，只获取该文件的历史版本
-            file_name = os.path.basename(file_path)
-            file_name_without_ext = os.path.splitext(file_name)[0]
-            files = [f for f in files if f.startswith(file_name_without_ext + "_")]
-        
-        # 按修改时间排序
-        files.sort(key=lambda x: os.path.getmtime(os.path.join(system_path(history_dir), x)), reverse=True)
-        
-        # 如果没有指定文件路径，对每个原始文件只保留最新的一个版本
-        if not file_path:
-            seen_files = set()
-            filtered_files = []
-            for file in files:
-                original_name = "_".join(os.path.splitext(file)[0].split("_")[:-2])
-                if original_name not in seen_files:
-                    seen_files.add(original_name)
-                    filtered_files.append(file)
-            files = filtered_files
-        
-        for file in files:
-            file_path = os.path.join(history_dir, file)
-            # 解析文件名获取原始文件名和时间戳
-            parts = os.path.splitext(file)[0].split('_')
-            timestamp_str = parts[-2] + "_" + parts[-1] if len(parts) >= 2 else ""
-            original_name = "_".join(parts[:-2]) if len(parts) >= 2 else file
-            
-            history_files.append(HistoryFileInfo(
-                original_path=original_name,
-                history_path=normalize_path(os.path.join("history", file)),
-                name=file,
-                timestamp=timestamp_str
-            ))
-        
-        return history_files
-    except Exception as e:
-        print(f"获取历史文件列表失败: {e}")
-        return []
+        if isinstance(data, str):
+            f = open(tmp_path, 'w', encoding='utf-8')
+        else:
+            f = open(tmp_path, 'wb')
+        with f:
+            f.write(data)
+            f.flush()
+            file_written_bytes.inc(os.fstat(f.fileno()).st_size)
+            if pending is None and WRITE_FSYNC != "none":
+                os.fsync(f.fileno())
+        try:
+            shutil.copymode(path, tmp_path)
+        except FileNotFoundError:
+            pass
+        if pending is not None:
+            pending.append((tmp_path, path))
+            tmp_path = None
+            return
+        os.replace(tmp_path, path)
+        tmp_path = None
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    if WRITE_FSYNC == "dir":
+        fsync_dir(os.path.dirname(path) or os.curdir)
 
-# 设置工作目录
-@app.post("/api/config/workspace")
-async def set_workspace_dir(config: DirectoryConfig):
-    """设置工作目录"""
-    try:
-        # 规范化路径
-        workspace_dir = normalize_path(config.path)
-        
-        # 验证目录是否存在
-        if not os.path.isdir(system_path(workspace_dir)):
-            raise HTTPException(status_code=400, detail=f"目录不存在: {workspace_dir}")
-        
-        # 更新配置
-        current_config = get_config()
-        current_config["workspace_dir"] = workspace_dir
-        
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(current_config, f, ensure_ascii=False, indent=2)
-        
-        return {"message": "工作目录设置成功", "path": workspace_dir}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+class GroupCommitter:
+    """
+    组提交：window秒内到达的写入合并为一批，统一同步临时文件、按提交顺序重命名，
+    再对涉及的目录各同步一次，多个请求分摊同一次fsync的开销
+    """
 
-# 获取当前工作目录
-@app.get("/api/config/workspace")
-async def get_current_workspace():
-    """获取当前工作目录"""
-    workspace_dir = get_workspace_dir()
-    return {"path": workspace_dir}
+    def __init__(self, window):
+        self.window = window
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._collecting = False
+        self._batch = 0      # 正在收集的批次编号
+        self._done = 0       # 已完成的批次数
+        self._errors = {}    # 批次编号 -> 异常
+        self.batches = 0
+        self.writes = 0
 
-@app.post("/api/config/mihomo")
-async def set_mihomo_address(config: MihomoConfig, token: dict = Depends(verify_token)):
-    """设置Mihomo地址"""
-    try:
-        current_config = get_config()
-        current_config["mihomo_address"] = config.address
-        
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(current_config, f, ensure_ascii=False, indent=2)
-        
-        return {"message": "Mihomo地址设置成功", "address": config.address}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    def commit(self, pending):
+        """提交一组 (临时文件, 目标文件)，阻塞到所在批次写入完成"""
+        with self._cond:
+            self._pending.extend(pending)
+            batch = self._batch
+            leader = not self._collecting
+            self._collecting = True
+        if leader:
+            # 第一个到达的请求负责等待并执行整批写入
+            time.sleep(self.window)
+            with self._flush_lock:
+                with self._cond:
+                    items, self._pending = self._pending, []
+                    self._batch += 1
+                    self._collecting = False
+                error = None
+                try:
+                    self._flush(items)
+                except Exception as e:
+                    error = e
+                with self._cond:
+                    if error is not None:
+                        self._errors[batch] = error
+                    self._errors.pop(batch - 64, None)
+                    self._done = batch + 1
+                    self.batches += 1
+                    self.writes += len(items)
+                    self._cond.notify_all()
+        with self._cond:
+            while self._done <= batch:
+                self._cond.wait()
+            error = self._errors.get(batch)
+        if error is not None:
+            raise error
 
-@app.get("/api/config/mihomo")
-async def get_mihomo_address(token: dict = Depends(verify_token)):
-    """获取Mihomo地址"""
-    config = get_config()
-    address = config.get("mihomo_address", "")
-    return {"address": address}
+    @staticmethod
+    def _flush(items):
+        try:
+            if WRITE_FSYNC != "none":
+                for tmp_path, _ in items:
+                    fd = os.open(tmp_path, os.O_RDWR)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+            for tmp_path, path in items:
+                os.replace(tmp_path, path)
+        finally:
+            for tmp_path, _ in items:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        if WRITE_FSYNC == "dir":
+            for dir_path in {os.path.dirname(path) for _, path in items}:
+                fsync_dir(dir_path)
 
-# Mihomo代理
-@app.api_route("/api/mihomo/proxy/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
-async def mihomo_proxy(path: str, request: Request):
-    """代理Mihomo API请求"""
-    config = get_config()
-    mihomo_address = config.get("mihomo_address")
+    def stats(self):
+        return {"window": self.window, "batches": self.batches, "writes": self.writes}
 
-    if not mihomo_address:
-        raise HTTPException(status_code=400, detail="Mihomo地址未配置")
+def read_text_file(sys_file_path):
+    with open(sys_file_path, 'r', encoding='utf-8') as f:
+        file_read_bytes.inc(os.fstat(f.fileno()).st_size)
+        return f.read()
 
-    # 解析Mihomo地址
-    if not mihomo_address.startswith(('http://', 'https://')):
-        mihomo_address = f"http://{mihomo_address}"
-    
-    parsed_uri = urlparse(mihomo_address)
-    host = parsed_uri.netloc
-    
-    url = f"http://{host}/{path}"
-    
-    headers = {key: value for key, value in request.headers.items() if key.lower() not in ['host', 'authorization']}
-    headers['Host'] = host
-    
+def write_text_file(sys_file_path, content):
+    atomic_write(sys_file_path, content)
+
+def remove_path(sys_path):
+    """删除文件或目录（目录递归删除）"""
+    if os.path.isdir(sys_path) and not os.path.islink(sys_path):
+        if os.listdir(sys_path):
+            shutil.rmtree(sys_path)
+        else:
+            os.rmdir(sys_path)
+    else:
+        os.remove(sys_path)
+
+def move_path(sys_source_path, sys_target_path, copy_fallback=True):
+    """
+    同一文件系统内用os.rename移动（耗时与大小无关），跨设备时退回复制+删除；
+    copy_fallback为False时跨设备抛出EXDEV，由调用方自行复制
+    """
+    os.makedirs(os.path.dirname(sys_target_path), exist_ok=True)
     try:
-        async with httpx.AsyncClient() as client:
-            if request.method == "GET":
-                response = await client.get(url, headers=headers, params=request.query_params)
-            elif request.method == "POST":
-                body = await request.body()
-                response = await client.post(url, headers=headers, content=body)
-            elif request.method == "PUT":
-                body = await request.body()
-                response = await client.put(url, headers=headers, content=body)
-            elif request.method == "DELETE":
-                response = await client.delete(url, headers=headers)
+        os.rename(sys_source_path, sys_target_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV or not copy_fallback:
+            raise
+        shutil.move(sys_source_path, sys_target_path)
+
+# 文件复制
+COPY_CHUNK_SIZE = int(os.getenv("COPY_CHUNK_SIZE", str(8 * 1024 * 1024)))  # 复制大文件时每段的字节数，段之间可以取消
+COPY_PARALLEL = int(os.getenv("COPY_PARALLEL", "4"))  # 复制目录时同时进行的复制块数
+COPY_BATCH_FILES = 64  # 小文件按此数量（或COPY_CHUNK_SIZE字节）合并为一个复制块
+
+def plan_copy(sys_source_path):
+    """
+    列出要复制的内容，返回 (目录列表, [(相对路径, 大小, 是否符号链接)], 总字节数)，相对路径以/分隔，
+    源是文件时唯一的条目相对路径为空字符串；符号链接按链接本身复制，不跟随
+    """
+    if not os.path.isdir(sys_source_path) or os.path.islink(sys_source_path):
+        st = os.lstat(sys_source_path)
+        return [], [("", st.st_size, os.path.islink(sys_source_path))], st.st_size
+    dirs, files, total = [], [], 0
+    pending = [""]
+    while pending:
+        rel_dir = pending.pop()
+        with os.scandir(os.path.join(sys_source_path, system_path(rel_dir)) if rel_dir else sys_source_path) as it:
+            for entry in it:
+                rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(rel_path)
+                    pending.append(rel_path)
+                elif entry.is_symlink():
+                    files.append((rel_path, 0, True))
+                elif entry.is_file(follow_symlinks=False):
+                    size = entry.stat(follow_symlinks=False).st_size
+                    files.append((rel_path, size, False))
+                    total += size
+    return dirs, files, total
+
+def copy_file_chunked(sys_source_path, sys_target_path, job=None):
+    """分段复制文件（Linux上使用sendfile在内核中复制），每段之后更新进度并检查是否已取消"""
+    with open(sys_source_path, 'rb') as src, open(sys_target_path, 'wb') as dst:
+        offset = 0
+        while True:
+            if job is not None:
+                job.check_cancelled()
+            if hasattr(os, "sendfile"):
+                try:
+                    copied = os.sendfile(dst.fileno(), src.fileno(), offset, COPY_CHUNK_SIZE)
+                except OSError as e:
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK):
+                        raise
+                    copied = None
             else:
-                raise HTTPException(status_code=405, detail="Method Not Allowed")
+                copied = None
+            if copied is None:
+                data = src.read(COPY_CHUNK_SIZE)
+                dst.write(data)
+                copied = len(data)
+            if not copied:
+                break
+            offset += copied
+            if job is not None:
+                job.advance(copied)
+    shutil.copystat(sys_source_path, sys_target_path)
 
-        return Response(content=response.content, status_code=response.status_code, headers=dict(response.headers))
-    except httpx.RequestError as e:
-        raise HTTPException(status_code=500, detail=f"请求Mihomo API失败: {e}")
-    except httpx.HTTPStatusError as e:
-        raise HTTPException(status_code=e.response.status_code, detail=f"Mihomo API返回错误: {e.response.text}")
+def copy_files(sys_source_path, sys_target_path, items, job=None):
+    """复制一个复制块中的文件（目录已创建）"""
+    for rel_path, size, is_link in items:
+        src = os.path.join(sys_source_path, system_path(rel_path)) if rel_path else sys_source_path
+        dst = os.path.join(sys_target_path, system_path(rel_path)) if rel_path else sys_target_path
+        if job is not None:
+            job.check_cancelled()
+            job.current = rel_path or posixpath.basename(normalize_path(sys_source_path))
+        if is_link:
+            os.symlink(os.readlink(src), dst)
+        else:
+            copy_file_chunked(src, dst, job)
+    return len(items)
 
-# 递归获取目录结构
-def get_directory_structure(dir_path, base_path):
-    result = []
-    for item in os.listdir(dir_path):
-        item_path = os.path.join(dir_path, item)
-        rel_path = os.path.relpath(item_path, base_path)
-        # 规范化相对路径
-        rel_path = normalize_path(rel_path)
-        
-        if os.path.isdir(item_path):
-            # 目录
-            children = get_directory_structure(item_path, base_path)
-            result.append(FileInfo(
-                path=rel_path,
-                name=item,
-                isDirectory=True,
-                children=children
-            ))
-        elif item.endswith(('.yaml', '.yml')):
-            # YAML文件
-            result.append(FileInfo(
-                path=rel_path,
-                name=item,
-                isDirectory=False
-            ))
-    
-    # 排序：目录在前，文件在后，按名称排序
-    result.sort(key=lambda x: (not x.isDirectory, x.name.lower()))
-    
-    return result
+def copy_chunks(files):
+    """把文件列表分成复制块：大文件单独成块，小文件按数量和总大小合并"""
+    chunk, chunk_bytes = [], 0
+    for item in files:
+        if item[1] >= COPY_CHUNK_SIZE:
+            yield [item]
+            continue
+        chunk.append(item)
+        chunk_bytes += item[1]
+        if len(chunk) >= COPY_BATCH_FILES or chunk_bytes >= COPY_CHUNK_SIZE:
+            yield chunk
+            chunk, chunk_bytes = [], 0
+    if chunk:
+        yield chunk
 
-@app.get("/api/files")
-async def list_files(search: str = "", token: dict = Depends(verify_token)):
-    """获取文件列表"""
-    workspace_dir = get_workspace_dir()
-    sys_workspace_dir = system_path(workspace_dir)
+@app.get("/api/status/pools")
+async def get_pool_status(token: dict = Depends(verify_token)):
+    """获取工作池和Mihomo连接池的运行状态"""
+    return {
+        "io": io_pool.stats(),
+        "cpu": cpu_pool.stats(),
+        "bulk": bulk_pool.stats(),
+        "mihomo": mihomo_client.stats(),
+        "history_commit": history_committer.stats() if history_committer is not None else None,
+        "auth": token_cache.stats()
+    }
+
+# 配置存储
+CONFIG_RELOAD_INTERVAL = float(os.getenv("CONFIG_RELOAD_INTERVAL", "1"))  # 检查配置文件是否被外部修改的最小间隔（秒）
+
+class ConfigStore:
+    """
+    内存中的配置缓存：启动后只读取一次，配置文件被外部修改时自动重新加载，
+    写入时加锁并通过临时文件+重命名原子替换，避免并发写入损坏文件
+    """
+
+    def __init__(self, path, defaults):
+        self.path = path
+        self.defaults = defaults
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._stat = None
+        self._checked_at = 0.0
+
+    def _file_stat(self):
+        try:
+            st = os.stat(self.path)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def _load(self):
+        stat_key = self._file_stat()
+        if stat_key is not None:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+                self._snapshot = types.MappingProxyType(config)
+                self._stat = stat_key
+                return
+            except Exception as e:
+                print(f"读取配置文件错误: {e}")
+                if self._snapshot is not None:
+                    # 文件可能正在被外部程序写入，保留上一次的配置
+                    return
+        
+        # 默认配置
+        config = dict(self.defaults)
+        self._snapshot = types.MappingProxyType(config)
+        
+        # 保存默认配置
+        if stat_key is None:
+            try:
+                self._write(config)
+            except Exception as e:
+                print(f"保存配置文件错误: {e}")
+
+    def _write(self, config):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        atomic_write(self.path, json.dumps(config, ensure_ascii=False, indent=2))
+        self._stat = self._file_stat()
+
+    def snapshot(self):
+        """返回当前配置的只读视图，每CONFIG_RELOAD_INTERVAL秒最多检查一次文件变化"""
+        now = time.monotonic()
+        if self._snapshot is None or now - self._checked_at >= CONFIG_RELOAD_INTERVAL:
+            with self._lock:
+                if self._snapshot is None or self._file_stat() != self._stat:
+                    self._load()
+                self._checked_at = now
+        return self._snapshot
+
+    def update(self, **changes):
+        """修改配置项并原子写回文件，返回新的配置"""
+        return self.modify(lambda config: config.update(changes))
+
+    def modify(self, fn):
+        """在锁内以磁盘上的最新配置调用fn(config)就地修改，然后原子写回文件"""
+        with self._lock:
+            with self._file_lock():
+                # 先读取磁盘上的最新配置，避免覆盖其他进程的修改
+                if self._file_stat() != self._stat:
+                    self._load()
+                config = dict(self._snapshot or self.defaults)
+                fn(config)
+                self._write(config)
+                self._snapshot = types.MappingProxyType(config)
+                self._checked_at = time.monotonic()
+                return self._snapshot
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        """多进程部署时用文件锁串行化写入"""
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".lock", 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+config_store = ConfigStore(CONFIG_FILE, {
+    "workspace_dir": normalize_path(WORKSPACE_DIR)  # 使用规范化的路径
+})
+revocation_store = ConfigStore(REVOKED_TOKENS_FILE, {"revoked_tokens": {}})
+
+# 读取配置
+def get_config():
+    """返回配置的只读快照，修改配置请使用 config_store.update"""
+    return config_store.snapshot()
+
+# 多工作区：认证时根据令牌和请求选择工作区，保存在上下文变量中（会随请求进入线程池）
+DEFAULT_WORKSPACE = "default"
+_current_workspace = contextvars.ContextVar("current_workspace", default=None)
+
+def current_workspace():
+    """当前请求所选的工作区，没有请求上下文时（启动、后台线程）为默认工作区"""
+    workspace = _current_workspace.get()
+    return workspace if workspace is not None else workspaces.get()
+
+class WorkspaceLocal:
+    """
+    把属性访问转发给当前工作区中的对象，
+    tree_index、history_store等模块级名称因此在各个工作区中都能直接使用
+    """
+    __slots__ = ("_attr",)
+
+    def __init__(self, attr):
+        self._attr = attr
+
+    def __getattr__(self, name):
+        return getattr(getattr(current_workspace(), self._attr), name)
+
+def default_workspace_dir():
+    """默认工作区的目录：优先使用已保存的配置（/api/config/workspace），目录不存在时使用WORKSPACE_DIR"""
+    configured = get_config().get("workspace_dir")
+    if configured and os.path.isdir(system_path(configured)):
+        return normalize_path(configured)
+    return normalize_path(WORKSPACE_DIR)
+
+# 获取工作目录
+def get_workspace_dir():
+    return current_workspace().path
+
+# 获取历史文件目录
+def get_history_dir():
+    workspace_dir = get_workspace_dir()
+    history_dir = os.path.join(workspace_dir, "history")
+    
+    # 确保历史目录存在
+    sys_history_dir = system_path(history_dir)
+    os.makedirs(sys_history_dir, exist_ok=True)
+    
+    # 返回规范化的路径
+    return normalize_path(history_dir)
+
+# 历史版本存储
+HISTORY_LIMIT = int(os.getenv("HISTORY_LIMIT", "200"))  # 每个文件默认保留的历史版本数
+HISTORY_COMPRESSION = os.getenv("HISTORY_COMPRESSION", "zstd").lower()  # zstd / none
+HISTORY_SNAPSHOT_INTERVAL = int(os.getenv("HISTORY_SNAPSHOT_INTERVAL", "20"))  # 每隔多少个版本保存一次完整快照
+HISTORY_DELTA_MAX_LINES = 200000  # 超过此行数的文件不计算增量
+HISTORY_STORE_DIR = ".store"
+HISTORY_MANIFEST_CACHE_SIZE = int(os.getenv("HISTORY_MANIFEST_CACHE_SIZE", "1024"))  # 每个工作区在内存中缓存的历史清单数
+HISTORY_GROUP_COMMIT_MS = float(os.getenv("HISTORY_GROUP_COMMIT_MS", "0"))  # 历史写入组提交的等待窗口（毫秒），0表示每次单独写入
+
+history_committer = GroupCommitter(HISTORY_GROUP_COMMIT_MS / 1000) if HISTORY_GROUP_COMMIT_MS > 0 else None
+
+def make_line_delta(base_lines, new_lines):
+    """
+    计算行级增量：["c", i1, i2] 表示复制基准版本的第i1到i2行，["i", 文本] 表示插入新内容
+    """
+    ops = []
+    matcher = difflib.SequenceMatcher(None, base_lines, new_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append(["c", i1, i2])
+        elif j2 > j1:
+            ops.append(["i", "".join(new_lines[j1:j2])])
+    return ops
+
+def apply_line_delta(base_lines, ops):
+    parts = []
+    for op in ops:
+        if op[0] == "c":
+            parts.extend(base_lines[op[1]:op[2]])
+        else:
+            parts.append(op[1])
+    return "".join(parts)
+
+class HistoryStore:
+    """
+    内容寻址的历史版本存储
+    - objects/ab/<sha256>     按哈希保存的完整快照或行级增量（可选zstd压缩），相同内容只保存一份
+    - manifests/<key>.json    每个文件（按完整相对路径）一个版本清单
+    保存和列出历史只需读写该文件自己的清单，与历史总量无关
+    版本以"快照 + 增量链"的形式保存，每HISTORY_SNAPSHOT_INTERVAL个版本至少有一个快照
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.store_dir = os.path.join(root, "history", HISTORY_STORE_DIR)
+        self.objects_dir = os.path.join(self.store_dir, "objects")
+        self.manifests_dir = os.path.join(self.store_dir, "manifests")
+        self._lock = threading.Lock()
+        self._path_locks = weakref.WeakValueDictionary()
+        self._manifests = collections.OrderedDict()  # key -> 清单（LRU内存缓存）
+        self._manifests_lock = threading.Lock()
+        self._refcounts = None    # 对象哈希 -> 引用次数，进程内首次保存时统计一次
+        self._latest_content = collections.OrderedDict()  # key -> (内容哈希, 最新版本内容)，用于计算增量
+        self._has_legacy = None
+        self._usage = None        # [对象数, 字节数]，首次查询时统计一次，之后增量维护
+        self._usage_lock = threading.Lock()
+
+    # 路径与键
+    @staticmethod
+    def normalize(rel_path):
+        return posixpath.normpath(normalize_path(rel_path)).strip("/")
+
+    @staticmethod
+    def manifest_key(rel_path):
+        return hashlib.sha1(HistoryStore.normalize(rel_path).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def history_path(key, version_id):
+        return f"history/{HISTORY_STORE_DIR}/{key}/{version_id}"
+
+    @staticmethod
+    def parse_history_path(history_path):
+        """把 history/.store/<key>/<id> 解析为 (key, id)，不是存储路径时返回None"""
+        parts = normalize_path(history_path).strip("/").split("/")
+        if len(parts) == 4 and parts[0] == "history" and parts[1] == HISTORY_STORE_DIR and parts[3].isdigit():
+            return parts[2], int(parts[3])
+        return None
+
+    @staticmethod
+    def version_name(rel_path, timestamp):
+        file_name_without_ext, file_ext = os.path.splitext(posixpath.basename(rel_path))
+        return f"{file_name_without_ext}_{timestamp}{file_ext}"
+
+    def _path_lock(self, key):
+        with self._lock:
+            lock = self._path_locks.get(key)
+            if lock is None:
+                lock = threading.Lock()
+                self._path_locks[key] = lock
+            return lock
+
+    # 内容对象
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def _write_object(self, digest, data, pending=None):
+        path = self._object_path(digest)
+        if os.path.exists(path) or os.path.exists(path + ".zst"):
+            return
+        if HISTORY_COMPRESSION == "zstd" and zstandard is not None:
+            data = zstandard.ZstdCompressor(level=3).compress(data)
+            path += ".zst"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write(path, data, pending)
+        self._track_usage(1, len(data))
+
+    def _read_object(self, digest):
+        path = self._object_path(digest)
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            with open(path + ".zst", 'rb') as f:
+                data = f.read()
+            if zstandard is None:
+                raise RuntimeError("读取压缩的历史版本需要安装zstandard")
+            return zstandard.ZstdDecompressor().decompress(data)
+
+    def _remove_object(self, digest):
+        path = self._object_path(digest)
+        for candidate in (path, path + ".zst"):
+            try:
+                size = os.path.getsize(candidate)
+                os.remove(candidate)
+                self._track_usage(-1, -size)
+            except FileNotFoundError:
+                pass
+
+    def _track_usage(self, objects, size):
+        with self._usage_lock:
+            if self._usage is not None:
+                self._usage[0] += objects
+                self._usage[1] += size
+
+    def usage(self):
+        """历史对象的数量和占用的字节数"""
+        with self._usage_lock:
+            if self._usage is None:
+                objects = size = 0
+                for dirpath, _, filenames in os.walk(self.objects_dir):
+                    for name in filenames:
+                        if name.endswith(".tmp"):
+                            continue
+                        try:
+                            size += os.path.getsize(os.path.join(dirpath, name))
+                            objects += 1
+                        except OSError:
+                            pass
+                self._usage = [objects, size]
+            return {"objects": self._usage[0], "bytes": self._usage[1]}
+
+    def memory_estimate(self):
+        """内存中缓存的清单和最新版本内容大约占用的字节数"""
+        with self._manifests_lock:
+            manifests = list(self._manifests.values())
+        with self._lock:
+            latest = sum(len(content) for _, content in list(self._latest_content.values()))
+        versions = sum(len(manifest.get("versions", ())) for manifest in manifests)
+        return len(manifests) * 512 + versions * 200 + latest
+
+    # 版本清单
+    def _manifest_path(self, key):
+        return os.path.join(self.manifests_dir, key + ".json")
+
+    def _cache_manifest(self, key, manifest):
+        with self._manifests_lock:
+            self._manifests[key] = manifest
+            self._manifests.move_to_end(key)
+            while len(self._manifests) > HISTORY_MANIFEST_CACHE_SIZE:
+                self._manifests.popitem(last=False)
+
+    def _forget_manifest(self, key):
+        with self._manifests_lock:
+            self._manifests.pop(key, None)
+
+    def _load_manifest(self, key, cache=True):
+        with self._manifests_lock:
+            manifest = self._manifests.get(key)
+            if manifest is not None:
+                self._manifests.move_to_end(key)
+                return manifest
+        try:
+            with open(self._manifest_path(key), 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        if cache:
+            self._cache_manifest(key, manifest)
+        return manifest
+
+    def _write_manifest(self, key, manifest, pending=None):
+        os.makedirs(self.manifests_dir, exist_ok=True)
+        atomic_write(self._manifest_path(key), json.dumps(manifest, ensure_ascii=False), pending)
+        if pending is None:
+            self._cache_manifest(key, manifest)
+
+    def _iter_manifests(self):
+        """遍历全部清单；不在缓存中的清单读出后不放入缓存，以免一次遍历挤掉常用的清单"""
+        try:
+            names = os.listdir(self.manifests_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.endswith(".json"):
+                manifest = self._load_manifest(name[:-5], cache=False)
+                if manifest:
+                    yield name[:-5], manifest
+
+    def _ensure_refcounts(self):
+        with self._lock:
+            if self._refcounts is not None:
+                return
+            refcounts = collections.Counter()
+            for _, manifest in self._iter_manifests():
+                for version in manifest["versions"]:
+                    refcounts[self._object_of(version)] += 1
+            self._refcounts = refcounts
+
+    def _add_ref(self, digest, delta):
+        with self._lock:
+            self._refcounts[digest] += delta
+            count = self._refcounts[digest]
+            if count <= 0:
+                del self._refcounts[digest]
+            return count
+
+    # 保留策略
+    def retention_for(self, rel_path):
+        """按配置 history_retention（{通配符: 数量}）确定文件保留的版本数"""
+        rules = get_config().get("history_retention") or {}
+        for pattern, limit in rules.items():
+            if fnmatch.fnmatch(rel_path, pattern):
+                return max(1, int(limit))
+        return max(1, HISTORY_LIMIT)
+
+    def _version_info(self, manifest, key, version):
+        return {
+            "original_path": manifest["path"],
+            "history_path": self.history_path(key, version["id"]),
+            "name": self.version_name(manifest["path"], version["timestamp"]),
+            "timestamp": version["timestamp"],
+            "version": version["id"]
+        }
+
+    # 版本内容（快照 + 增量）
+    @staticmethod
+    def _object_of(version):
+        # 早期版本记录没有object字段，内容对象即完整快照
+        return version.get("object", version["hash"])
+
+    def _content_of(self, key, manifest, version):
+        """还原某个版本的完整内容：从最近的快照开始依次应用增量"""
+        cached = self._latest_content.get(key)
+        if cached is not None and cached[0] == version["hash"]:
+            return cached[1]
+        by_id = {v["id"]: v for v in manifest["versions"]}
+        chain = [version]
+        while chain[-1].get("base") is not None:
+            chain.append(by_id[chain[-1]["base"]])
+        content = self._read_object(self._object_of(chain[-1])).decode("utf-8")
+        for item in reversed(chain[:-1]):
+            delta = json.loads(self._read_object(self._object_of(item)))
+            content = apply_line_delta(content.splitlines(keepends=True), delta)
+        return content
+
+    def _remember_latest(self, key, digest, content):
+        with self._lock:
+            self._latest_content[key] = (digest, content)
+            self._latest_content.move_to_end(key)
+            while len(self._latest_content) > 32:
+                self._latest_content.popitem(last=False)
+
+    # 对外接口
+    def save(self, rel_path, content):
+        """保存一个版本，内容与最新版本相同时不产生新版本"""
+        rel_path = self.normalize(rel_path)
+        key = self.manifest_key(rel_path)
+        data = content.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        self._ensure_refcounts()
+
+        with self._path_lock(key):
+            # 启用组提交时先写临时文件，最后与其他请求的写入一起同步和重命名
+            pending = [] if history_committer is not None else None
+            manifest = self._load_manifest(key) or {"path": rel_path, "next_id": 1, "versions": []}
+            versions = manifest["versions"]
+            if versions and versions[-1]["hash"] == digest:
+                return self._version_info(manifest, key, versions[-1])
+
+            version = {
+                "id": manifest["next_id"],
+                "hash": digest,
+                "timestamp": datetime.now().strftime("%Y%m%d_%H%M%S"),
+                "size": len(data)
+            }
+            # 相对上一版本保存行级增量，增量过大或链过长时保存完整快照
+            previous = versions[-1] if versions else None
+            if previous is not None and previous.get("depth", 0) + 1 < HISTORY_SNAPSHOT_INTERVAL:
+                base_content = self._content_of(key, manifest, previous)
+                new_lines = content.splitlines(keepends=True)
+                if len(new_lines) <= HISTORY_DELTA_MAX_LINES:
+                    delta = json.dumps(
+                        make_line_delta(base_content.splitlines(keepends=True), new_lines),
+                        ensure_ascii=False, separators=(",", ":")
+                    ).encode("utf-8")
+                    if len(delta) < len(data) // 2:
+                        object_digest = hashlib.sha256(delta).hexdigest()
+                        self._write_object(object_digest, delta, pending)
+                        version.update(object=object_digest, base=previous["id"], depth=previous.get("depth", 0) + 1)
+            if "object" not in version:
+                self._write_object(digest, data, pending)
+                version.update(object=digest, base=None, depth=0)
+            self._add_ref(version["object"], 1)
+
+            # 按保留策略淘汰旧版本，保留的最早版本若依赖被淘汰的版本则转为快照
+            all_versions = versions + [version]
+            limit = self.retention_for(rel_path)
+            expired = all_versions[:-limit]
+            kept = all_versions[-limit:]
+            released = [self._object_of(v) for v in expired]
+            if expired and kept[0].get("base") is not None:
+                oldest = kept[0]
+                oldest_content = self._content_of(key, {**manifest, "versions": all_versions}, oldest)
+                self._write_object(oldest["hash"], oldest_content.encode("utf-8"), pending)
+                self._add_ref(oldest["hash"], 1)
+                released.append(self._object_of(oldest))
+                kept[0] = {**oldest, "object": oldest["hash"], "base": None, "depth": 0}
+            manifest = {**manifest, "next_id": manifest["next_id"] + 1, "versions": kept}
+            self._write_manifest(key, manifest, pending)
+            if pending is not None:
+                history_committer.commit(pending)
+                self._cache_manifest(key, manifest)
+            self._remember_latest(key, digest, content)
+
+        for object_digest in released:
+            if self._add_ref(object_digest, -1) == 0:
+                self._remove_object(object_digest)
+        return self._version_info(manifest, key, version)
+
+    def list_versions(self, rel_path):
+        """列出文件的历史版本（新的在前）"""
+        key = self.manifest_key(rel_path)
+        manifest = self._load_manifest(key)
+        if not manifest:
+            return []
+        return [self._version_info(manifest, key, v) for v in reversed(manifest["versions"])]
+
+    def latest_versions(self):
+        """每个有历史的文件的最新版本（新的在前）"""
+        result = [
+            (manifest["versions"][-1]["timestamp"], self._version_info(manifest, key, manifest["versions"][-1]))
+            for key, manifest in self._iter_manifests()
+            if manifest["versions"]
+        ]
+        result.sort(key=lambda x: x[0], reverse=True)
+        return [info for _, info in result]
+
+    def move(self, source_path, target_path, is_dir=False):
+        """
+        文件或目录移动后把历史清单改为以新路径为键，返回迁移的文件数；
+        目录只需遍历一次清单，内容对象不变。目标已有历史时合并，源的版本排在后面并重新编号
+        """
+        source_path = self.normalize(source_path)
+        target_path = self.normalize(target_path)
+        if is_dir:
+            prefix = source_path + "/"
+            with self._lock:
+                manifests = list(self._iter_manifests())
+            keys = [(key, manifest["path"]) for key, manifest in manifests
+                    if manifest["path"] == source_path or manifest["path"].startswith(prefix)]
+        else:
+            keys = [(self.manifest_key(source_path), source_path)]
+
+        moved = 0
+        for key, old_path in keys:
+            new_path = target_path + old_path[len(source_path):]
+            new_key = self.manifest_key(new_path)
+            if new_key == key:
+                continue
+            # 两个键按固定顺序加锁，避免与并发的移动互相等待
+            first, second = sorted((key, new_key))
+            with self._path_lock(first), self._path_lock(second):
+                manifest = self._load_manifest(key)
+                if not manifest:
+                    continue
+                existing = self._load_manifest(new_key)
+                if existing and existing["versions"]:
+                    merged = self._merge_manifests(existing, manifest)
+                else:
+                    merged = {**manifest, "path": new_path}
+                self._write_manifest(new_key, merged)
+                try:
+                    os.remove(self._manifest_path(key))
+                except FileNotFoundError:
+                    pass
+                self._forget_manifest(key)
+                with self._lock:
+                    latest = self._latest_content.pop(key, None)
+                    self._latest_content.pop(new_key, None)
+                    if latest is not None and merged["versions"][-1]["hash"] == latest[0]:
+                        self._latest_content[new_key] = latest
+            moved += 1
+        return moved
+
+    @staticmethod
+    def _merge_manifests(existing, manifest):
+        """把manifest的版本接在existing之后，版本号（及增量的base）顺延"""
+        offset = existing["next_id"] - min(v["id"] for v in manifest["versions"]) if manifest["versions"] else 0
+        versions = list(existing["versions"])
+        for version in manifest["versions"]:
+            version = {**version, "id": version["id"] + offset}
+            if version.get("base") is not None:
+                version["base"] += offset
+            versions.append(version)
+        next_id = versions[-1]["id"] + 1 if versions else existing["next_id"]
+        return {**existing, "next_id": max(next_id, existing["next_id"]), "versions": versions}
+
+    def read(self, key, version_id):
+        """读取指定版本，返回 (内容, 版本信息)"""
+        manifest = self._load_manifest(key)
+        if manifest:
+            for version in manifest["versions"]:
+                if version["id"] == version_id:
+                    return self._content_of(key, manifest, version), self._version_info(manifest, key, version)
+        raise FileNotFoundError(f"历史版本不存在：{key}/{version_id}")
+
+    def read_version(self, rel_path, version_id):
+        return self.read(self.manifest_key(rel_path), version_id)
+
+    def has_legacy_files(self):
+        """旧版本直接保存在history目录下的历史文件（只检查一次）"""
+        if self._has_legacy is None:
+            try:
+                with os.scandir(os.path.join(self.root, "history")) as it:
+                    self._has_legacy = any(e.is_file() and e.name.endswith(('.yaml', '.yml')) for e in it)
+            except OSError:
+                self._has_legacy = False
+        return self._has_legacy
+
+history_store = WorkspaceLocal("history")
+
+# 保存历史文件
+def save_history_file(file_path, content):
+    try:
+        return history_store.save(file_path, content)
+    except Exception as e:
+        print(f"保存历史文件失败: {e}")
+        return None
+
+def _parse_legacy_history_name(file):
+    """解析旧格式的历史文件名 <原文件名>_<日期>_<时间>.<扩展名>"""
+    parts = os.path.splitext(file)[0].split('_')
+    timestamp_str = parts[-2] + "_" + parts[-1] if len(parts) >= 2 else ""
+    original_name = "_".join(parts[:-2]) if len(parts) >= 2 else file
+    return original_name, timestamp_str
+
+def _get_legacy_history_files(file_path=None):
+    """旧格式历史文件（保存在history目录下的完整副本），只读兼容"""
+    if not history_store.has_legacy_files():
+        return []
+    sys_history_dir = system_path(get_history_dir())
+    files = [f for f in os.listdir(sys_history_dir) if f.endswith(('.yaml', '.yml'))]
+    if file_path:
+        file_name_without_ext = os.path.splitext(os.path.basename(file_path))[0]
+        files = [f for f in files if f.startswith(file_name_without_ext + "_")]
+    files.sort(key=lambda x: os.path.getmtime(os.path.join(sys_history_dir, x)), reverse=True)
+    
+    result = []
+    seen_files = set()
+    for file in files:
+        original_name, timestamp_str = _parse_legacy_history_name(file)
+        # 如果没有指定文件路径，对每个原始文件只保留最新的一个版本
+        if not file_path:
+            if original_name in seen_files:
+                continue
+            seen_files.add(original_name)
+        result.append(HistoryFileInfo(
+            original_path=original_name,
+            history_path=normalize_path(os.path.join("history", file)),
+            name=file,
+            timestamp=timestamp_str
+        ))
+    return result
+
+# 获取历史文件列表
+def get_history_files(file_path=None):
+    """
+    获取历史文件列表
+    如果指定了file_path，则只返回该文件的历史版本
+    否则返回所有文件的最新历史版本
+    """
+    try:
+        if file_path:
+            versions = history_store.list_versions(file_path)
+        else:
+            versions = history_store.latest_versions()
+        history_files = [HistoryFileInfo(**version) for version in versions]
+        return history_files + _get_legacy_history_files(file_path)
+    except Exception as e:
+        print(f"获取历史文件列表失败: {e}")
+        return []
+
+# 设置工作目录
+@app.post("/api/config/workspace")
+async def set_workspace_dir(config: DirectoryConfig, token: dict = Depends(verify_token)):
+    """设置当前工作区的目录，之后的请求使用新目录（索引重新加载）"""
+    try:
+        # 绑定了工作区的登录不能把工作区指向别的目录
+        require_unbound(token)
+        
+        # 规范化路径
+        workspace_dir = normalize_path(config.path)
+        
+        # 验证目录是否存在
+        if not os.path.isdir(system_path(workspace_dir)):
+            raise HTTPException(status_code=400, detail=f"目录不存在: {workspace_dir}")
+        
+        # 更新配置
+        name = current_workspace().name
+        if name == DEFAULT_WORKSPACE:
+            await io_pool.run(config_store.update, workspace_dir=workspace_dir)
+        else:
+            def apply(config):
+                defined = dict(config.get("workspaces") or {})
+                defined[name] = workspace_dir
+                config["workspaces"] = defined
+
+            await io_pool.run(config_store.modify, apply)
+        workspaces.get(name)
+        
+        return {"message": "工作目录设置成功", "workspace": name, "path": workspace_dir}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 获取当前工作目录
+@app.get("/api/config/workspace")
+async def get_current_workspace(token: dict = Depends(verify_token)):
+    """获取当前工作区的名称和目录"""
+    workspace = current_workspace()
+    return {"workspace": workspace.name, "path": workspace.path}
+
+# Mihomo连接池
+MIHOMO_MAX_CONNECTIONS = int(os.getenv("MIHOMO_MAX_CONNECTIONS", "100"))  # 最大连接数
+MIHOMO_MAX_KEEPALIVE = int(os.getenv("MIHOMO_MAX_KEEPALIVE", "20"))  # 最大空闲保活连接数
+MIHOMO_KEEPALIVE_EXPIRY = float(os.getenv("MIHOMO_KEEPALIVE_EXPIRY", "30"))  # 空闲连接保活时间（秒）
+MIHOMO_TIMEOUT = float(os.getenv("MIHOMO_TIMEOUT", "10"))  # 读写超时（秒）
+MIHOMO_CONNECT_TIMEOUT = float(os.getenv("MIHOMO_CONNECT_TIMEOUT", "5"))  # 连接超时（秒）
+MIHOMO_HTTP2 = os.getenv("MIHOMO_HTTP2", "false").lower() == "true"  # 启用HTTP/2（需安装h2）
+MIHOMO_MAX_STREAMS = int(os.getenv("MIHOMO_MAX_STREAMS", "64"))  # 同时转发的流（HTTP响应和WebSocket）上限
+
+def parse_mihomo_host(mihomo_address):
+    """从Mihomo地址中解析出 host:port"""
+    if not mihomo_address.startswith(('http://', 'https://')):
+        mihomo_address = f"http://{mihomo_address}"
+    return urlparse(mihomo_address).netloc
+
+class MihomoClient:
+    """
+    长连接复用的Mihomo HTTP客户端，应用启动时创建、关闭时释放，
+    只有Mihomo地址变化时才重建连接池
+    """
+
+    def __init__(self):
+        self._client = None
+        self._address = None
+        self.in_flight = 0
+        self.requests = 0
+        self.rejected = 0
+        self.rebuilds = 0
+
+    @property
+    def address(self):
+        return get_config().get("mihomo_address") or None
+
+    def _build(self, host):
+        kwargs = dict(
+            base_url=f"http://{host}",
+            limits=httpx.Limits(
+                max_connections=MIHOMO_MAX_CONNECTIONS,
+                max_keepalive_connections=MIHOMO_MAX_KEEPALIVE,
+                keepalive_expiry=MIHOMO_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(MIHOMO_TIMEOUT, connect=MIHOMO_CONNECT_TIMEOUT)
+        )
+        try:
+            return httpx.AsyncClient(http2=MIHOMO_HTTP2, **kwargs)
+        except ImportError:
+            print("未安装h2，Mihomo代理使用HTTP/1.1")
+            return httpx.AsyncClient(**kwargs)
+
+    def get(self):
+        """返回 (client, host)，地址未配置时返回 (None, None)"""
+        address = self.address
+        if address != self._address:
+            # 地址变化（包括配置文件被外部修改）时关闭旧连接池
+            old_client, self._client = self._client, None
+            if old_client is not None:
+                asyncio.ensure_future(old_client.aclose())
+            self._address = address
+        if not address:
+            return None, None
+        host = parse_mihomo_host(address)
+        if self._client is None:
+            self._client = self._build(host)
+            self.rebuilds += 1
+        return self._client, host
+
+    def open_stream(self):
+        """占用一个转发名额（HTTP响应或WebSocket），达到MIHOMO_MAX_STREAMS时返回False"""
+        if self.in_flight >= MIHOMO_MAX_STREAMS:
+            self.rejected += 1
+            return False
+        self.in_flight += 1
+        self.requests += 1
+        return True
+
+    def close_stream(self):
+        self.in_flight -= 1
+
+    async def close(self):
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
+
+    def stats(self):
+        return {
+            "address": self._address,
+            "connected": self._client is not None,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "rejected": self.rejected,
+            "rebuilds": self.rebuilds,
+            "max_connections": MIHOMO_MAX_CONNECTIONS,
+            "max_keepalive": MIHOMO_MAX_KEEPALIVE,
+            "http2": MIHOMO_HTTP2
+        }
+
+mihomo_client = MihomoClient()
+
+@app.on_event("startup")
+async def start_mihomo_client():
+    mihomo_client.get()
+
+@app.on_event("shutdown")
+async def stop_mihomo_client():
+    await mihomo_client.close()
+
+@app.post("/api/config/mihomo")
+async def set_mihomo_address(config: MihomoConfig, token: dict = Depends(verify_token)):
+    """设置Mihomo地址"""
+    try:
+        await io_pool.run(config_store.update, mihomo_address=config.address)
+        mihomo_client.get()
+        
+        return {"message": "Mihomo地址设置成功", "address": config.address}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/config/mihomo")
+async def get_mihomo_address(token: dict = Depends(verify_token)):
+    """获取Mihomo地址"""
+    return {"address": mihomo_client.address or ""}
+
+# Mihomo代理
+MIHOMO_STREAM_PATHS = {p.strip("/ ") for p in os.getenv("MIHOMO_STREAM_PATHS", "traffic,logs,memory,connections").split(",")}  # 长连接推送接口，不设读超时
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade"
+}
+
+def proxy_request_headers(headers, host):
+    result = {
+        key: value for key, value in headers.items()
+        if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() not in ('host', 'authorization', 'cookie')
+    }
+    result['Host'] = host
+    return result
+
+@app.api_route("/api/mihomo/proxy/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
+async def mihomo_proxy(path: str, request: Request):
+    """代理Mihomo API请求，请求体和响应体都以流的方式转发"""
+    authenticate(request, prefer_cookie=True)
+    client, host = mihomo_client.get()
+
+    if client is None:
+        raise HTTPException(status_code=400, detail="Mihomo地址未配置")
+
+    if not mihomo_client.open_stream():
+        raise HTTPException(status_code=503, detail="Mihomo代理连接数已达上限，请稍后重试")
+
+    timeout = httpx.USE_CLIENT_DEFAULT
+    if path.strip("/").split("/")[0] in MIHOMO_STREAM_PATHS:
+        timeout = httpx.Timeout(MIHOMO_TIMEOUT, connect=MIHOMO_CONNECT_TIMEOUT, read=None)
+    
+    started = time.perf_counter()
+    try:
+        has_body = request.method in ("POST", "PUT", "PATCH")
+        upstream_request = client.build_request(
+            request.method,
+            f"/{path}",
+            headers=proxy_request_headers(request.headers, host),
+            params=request.query_params,
+            content=request.stream() if has_body else None,
+            timeout=timeout
+        )
+        response = await client.send(upstream_request, stream=True)
+        mihomo_upstream_seconds.observe(time.perf_counter() - started, str(response.status_code))
+    except httpx.RequestError as e:
+        mihomo_client.close_stream()
+        mihomo_upstream_seconds.observe(time.perf_counter() - started, "error")
+        raise HTTPException(status_code=500, detail=f"请求Mihomo API失败: {e}")
+    except BaseException:
+        mihomo_client.close_stream()
+        raise
+
+    async def close_upstream():
+        mihomo_client.close_stream()
+        await response.aclose()
+
+    # 原样转发未解码的字节，发送端等待客户端消费后再读取上游，形成背压
+    headers = {key: value for key, value in response.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS}
+    return StreamingResponse(
+        response.aiter_raw(),
+        status_code=response.status_code,
+        headers=headers,
+        background=BackgroundTask(close_upstream)
+    )
+
+@app.websocket("/api/mihomo/proxy/{path:path}")
+async def mihomo_proxy_websocket(websocket: WebSocket, path: str):
+    """转发Mihomo的WebSocket接口（traffic、logs、connections等）"""
+    # token查询参数属于Mihomo自己的密钥，原样转发给上游，这里只认会话Cookie和请求头
+    try:
+        authenticate(websocket, prefer_cookie=True)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+    client, host = mihomo_client.get()
+    if client is None or websockets is None:
+        await websocket.close(code=1011)
+        return
+    if not mihomo_client.open_stream():
+        await websocket.close(code=1013)
+        return
+
+    try:
+        query = websocket.url.query
+        uri = f"ws://{host}/{path}" + (f"?{query}" if query else "")
+        headers = [
+            (key, value) for key, value in websocket.headers.items()
+            if key.lower() not in HOP_BY_HOP_HEADERS
+            and key.lower() not in ('host', 'authorization', 'origin', 'cookie')
+            and not key.lower().startswith('sec-websocket')
+        ]
+        connect_kwargs = {"open_timeout": MIHOMO_CONNECT_TIMEOUT, "max_size": None}
+        try:
+            try:
+                upstream = await websockets.connect(uri, additional_headers=headers, **connect_kwargs)
+            except TypeError:
+                # websockets旧版本参数名为extra_headers
+                upstream = await websockets.connect(uri, extra_headers=headers, **connect_kwargs)
+        except Exception as e:
+            print(f"连接Mihomo WebSocket失败: {e}")
+            await websocket.close(code=1011)
+            return
+
+        await websocket.accept()
+
+        async def client_to_upstream():
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("text") is not None:
+                    await upstream.send(message["text"])
+                elif message.get("bytes") is not None:
+                    await upstream.send(message["bytes"])
+
+        async def upstream_to_client():
+            async for message in upstream:
+                if isinstance(message, str):
+                    await websocket.send_text(message)
+                else:
+                    await websocket.send_bytes(message)
+
+        # 任意一端结束即关闭另一端；每条消息发送完成后才读取下一条，形成背压
+        tasks = [asyncio.ensure_future(client_to_upstream()), asyncio.ensure_future(upstream_to_client())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await upstream.close()
+            try:
+                await websocket.close()
+            except RuntimeError:
+                pass
+    finally:
+        mihomo_client.close_stream()
+
+# 工作区目录树索引
+TREE_WATCH_MODE = os.getenv("TREE_WATCH_MODE", "auto").lower()  # auto / watchdog / poll / off
+TREE_POLL_INTERVAL = float(os.getenv("TREE_POLL_INTERVAL", "2"))  # 轮询间隔（秒）
+
+class WorkspaceTreeIndex:
+    """
+    常驻内存的工作区目录树索引
+    启动时完整扫描一次，之后由文件系统监听（或轮询）以及应用自身的写操作增量更新，
+    文件树的JSON结果按版本缓存，请求时直接返回
+    """
+
+    def __init__(self, root, ignored=()):
+        self.root = root
+        self.ignored = frozenset(ignored)  # 不纳入索引的相对路径（如历史版本存储目录）
+        self._lock = threading.RLock()
+        self._dirs = {}     # 相对目录路径 -> {名称: 是否目录}，只记录目录和YAML文件
+        self._mtimes = {}   # 相对目录路径 -> 目录mtime，用于轮询检测变化
+        self._ready = False
+        self._dirty = True
+        self._body = b"[]"
+        self._etag = ""
+        self._observer = None
+        self._poll_thread = None
+        self._stop_event = threading.Event()
+        self._listeners = []
+        self._listings = collections.OrderedDict()  # 相对目录路径 -> (来源, 排序键列表, 排序后的子项)，供分页列目录使用
+
+    def add_listener(self, callback):
+        """
+        注册变化监听器，callback(event_type, rel_path, is_dir)
+        event_type 为 created / deleted / modified，在索引锁内同步调用，回调应尽快返回
+        """
+        self._listeners.append(callback)
+
+    def _emit(self, event_type, rel_path, is_dir):
+        if not self._ready:
+            return
+        for callback in self._listeners:
+            try:
+                callback(event_type, rel_path, is_dir)
+            except Exception as e:
+                print(f"目录树变化通知失败: {e}")
+
+    @property
+    def ready(self):
+        return self._ready and not self._dirty
+
+    def _abs(self, rel_path):
+        return os.path.join(self.root, system_path(rel_path)) if rel_path else self.root
+
+    def _drop_subtree(self, rel_dir):
+        prefix = rel_dir + "/"
+        for key in [k for k in self._dirs if k == rel_dir or k.startswith(prefix)]:
+            self._dirs.pop(key, None)
+            self._mtimes.pop(key, None)
+        self._emit("deleted", rel_dir, True)
+
+    def _read_dir(self, rel_dir):
+        """扫描一层目录，返回 (目录mtime, {名称: 是否目录})；使用scandir自带的类型信息，不额外stat"""
+        abs_dir = self._abs(rel_dir)
+        mtime = os.stat(abs_dir).st_mtime_ns
+        entries = {}
+        with os.scandir(abs_dir) as it:
+            for entry in it:
+                if self.ignored and self._child(rel_dir, entry.name) in self.ignored:
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+                if is_dir:
+                    entries[entry.name] = True
+                elif entry.name.endswith(('.yaml', '.yml')):
+                    entries[entry.name] = False
+        return mtime, entries
+
+    def _rescan(self, rel_dir, recursive):
+        try:
+            mtime, entries = self._read_dir(rel_dir)
+        except OSError:
+            # 目录已不存在
+            if rel_dir in self._dirs:
+                self._drop_subtree(rel_dir)
+                self._dirty = True
+            return
+
+        old_entries = self._dirs.get(rel_dir)
+        if old_entries != entries:
+            self._dirty = True
+            old_entries = old_entries or {}
+            for name, is_dir in old_entries.items():
+                if entries.get(name) is is_dir:
+                    continue
+                if is_dir:
+                    self._drop_subtree(self._child(rel_dir, name))
+                else:
+                    self._emit("deleted", self._child(rel_dir, name), False)
+            for name, is_dir in entries.items():
+                if old_entries.get(name) is not is_dir:
+                    self._emit("created", self._child(rel_dir, name), is_dir)
+        self._dirs[rel_dir] = entries
+        self._mtimes[rel_dir] = mtime
+
+        for name, is_dir in entries.items():
+            child = self._child(rel_dir, name)
+            if is_dir and (recursive or child not in self._dirs):
+                self._rescan(child, recursive)
+
+    @staticmethod
+    def _child(rel_dir, name):
+        return f"{rel_dir}/{name}" if rel_dir else name
+
+    def is_ignored(self, rel_path):
+        return any(rel_path == p or rel_path.startswith(p + "/") for p in self.ignored)
+
+    def build(self):
+        """完整扫描工作区，建立索引"""
+        started = time.perf_counter()
+        with self._lock:
+            self._dirs.clear()
+            self._mtimes.clear()
+            self._rescan("", recursive=True)
+            self._ready = True
+            self._dirty = True
+        tree_scan_seconds.observe(time.perf_counter() - started, "full")
+
+    def ensure_built(self):
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    self.build()
+
+    def refresh(self, rel_path):
+        """
+        路径发生变化后增量刷新索引：重新扫描其父目录，若路径本身是目录则递归扫描
+        """
+        rel_path = posixpath.normpath(normalize_path(rel_path)).strip("/")
+        if rel_path == ".":
+            rel_path = ""
+        if self.is_ignored(rel_path):
+            return
+        started = time.perf_counter()
+        with self._lock:
+            if not self._ready:
+                return
+            was_file = self.is_file(rel_path)
+            parent = posixpath.dirname(rel_path)
+            while parent and parent not in self._dirs:
+                parent = posixpath.dirname(parent)
+            self._rescan(parent, recursive=False)
+            if rel_path and os.path.isdir(self._abs(rel_path)):
+                self._rescan(rel_path, recursive=True)
+            elif was_file and self.is_file(rel_path):
+                # 已存在的文件被覆盖写入，目录结构不变但内容变化
+                self._emit("modified", rel_path, False)
+        tree_scan_seconds.observe(time.perf_counter() - started, "refresh")
+
+    def move(self, source_path, target_path):
+        """
+        移动完成后一次性改写索引：把源路径下的目录条目整体改挂到目标路径，不重新扫描磁盘，
+        监听者收到源路径的deleted和目标路径的created事件；无法直接改写时退回refresh
+        """
+        source_path = HistoryStore.normalize(source_path)
+        target_path = HistoryStore.normalize(target_path)
+        with self._lock:
+            if not self._ready:
+                return
+            src_parent, src_name = posixpath.split(source_path)
+            dst_parent, dst_name = posixpath.split(target_path)
+            is_dir = self._dirs.get(src_parent, {}).get(src_name)
+            if (
+                is_dir is None or dst_parent not in self._dirs or self._dirs[dst_parent].get(dst_name) is True
+                or self.is_ignored(source_path) or self.is_ignored(target_path)
+            ):
+                self.refresh(source_path)
+                self.refresh(target_path)
+                return
+            # 目录内容只整体替换（list_dir的缓存依赖这一点）
+            entries = dict(self._dirs[src_parent])
+            del entries[src_name]
+            self._dirs[src_parent] = entries
+            if is_dir:
+                prefix = source_path + "/"
+                moved = [key for key in self._dirs if key == source_path or key.startswith(prefix)]
+                for key in moved:
+                    new_key = target_path + key[len(source_path):]
+                    self._dirs[new_key] = self._dirs.pop(key)
+                    if key in self._mtimes:
+                        self._mtimes[new_key] = self._mtimes.pop(key)
+            self._emit("deleted", source_path, is_dir)
+            if is_dir or dst_name.endswith(('.yaml', '.yml')):
+                entries = dict(self._dirs[dst_parent])
+                entries[dst_name] = is_dir
+                self._dirs[dst_parent] = entries
+                self._emit("created", target_path, is_dir)
+            self._dirty = True
+
+    def notify_modified(self, rel_path):
+        """文件内容变化（由文件监听触发）"""
+        rel_path = posixpath.normpath(normalize_path(rel_path)).strip("/")
+        if self.is_ignored(rel_path):
+            return
+        with self._lock:
+            if self.is_file(rel_path):
+                self._emit("modified", rel_path, False)
+
+    def is_file(self, rel_path):
+        parent, name = posixpath.split(rel_path)
+        return self._dirs.get(parent, {}).get(name) is False
+
+    def is_dir(self, rel_path):
+        return rel_path == "" or rel_path in self._dirs
+
+    def iter_files(self, rel_dir=""):
+        """列出目录（默认整个工作区）下所有已索引的YAML文件的相对路径"""
+        with self._lock:
+            prefix = rel_dir + "/" if rel_dir else ""
+            return [
+                self._child(d, name)
+                for d, entries in self._dirs.items()
+                if d == rel_dir or not rel_dir or d.startswith(prefix)
+                for name, is_dir in entries.items()
+                if not is_dir
+            ]
+
+    def _build_nodes(self, rel_dir):
+        result = []
+        for name, is_dir in self._dirs.get(rel_dir, {}).items():
+            child = self._child(rel_dir, name)
+            result.append({
+                "path": child,
+                "name": name,
+                "isDirectory": is_dir,
+                "children": self._build_nodes(child) if is_dir else None
+            })
+        # 排序：目录在前，文件在后，按名称排序
+        result.sort(key=lambda x: (not x["isDirectory"], x["name"].lower()))
+        return result
+
+    def list_dir(self, rel_dir):
+        """
+        返回一层目录按（目录在前，名称）排序的 (排序键列表, [(名称, 是否目录)])
+        索引已建立时直接使用内存中的目录内容，否则只用scandir读取这一层；目录不存在时抛出FileNotFoundError
+        """
+        if self.is_ignored(rel_dir):
+            raise FileNotFoundError(rel_dir)
+        with self._lock:
+            entries = self._dirs.get(rel_dir) if self._ready else None
+        if entries is not None:
+            source = entries
+        else:
+            abs_dir = self._abs(rel_dir)
+            if not os.path.isdir(abs_dir):
+                raise FileNotFoundError(rel_dir)
+            source = os.stat(abs_dir).st_mtime_ns
+
+        with self._lock:
+            cached = self._listings.get(rel_dir)
+            # 索引中的目录内容只会整体替换，同一个对象即内容未变；直接扫描时按mtime判断
+            if cached is not None and (cached[0] is source or (isinstance(source, int) and cached[0] == source)):
+                self._listings.move_to_end(rel_dir)
+                return cached[1], cached[2]
+        if entries is None:
+            source, entries = self._read_dir(rel_dir)
+        items = sorted(entries.items(), key=lambda item: (not item[1], item[0].lower(), item[0]))
+        keys = [(not is_dir, name.lower(), name) for name, is_dir in items]
+        with self._lock:
+            self._listings[rel_dir] = (source, keys, items)
+            while len(self._listings) > 256:
+                self._listings.popitem(last=False)
+        return keys, items
+
+    def child_count(self, rel_dir):
+        """子目录中的目录和YAML文件数量，无法读取时返回None"""
+        with self._lock:
+            entries = self._dirs.get(rel_dir) if self._ready else None
+        if entries is not None:
+            return len(entries)
+        try:
+            return len(self.list_dir(rel_dir)[1])
+        except OSError:
+            return None
+
+    def snapshot(self):
+        """返回 (etag, JSON字节) ，索引未变化时直接复用缓存"""
+        self.ensure_built()
+        with self._lock:
+            if self._dirty:
+                self._body = json.dumps(
+                    self._build_nodes(""), ensure_ascii=False, separators=(",", ":")
+                ).encode("utf-8")
+                self._etag = '"' + hashlib.sha1(self._body).hexdigest() + '"'
+                self._dirty = False
+            return self._etag, self._body
+
+    def poll_once(self):
+        """检查已索引目录的mtime，重新扫描发生变化的目录"""
+        started = time.perf_counter()
+        with self._lock:
+            known = list(self._mtimes.items())
+        for rel_dir, mtime in known:
+            try:
+                current = os.stat(self._abs(rel_dir)).st_mtime_ns
+            except OSError:
+                current = None
+            if current != mtime:
+                with self._lock:
+                    self._rescan(rel_dir, recursive=False)
+        tree_scan_seconds.observe(time.perf_counter() - started, "poll")
+
+    def _poll_loop(self):
+        while not self._stop_event.wait(TREE_POLL_INTERVAL):
+            try:
+                self.poll_once()
+            except Exception as e:
+                print(f"轮询目录变化失败: {e}")
+
+    def start(self, mode=TREE_WATCH_MODE):
+        """构建索引并启动文件系统监听，watchdog不可用时退回轮询"""
+        self.ensure_built()
+        if mode == "off":
+            return
+        if mode in ("auto", "watchdog") and Observer is not None:
+            try:
+                observer = Observer()
+                observer.schedule(_TreeWatchHandler(self), self.root, recursive=True)
+                observer.daemon = True
+                observer.start()
+                self._observer = observer
+                return
+            except Exception as e:
+                print(f"启动文件监听失败，改用轮询: {e}")
+        self._stop_event.clear()
+        self._poll_thread = threading.Thread(target=self._poll_loop, name="tree-index-poll", daemon=True)
+        self._poll_thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join(timeout=5)
+            self._observer = None
+        if self._poll_thread is not None:
+            self._poll_thread.join(timeout=5)
+            self._poll_thread = None
+
+    def memory_estimate(self):
+        """索引和缓存的JSON结果大约占用的字节数"""
+        with self._lock:
+            entries = sum(len(children) for children in self._dirs.values())
+            listed = sum(len(listing[1]) for listing in self._listings.values())
+            return (entries + len(self._dirs)) * 160 + listed * 240 + len(self._body)
+
+class _TreeWatchHandler(FileSystemEventHandler):
+    """把watchdog事件转换为目录树索引的增量刷新"""
+
+    def __init__(self, index):
+        super().__init__()
+        self.index = index
+
+    def on_any_event(self, event):
+        if event.event_type in ("opened", "closed_no_write"):
+            return
+        # 文件内容修改不影响目录树，只通知监听者
+        if event.event_type in ("modified", "closed") and not event.is_directory:
+            rel_path = os.path.relpath(os.fsdecode(event.src_path), self.index.root)
+            if not rel_path.startswith(os.pardir):
+                self.index.notify_modified(rel_path)
+            return
+        for path in (event.src_path, getattr(event, "dest_path", "")):
+            if not path:
+                continue
+            rel_path = os.path.relpath(os.fsdecode(path), self.index.root)
+            if rel_path == os.curdir or rel_path.startswith(os.pardir):
+                continue
+            self.index.refresh(rel_path)
+
+tree_index = WorkspaceLocal("tree")
+
+# 工作区搜索索引
+SEARCH_INDEX_CONTENT = os.getenv("SEARCH_INDEX_CONTENT", "true").lower() == "true"  # 是否索引文件内容
+SEARCH_MAX_CONTENT_BYTES = int(os.getenv("SEARCH_MAX_CONTENT_BYTES", str(2 * 1024 * 1024)))  # 超过此大小的文件只索引路径
+SEARCH_VERIFY_INTERVAL = float(os.getenv("SEARCH_VERIFY_INTERVAL", "30"))  # 轮询模式下检查文件内容变化的间隔（秒）
+SEARCH_DEFAULT_LIMIT = 500
+SEARCH_MAX_LIMIT = 5000
+SEARCH_MAX_KEY_VALUES = 2000  # 每个文件最多记录的键路径取值数量
+SEARCH_MIN_CONTENT_QUERY = 3  # 内容搜索的最短关键词（trigram长度），更短的关键词无法用倒排表缩小范围，需要逐个读取文件
+
+YAMLLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)  # 优先使用libyaml加速
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def flatten_key_paths(data, prefix="", result=None, depth=0):
+    """
+    把YAML文档展开为 键路径 -> 标量值列表，列表下标统一记为[*]
+    例如 proxies[*].name -> ["HK-01", "JP-01"]
+    """
+    if result is None:
+        result = {}
+    if depth > 32:
+        return result
+    if isinstance(data, dict):
+        for key, value in data.items():
+            path = f"{prefix}.{key}" if prefix else str(key)
+            result.setdefault(path, [])
+            flatten_key_paths(value, path, result, depth + 1)
+    elif isinstance(data, list):
+        path = f"{prefix}[*]"
+        result.setdefault(path, [])
+        for item in data:
+            flatten_key_paths(item, path, result, depth + 1)
+    elif prefix and data is not None:
+        values = result.setdefault(prefix, [])
+        if len(values) < SEARCH_MAX_KEY_VALUES:
+            values.append(str(data))
+    return result
+
+class _SearchEntry:
+    __slots__ = ("mtime", "size", "trigrams", "keys")
+
+    def __init__(self, mtime, size, trigrams, keys):
+        self.mtime = mtime
+        self.size = size
+        self.trigrams = trigrams
+        self.keys = keys
+
+class WorkspaceSearchIndex:
+    """
+    基于三元组(trigram)倒排索引的文件搜索
+    索引文件路径、文件内容以及YAML键路径，随目录树索引的变化事件增量更新
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.root = tree.root
+        self._lock = threading.RLock()
+        self._paths = {}           # 相对路径 -> 小写路径
+        self._path_grams = {}      # trigram -> {相对路径}
+        self._entries = {}         # 相对路径 -> _SearchEntry
+        self._content_grams = {}   # trigram -> {相对路径}
+        self._key_files = {}       # 键路径 -> {相对路径}
+        self._queue = queue.Queue()
+        self._worker = None
+        self._verify_thread = None
+        self._stop_event = threading.Event()
+        self.paths_ready = False
+        self.content_ready = False
+        tree.add_listener(self._on_tree_event)
+
+    def _on_tree_event(self, event_type, rel_path, is_dir):
+        self._queue.put((event_type, rel_path, is_dir))
+
+    # 路径索引
+    def _add_path(self, rel_path):
+        if rel_path in self._paths:
+            return
+        lower = rel_path.lower()
+        self._paths[rel_path] = lower
+        for gram in _trigrams(lower):
+            self._path_grams.setdefault(gram, set()).add(rel_path)
+
+    def _remove_path(self, rel_path):
+        lower = self._paths.pop(rel_path, None)
+        if lower is None:
+            return
+        for gram in _trigrams(lower):
+            bucket = self._path_grams.get(gram)
+            if bucket is not None:
+                bucket.discard(rel_path)
+                if not bucket:
+                    del self._path_grams[gram]
+        self._remove_content(rel_path)
+
+    # 内容索引
+    def _remove_content(self, rel_path):
+        entry = self._entries.pop(rel_path, None)
+        if entry is None:
+            return
+        for gram in entry.trigrams:
+            bucket = self._content_grams.get(gram)
+            if bucket is not None:
+                bucket.discard(rel_path)
+                if not bucket:
+                    del self._content_grams[gram]
+        for key in entry.keys:
+            bucket = self._key_files.get(key)
+            if bucket is not None:
+                bucket.discard(rel_path)
+                if not bucket:
+                    del self._key_files[key]
+
+    def _index_content(self, rel_path):
+        """读取并索引单个文件内容，文件未变化时跳过"""
+        abs_path = os.path.join(self.root, system_path(rel_path))
+        try:
+            st = os.stat(abs_path)
+        except OSError:
+            return
+        entry = self._entries.get(rel_path)
+        if entry is not None and entry.mtime == st.st_mtime_ns and entry.size == st.st_size:
+            return
+
+        trigrams = frozenset()
+        keys = {}
+        if st.st_size <= SEARCH_MAX_CONTENT_BYTES:
+            try:
+                with open(abs_path, 'r', encoding='utf-8') as f:
+                    text = f.read()
+                trigrams = frozenset(_trigrams(text.lower()))
+                keys = flatten_key_paths(yaml.load(text, Loader=YAMLLoader))
+            except (OSError, UnicodeDecodeError, yaml.YAMLError, ValueError):
+                pass
+
+        with self._lock:
+            if rel_path not in self._paths:
+                return
+            self._remove_content(rel_path)
+            self._entries[rel_path] = _SearchEntry(st.st_mtime_ns, st.st_size, trigrams, keys)
+            for gram in trigrams:
+                self._content_grams.setdefault(gram, set()).add(rel_path)
+            for key in keys:
+                self._key_files.setdefault(key, set()).add(rel_path)
+
+    def _handle_event(self, event_type, rel_path, is_dir):
+        if is_dir:
+            if event_type == "deleted":
+                prefix = rel_path + "/"
+                with self._lock:
+                    for path in [p for p in self._paths if p.startswith(prefix)]:
+                        self._remove_path(path)
+            elif event_type == "created":
+                for path in self.tree.iter_files(rel_path):
+                    with self._lock:
+                        self._add_path(path)
+                    if SEARCH_INDEX_CONTENT:
+                        self._index_content(path)
+            return
+        if event_type == "deleted":
+            with self._lock:
+                self._remove_path(rel_path)
+            return
+        with self._lock:
+            self._add_path(rel_path)
+        if SEARCH_INDEX_CONTENT:
+            self._index_content(rel_path)
+
+    def build(self):
+        """初始化索引：先建立路径索引，再逐个索引文件内容"""
+        self.tree.ensure_built()
+        files = self.tree.iter_files()
+        with self._lock:
+            for rel_path in files:
+                self._add_path(rel_path)
+        self.paths_ready = True
+        if SEARCH_INDEX_CONTENT:
+            for rel_path in files:
+                if self._stop_event.is_set():
+                    return
+                self._index_content(rel_path)
+        self.content_ready = True
+
+    def _run(self):
+        try:
+            self.build()
+        except Exception as e:
+            print(f"建立搜索索引失败: {e}")
+        while not self._stop_event.is_set():
+            try:
+                event = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self._handle_event(*event)
+            except Exception as e:
+                print(f"更新搜索索引失败: {e}")
+
+    def verify_once(self):
+        """检查已索引文件的mtime，重新索引内容发生变化的文件（轮询模式下使用）"""
+        with self._lock:
+            known = list(self._entries.items())
+        for rel_path, entry in known:
+            try:
+                st = os.stat(os.path.join(self.root, system_path(rel_path)))
+            except OSError:
+                continue
+            if st.st_mtime_ns != entry.mtime or st.st_size != entry.size:
+                self._queue.put(("modified", rel_path, False))
+
+    def _verify_loop(self):
+        while not self._stop_event.wait(SEARCH_VERIFY_INTERVAL):
+            try:
+                self.verify_once()
+            except Exception as e:
+                print(f"检查文件内容变化失败: {e}")
+
+    def start(self):
+        self._stop_event.clear()
+        self._worker = threading.Thread(target=self._run, name="search-index", daemon=True)
+        self._worker.start()
+        if SEARCH_INDEX_CONTENT and self.tree._observer is None:
+            self._verify_thread = threading.Thread(target=self._verify_loop, name="search-verify", daemon=True)
+            self._verify_thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        for thread in (self._worker, self._verify_thread):
+            if thread is not None:
+                thread.join(timeout=5)
+        self._worker = self._verify_thread = None
+
+    def memory_estimate(self):
+        """倒排表大约占用的字节数（按每条倒排记录和每个键路径估算）"""
+        with self._lock:
+            postings = sum(len(entry.trigrams) + len(entry.keys) for entry in self._entries.values())
+            path_postings = sum(len(paths) for paths in self._path_grams.values())
+            return len(self._paths) * 200 + (postings + path_postings) * 90
+
+    # 查询
+    def _candidates(self, grams_index, universe, text):
+        """用trigram倒排表缩小候选集，查询词不足3个字符时返回全集"""
+        grams = _trigrams(text)
+        if not grams:
+            return set(universe)
+        buckets = []
+        for gram in grams:
+            bucket = grams_index.get(gram)
+            if not bucket:
+                return set()
+            buckets.append(bucket)
+        buckets.sort(key=len)
+        result = set(buckets[0])
+        for bucket in buckets[1:]:
+            result &= bucket
+            if not result:
+                break
+        return result
+
+    def _read_lower(self, rel_path):
+        try:
+            with open(os.path.join(self.root, system_path(rel_path)), 'r', encoding='utf-8') as f:
+                return f.read().lower()
+        except (OSError, UnicodeDecodeError):
+            return ""
+
+    def search(self, query, scope="name", match="substring", offset=0, limit=SEARCH_DEFAULT_LIMIT):
+        """
+        搜索文件
+        scope: name（文件名）/ path（相对路径）/ content（文件内容）/ key（YAML键路径，可写作 键路径=值）
+        match: substring（包含）/ prefix（前缀，content范围不支持）
+        返回 (总数, 当前页结果, 总数是否准确)，结果为 {"path", "name", "matches"} 字典；
+        content范围凑够当前页后不再读取其余候选文件，总数按未确认的候选估计
+        """
+        if not self.paths_ready:
+            self.tree.ensure_built()
+            with self._lock:
+                for rel_path in self.tree.iter_files():
+                    self._add_path(rel_path)
+            self.paths_ready = True
+
+        limit = max(0, min(limit, SEARCH_MAX_LIMIT))
+        offset = max(0, offset)
+        q = query.lower()
+        results = []
+
+        if scope in ("name", "path"):
+            with self._lock:
+                candidates = self._candidates(self._path_grams, self._paths, q)
+                for rel_path in candidates:
+                    target = self._paths[rel_path]
+                    if scope == "name":
+                        target = posixpath.basename(target)
+                    if target.startswith(q) if match == "prefix" else q in target:
+                        results.append({"path": rel_path, "name": posixpath.basename(rel_path), "matches": []})
+        elif scope == "content":
+            if len(q) < SEARCH_MIN_CONTENT_QUERY:
+                raise ValueError(f"内容搜索的关键词至少需要{SEARCH_MIN_CONTENT_QUERY}个字符")
+            with self._lock:
+                candidates = self._candidates(self._content_grams, self._entries, q)
+            # 倒排表只能排除不含查询词的文件，候选要读取文件确认；常见词几乎匹配所有文件，只确认到当前页为止
+            candidates = sorted(candidates)
+            checked = 0
+            for rel_path in candidates:
+                if len(results) >= offset + limit:
+                    break
+                checked += 1
+                content = self._read_lower(rel_path)
+                if q in content:
+                    line_no = content.count("\n", 0, content.index(q)) + 1
+                    results.append({"path": rel_path, "name": posixpath.basename(rel_path), "matches": [f"line {line_no}"]})
+            unchecked = len(candidates) - checked
+            return len(results) + unchecked, results[offset:offset + limit], unchecked == 0
+        elif scope == "key":
+            key_query, _, value_query = query.partition("=")
+            key_query = key_query.strip().lower()
+            value_query = value_query.strip().lower()
+            with self._lock:
+                keys = [
+                    key for key in self._key_files
+                    if (key.lower().startswith(key_query) if match == "prefix" else key_query in key.lower())
+                ]
+                per_file = {}
+                for key in keys:
+                    for rel_path in self._key_files[key]:
+                        values = self._entries[rel_path].keys.get(key, [])
+                        if value_query:
+                            values = [v for v in values if value_query in v.lower()]
+                            if not values:
+                                continue
+                        per_file.setdefault(rel_path, []).extend(f"{key}={v}" for v in values[:20])
+                        if not values:
+                            per_file[rel_path].append(key)
+            for rel_path, matches in per_file.items():
+                results.append({"path": rel_path, "name": posixpath.basename(rel_path), "matches": matches[:50]})
+        else:
+            raise ValueError(f"不支持的搜索范围: {scope}")
+
+        results.sort(key=lambda x: x["path"])
+        return len(results), results[offset:offset + limit], True
+
+search_index = WorkspaceLocal("search")
+
+# Mihomo引用索引
+REFS_INDEX = os.getenv("REFS_INDEX", "true").lower() == "true"  # 是否建立代理、策略组和Provider的引用索引
+REFS_MAX_FILE_BYTES = int(os.getenv("REFS_MAX_FILE_BYTES", str(8 * 1024 * 1024)))  # 超过此大小的文件不建立引用索引
+REFS_DEFAULT_LIMIT = 1000
+REFS_MAX_LIMIT = 10000
+
+# 查询参数中的类型 -> 命名空间，代理和策略组在Mihomo中共用一个名字空间
+REF_NAMESPACES = {
+    "proxy": "proxy",
+    "proxy-group": "proxy",
+    "proxy-provider": "proxy-provider",
+    "rule-provider": "rule-provider",
+    "sub-rule": "sub-rule",
+}
+MIHOMO_BUILTIN_PROXIES = frozenset({"DIRECT", "REJECT", "REJECT-DROP", "PASS", "COMPATIBLE", "GLOBAL"})
+_YAML_MERGE_TAG = "tag:yaml.org,2002:merge"
+
+def _node_pairs(node):
+    """映射节点中键为标量的 (键节点, 值节点)，不含合并键"""
+    if not isinstance(node, yaml.MappingNode):
+        return []
+    return [(k, v) for k, v in node.value if isinstance(k, yaml.ScalarNode) and k.tag != _YAML_MERGE_TAG]
+
+def _node_map(node, depth=0):
+    """映射节点转换为 键 -> 值节点，展开合并键（<<），显式写出的键优先"""
+    result = {}
+    if not isinstance(node, yaml.MappingNode) or depth > 8:
+        return result
+    merged = []
+    for key, value in node.value:
+        if not isinstance(key, yaml.ScalarNode):
+            continue
+        if key.tag == _YAML_MERGE_TAG:
+            merged.extend(value.value if isinstance(value, yaml.SequenceNode) else [value])
+        else:
+            result[key.value] = value
+    for source in merged:
+        for key, value in _node_map(source, depth + 1).items():
+            result.setdefault(key, value)
+    return result
+
+def _node_seq(node):
+    return node.value if isinstance(node, yaml.SequenceNode) else []
+
+def _node_scalar(node):
+    return node.value if isinstance(node, yaml.ScalarNode) and node.value != "" else None
+
+def split_rule(rule):
+    """按顶层逗号拆分规则，括号内的逗号不拆分"""
+    parts = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(rule):
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "," and depth == 0:
+            parts.append(rule[start:i].strip())
+            start = i + 1
+    parts.append(rule[start:].strip())
+    return parts
+
+def _unwrap(text):
+    return text[1:-1].strip() if text.startswith("(") and text.endswith(")") else None
+
+def rule_references(rule, with_target=True, depth=0):
+    """
+    返回一条规则引用的 [(命名空间, 名称)]
+    例如 RULE-SET,ads,REJECT -> [("rule-provider", "ads"), ("proxy", "REJECT")]，
+    AND/OR/NOT 和 SUB-RULE 中嵌套的子规则一并解析
+    """
+    parts = split_rule(rule)
+    rule_type = parts[0].upper()
+    refs = []
+    if depth > 16:
+        return refs
+    if rule_type in ("AND", "OR", "NOT") and len(parts) > 1:
+        inner = _unwrap(parts[1])
+        for sub in split_rule(inner) if inner else []:
+            sub = _unwrap(sub)
+            if sub:
+                refs.extend(rule_references(sub, False, depth + 1))
+    elif rule_type == "SUB-RULE" and len(parts) > 1:
+        inner = _unwrap(parts[1])
+        if inner:
+            refs.extend(rule_references(inner, False, depth + 1))
+    elif rule_type == "RULE-SET" and len(parts) > 1 and parts[1]:
+        refs.append(("rule-provider", parts[1]))
+    if with_target:
+        index = 1 if rule_type == "MATCH" else 2
+        if len(parts) > index and parts[index]:
+            refs.append(("sub-rule" if rule_type == "SUB-RULE" else "proxy", parts[index]))
+    return refs
+
+def extract_mihomo_references(text, rel_path):
+    """
+    从Mihomo配置中提取定义和引用，返回 (定义, 引用, 策略组成员, 引用的文件)
+    定义为 (类型, 名称, 行, 列, 位置)，引用为 (命名空间, 名称, 行, 列, 位置)，行列从1开始；
+    策略组成员为 名称 -> (成员元组, 是否还有use/include-all等其他来源)
+    """
+    definitions = []
+    usages = []
+    groups = {}
+    includes = set()
+
+    def define(kind, node, context):
+        name = _node_scalar(node)
+        if name is not None:
+            definitions.append((kind, name, node.start_mark.line + 1, node.start_mark.column + 1, context))
+        return name
+
+    def use(namespace, node, context, name=None):
+        name = name or _node_scalar(node)
+        if name is not None:
+            usages.append((namespace, name, node.start_mark.line + 1, node.start_mark.column + 1, context))
+        return name
+
+    def use_rules(rules_node, context):
+        for i, rule in enumerate(_node_seq(rules_node)):
+            rule_text = _node_scalar(rule)
+            if rule_text is None:
+                continue
+            for namespace, name in rule_references(rule_text):
+                use(namespace, rule, f"{context}[{i}]", name)
+
+    def include(path_node):
+        path = _node_scalar(path_node)
+        if not path or os.path.isabs(path) or path.startswith(("http://", "https://")):
+            return
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(rel_path), path.replace("\\", "/")))
+        if not target.startswith("../") and target != "..":
+            includes.add(target)
+
+    for root in yaml.compose_all(text, Loader=YAMLLoader):
+        top = _node_map(root)
+        for i, proxy in enumerate(_node_seq(top.get("proxies"))):
+            fields = _node_map(proxy)
+            define("proxy", fields.get("name"), f"proxies[{i}]")
+            use("proxy", fields.get("dialer-proxy"), f"proxies[{i}].dialer-proxy")
+        for i, group in enumerate(_node_seq(top.get("proxy-groups"))):
+            fields = _node_map(group)
+            context = f"proxy-groups[{i}]"
+            name = define("proxy-group", fields.get("name"), context)
+            members = [use("proxy", member, f"{context}.proxies") for member in _node_seq(fields.get("proxies"))]
+            providers = [use("proxy-provider", provider, f"{context}.use") for provider in _node_seq(fields.get("use"))]
+            use("proxy", fields.get("dialer-proxy"), f"{context}.dialer-proxy")
+            if name is not None:
+                include_all = any(
+                    (_node_scalar(fields.get(key)) or "").lower() == "true"
+                    for key in ("include-all", "include-all-proxies", "include-all-providers")
+                )
+                groups[name] = (tuple(m for m in members if m is not None), include_all or any(providers))
+        for key, kind in (("proxy-providers", "proxy-provider"), ("rule-providers", "rule-provider")):
+            for name_node, provider in _node_pairs(top.get(key)):
+                name = define(kind, name_node, f"{key}.{name_node.value}")
+                fields = _node_map(provider)
+                include(fields.get("path"))
+                use("proxy", _node_map(fields.get("override")).get("dialer-proxy"), f"{key}.{name}.override.dialer-proxy")
+        use_rules(top.get("rules"), "rules")
+        for name_node, rules in _node_pairs(top.get("sub-rules")):
+            name = define("sub-rule", name_node, f"sub-rules.{name_node.value}")
+            use_rules(rules, f"sub-rules.{name}")
+        for key in ("listeners", "tunnels"):
+            for i, item in enumerate(_node_seq(top.get(key))):
+                use("proxy", _node_map(item).get("proxy"), f"{key}[{i}].proxy")
+    return definitions, usages, groups, includes
+
+class _RefEntry:
+    __slots__ = ("mtime", "size", "definitions", "usages", "groups", "includes", "error")
+
+    def __init__(self, mtime, size, definitions=(), usages=(), groups=None, includes=frozenset(), error=None):
+        self.mtime = mtime
+        self.size = size
+        self.definitions = definitions
+        self.usages = usages
+        self.groups = groups or {}
+        self.includes = includes
+        self.error = error
+
+def ref_namespace(kind):
+    namespace = REF_NAMESPACES.get(kind)
+    if namespace is None:
+        raise ValueError(f"不支持的类型: {kind}，可选 {', '.join(REF_NAMESPACES)}")
+    return namespace
+
+def _definition_dict(rel_path, item):
+    kind, name, line, column, context = item
+    return {"kind": kind, "name": name, "path": rel_path, "line": line, "column": column, "context": context}
+
+def _usage_dict(rel_path, item):
+    namespace, name, line, column, context = item
+    return {"kind": namespace, "name": name, "path": rel_path, "line": line, "column": column, "context": context}
+
+class MihomoReferenceIndex:
+    """
+    工作区内Mihomo配置的符号索引：代理、策略组、proxy/rule-provider和sub-rule的定义与引用
+    随目录树索引的变化事件增量更新，查找引用、跳转定义、重命名/删除影响分析都只查内存
+    同名定义优先解析到同一文件，否则解析到工作区内任意文件中的定义
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.root = tree.root
+        self._lock = threading.RLock()
+        self._entries = {}       # 相对路径 -> _RefEntry
+        self._defined_in = {}    # (命名空间, 名称) -> {相对路径}
+        self._used_in = {}       # (命名空间, 名称) -> {相对路径}
+        self._included_by = {}   # 相对路径 -> {通过provider的path引用它的文件}
+        self._queue = queue.Queue()
+        self._worker = None
+        self._verify_thread = None
+        self._stop_event = threading.Event()
+        self.ready = False
+        tree.add_listener(self._on_tree_event)
+
+    def _on_tree_event(self, event_type, rel_path, is_dir):
+        if REFS_INDEX:
+            self._queue.put((event_type, rel_path, is_dir))
+
+    def _remove(self, rel_path):
+        entry = self._entries.pop(rel_path, None)
+        if entry is None:
+            return
+        for table, items in ((self._defined_in, entry.definitions), (self._used_in, entry.usages)):
+            for item in items:
+                key = (REF_NAMESPACES[item[0]], item[1])
+                bucket = table.get(key)
+                if bucket is not None:
+                    bucket.discard(rel_path)
+                    if not bucket:
+                        del table[key]
+        for target in entry.includes:
+            bucket = self._included_by.get(target)
+            if bucket is not None:
+                bucket.discard(rel_path)
+                if not bucket:
+                    del self._included_by[target]
+
+    def _index_file(self, rel_path):
+        """解析并索引单个文件，文件未变化时跳过"""
+        abs_path = os.path.join(self.root, system_path(rel_path))
+        try:
+            st = os.stat(abs_path)
+        except OSError:
+            return
+        entry = self._entries.get(rel_path)
+        if entry is not None and entry.mtime == st.st_mtime_ns and entry.size == st.st_size:
+            return
+
+        entry = _RefEntry(st.st_mtime_ns, st.st_size)
+        if st.st_size <= REFS_MAX_FILE_BYTES:
+            try:
+                with open(abs_path, 'r', encoding='utf-8') as f:
+                    text = f.read()
+                definitions, usages, groups, includes = extract_mihomo_references(text, rel_path)
+                entry = _RefEntry(st.st_mtime_ns, st.st_size, tuple(definitions), tuple(usages), groups, frozenset(includes))
+            except (OSError, UnicodeDecodeError) as e:
+                entry.error = f"读取失败：{e}"
+            except yaml.YAMLError as e:
+                entry.error = format_yaml_error(str(e))
+        else:
+            entry.error = "文件过大，未建立引用索引"
+
+        with self._lock:
+            self._remove(rel_path)
+            self._entries[rel_path] = entry
+            for item in entry.definitions:
+                self._defined_in.setdefault((REF_NAMESPACES[item[0]], item[1]), set()).add(rel_path)
+            for item in entry.usages:
+                self._used_in.setdefault((item[0], item[1]), set()).add(rel_path)
+            for target in entry.includes:
+                self._included_by.setdefault(target, set()).add(rel_path)
+
+    def _handle_event(self, event_type, rel_path, is_dir):
+        if is_dir:
+            if event_type == "deleted":
+                prefix = rel_path + "/"
+                with self._lock:
+                    for path in [p for p in self._entries if p.startswith(prefix)]:
+                        self._remove(path)
+            elif event_type == "created":
+                for path in self.tree.iter_files(rel_path):
+                    self._index_file(path)
+            return
+        if event_type == "deleted":
+            with self._lock:
+                self._remove(rel_path)
+            return
+        self._index_file(rel_path)
+
+    def build(self):
+        self.tree.ensure_built()
+        for rel_path in self.tree.iter_files():
+            if self._stop_event.is_set():
+                return
+            self._index_file(rel_path)
+        self.ready = True
+
+    def _run(self):
+        try:
+            self.build()
+        except Exception as e:
+            print(f"建立引用索引失败: {e}")
+        while not self._stop_event.is_set():
+            try:
+                event = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self._handle_event(*event)
+            except Exception as e:
+                print(f"更新引用索引失败: {e}")
+
+    def verify_once(self):
+        """检查已索引文件的mtime，重新索引发生变化的文件（轮询模式下使用）"""
+        with self._lock:
+            known = list(self._entries.items())
+        for rel_path, entry in known:
+            try:
+                st = os.stat(os.path.join(self.root, system_path(rel_path)))
+            except OSError:
+                continue
+            if st.st_mtime_ns != entry.mtime or st.st_size != entry.size:
+                self._queue.put(("modified", rel_path, False))
+
+    def _verify_loop(self):
+        while not self._stop_event.wait(SEARCH_VERIFY_INTERVAL):
+            try:
+                self.verify_once()
+            except Exception as e:
+                print(f"检查文件变化失败: {e}")
+
+    def start(self):
+        if not REFS_INDEX:
+            return
+        self._stop_event.clear()
+        self._worker = threading.Thread(target=self._run, name="refs-index", daemon=True)
+        self._worker.start()
+        if self.tree._observer is None:
+            self._verify_thread = threading.Thread(target=self._verify_loop, name="refs-verify", daemon=True)
+            self._verify_thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        for thread in (self._worker, self._verify_thread):
+            if thread is not None:
+                thread.join(timeout=5)
+        self._worker = self._verify_thread = None
+
+    # 查询
+    def _resolve(self, namespace, name, rel_path):
+        """引用解析到的定义所在文件：同一文件优先"""
+        files = self._defined_in.get((namespace, name), ())
+        if rel_path in files:
+            return {rel_path}
+        return set(files)
+
+    def definitions(self, name, kind="proxy", path=None):
+        """跳转定义：返回名称的定义位置，给出path时同一文件内的定义优先"""
+        namespace = ref_namespace(kind)
+        with self._lock:
+            files = self._resolve(namespace, name, path) if path else self._defined_in.get((namespace, name), ())
+            result = [
+                _definition_dict(rel_path, item)
+                for rel_path in sorted(files)
+                for item in self._entries[rel_path].definitions
+                if item[1] == name and REF_NAMESPACES[item[0]] == namespace
+            ]
+        return result
+
+    def usages(self, name, kind="proxy"):
+        """查找引用：返回所有引用该名称的位置"""
+        namespace = ref_namespace(kind)
+        with self._lock:
+            return [
+                _usage_dict(rel_path, item)
+                for rel_path in sorted(self._used_in.get((namespace, name), ()))
+                for item in self._entries[rel_path].usages
+                if item[0] == namespace and item[1] == name
+            ]
+
+    def impact(self, name, kind="proxy", new_name=None):
+        """
+        重命名或删除的影响：需要同步修改的引用、涉及的文件，
+        删除后成员为空的策略组（递归计算，空策略组本身也会被移除），
+        以及重命名时与新名称冲突的已有定义
+        """
+        namespace = ref_namespace(kind)
+        usages = self.usages(name, kind)
+        emptied = []
+        with self._lock:
+            if namespace == "proxy":
+                removed = {name}
+                groups = {}
+                for rel_path in self._entries:
+                    for group, (members, other_sources) in self._entries[rel_path].groups.items():
+                        if members and not other_sources:
+                            groups.setdefault(group, (rel_path, members))
+                changed = True
+                while changed:
+                    changed = False
+                    for group, (rel_path, members) in groups.items():
+                        if group not in removed and all(m in removed for m in members):
+                            removed.add(group)
+                            emptied.append({"name": group, "path": rel_path})
+                            changed = True
+        result = {
+            "definitions": self.definitions(name, kind),
+            "usages": usages,
+            "files": sorted({u["path"] for u in usages}),
+            "emptied_groups": emptied,
+        }
+        if new_name is not None:
+            result["conflicts"] = self.definitions(new_name, kind)
+        return result
+
+    def dangling(self, path=None):
+        """找不到定义的引用（内置策略DIRECT、REJECT等除外），给出path时只检查该文件"""
+        result = []
+        with self._lock:
+            paths = [path] if path else sorted(self._entries)
+            for rel_path in paths:
+                entry = self._entries.get(rel_path)
+                if entry is None:
+                    continue
+                for item in entry.usages:
+                    namespace, name = item[0], item[1]
+                    if namespace == "proxy" and name in MIHOMO_BUILTIN_PROXIES:
+                        continue
+                    if (namespace, name) not in self._defined_in:
+                        result.append(_usage_dict(rel_path, item))
+        return result
+
+    def _depends_on(self, rel_path):
+        entry = self._entries[rel_path]
+        targets = {t for t in entry.includes if t in self._entries}
+        for item in entry.usages:
+            targets |= self._resolve(item[0], item[1], rel_path)
+        targets.discard(rel_path)
+        return targets
+
+    def _used_by(self, rel_path):
+        entry = self._entries[rel_path]
+        sources = set(self._included_by.get(rel_path, ()))
+        for item in entry.definitions:
+            key = (REF_NAMESPACES[item[0]], item[1])
+            for source in self._used_in.get(key, ()):
+                if rel_path in self._resolve(key[0], key[1], source):
+                    sources.add(source)
+        sources.discard(rel_path)
+        return sources
+
+    def graph(self, path=None):
+        """
+        文件依赖关系：depends_on为该文件引用的定义所在的文件以及provider的path指向的文件，
+        used_by为反向关系；给出path时只计算该文件
+        """
+        with self._lock:
+            if path:
+                if path not in self._entries:
+                    return {}
+                depends_on = {path: self._depends_on(path)}
+                used_by = {path: self._used_by(path)}
+            else:
+                depends_on = {rel_path: self._depends_on(rel_path) for rel_path in self._entries}
+                used_by = {}
+                for rel_path, targets in depends_on.items():
+                    for target in targets:
+                        used_by.setdefault(target, set()).add(rel_path)
+            return {
+                rel_path: {
+                    "depends_on": sorted(targets),
+                    "used_by": sorted(used_by.get(rel_path, ())),
+                    "error": self._entries[rel_path].error
+                }
+                for rel_path, targets in sorted(depends_on.items())
+            }
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self._entries),
+                "symbols": len(self._defined_in),
+                "referenced": len(self._used_in),
+                "errors": sum(1 for entry in self._entries.values() if entry.error),
+                "ready": self.ready,
+            }
+
+    def memory_estimate(self):
+        with self._lock:
+            items = sum(len(entry.definitions) + len(entry.usages) for entry in self._entries.values())
+            return len(self._entries) * 300 + items * 250
+
+refs_index = WorkspaceLocal("refs")
+
+# 工作区变化推送
+CHANGE_FEED_COALESCE_MS = float(os.getenv("CHANGE_FEED_COALESCE_MS", "200"))  # 合并变化事件的时间窗口（毫秒）
+CHANGE_FEED_BACKLOG = int(os.getenv("CHANGE_FEED_BACKLOG", "1000"))  # 保留的最近事件数，断线重连时据此补发
+CHANGE_FEED_QUEUE_SIZE = 256  # 每个订阅者最多积压的推送批次，超过后通知客户端重新加载
+CHANGE_FEED_HEARTBEAT = 15  # SSE心跳间隔（秒）
+
+class ChangeFeed:
+    """
+    工作区变化事件流：汇总目录树索引（文件监听）和接口自身写入产生的变化，
+    按时间窗口合并同一路径的事件、识别移动，附上新的ETag后推送给订阅者（SSE / WebSocket）
+    事件ID为 "<进程标识>-<序号>"，客户端重连时带上最后收到的ID即可补发期间的事件
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.epoch = uuid.uuid4().hex[:8]
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self._pending = collections.OrderedDict()  # 路径 -> {"type", "is_dir", "etag"}
+        self._moves = {}                           # 目标路径 -> 源路径（接口内的移动操作）
+        self._subscribers = set()
+        self._backlog = collections.deque(maxlen=CHANGE_FEED_BACKLOG)
+        self._etags = collections.OrderedDict()    # 路径 -> 最近推送的ETag，过滤内容未变的修改事件
+        self._seq = 0
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    # 事件来源（可在任意线程中调用）
+    def publish(self, event_type, rel_path, is_dir=False, etag=None):
+        if self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._add, event_type, rel_path, is_dir, etag)
+        except RuntimeError:
+            # 事件循环已关闭
+            pass
+
+    def announce_move(self, source_path, target_path):
+        """接口内的移动操作：随后目录树产生的删除/新增事件会合并为一个moved事件"""
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._moves.__setitem__, target_path, source_path)
+
+    def on_tree_event(self, event_type, rel_path, is_dir):
+        self.publish(event_type, rel_path, is_dir)
+
+    def _add(self, event_type, rel_path, is_dir, etag):
+        previous = self._pending.get(rel_path)
+        if previous is not None:
+            if previous["type"] == "created" and event_type == "deleted":
+                # 窗口内创建后又删除，相互抵消
+                del self._pending[rel_path]
+                return
+            if previous["type"] == "deleted" and event_type == "created":
+                event_type = "modified"
+            elif previous["type"] == "created" and event_type == "modified":
+                event_type = "created"
+            etag = etag or (previous["etag"] if event_type != "deleted" else None)
+        self._pending[rel_path] = {"type": event_type, "is_dir": is_dir, "etag": etag}
+        self._wakeup.set()
+
+    # 合并与推送
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(CHANGE_FEED_COALESCE_MS / 1000)
+            self._wakeup.clear()
+            pending, self._pending = self._pending, collections.OrderedDict()
+            moves, self._moves = self._moves, {}
+            try:
+                events = await self._build_events(pending, moves)
+            except Exception as e:
+                print(f"处理工作区变化事件失败: {e}")
+                continue
+            if events:
+                self._dispatch(events)
+
+    @staticmethod
+    def _pair_moves(pending, moves):
+        """把同一窗口内的删除+新增识别为移动：优先使用接口记录的移动，其次按文件名唯一匹配"""
+        pairs = []
+        for target, source in moves.items():
+            if pending.get(source, {}).get("type") == "deleted" and pending.get(target, {}).get("type") in ("created", "modified"):
+                pairs.append((source, target))
+        paired = {p for pair in pairs for p in pair}
+        deleted, created = {}, {}
+        for rel_path, item in pending.items():
+            if rel_path in paired:
+                continue
+            key = (posixpath.basename(rel_path), item["is_dir"])
+            if item["type"] == "deleted":
+                deleted.setdefault(key, []).append(rel_path)
+            elif item["type"] == "created":
+                created.setdefault(key, []).append(rel_path)
+        for key, sources in deleted.items():
+            if len(sources) == 1 and len(created.get(key, ())) == 1:
+                pairs.append((sources[0], created[key][0]))
+        for source, target in pairs:
+            item = pending.pop(source)
+            pending[target] = {**pending[target], "type": "moved", "from": source, "is_dir": item["is_dir"]}
+
+    def _file_etags(self, rel_paths):
+        """计算文件当前内容的ETag（与读取接口一致），文件已不存在时为None"""
+        result = {}
+        for rel_path in rel_paths:
+            try:
+                digest, _ = load_file_content(system_path(os.path.join(self.root, rel_path)))
+                result[rel_path] = content_etag(digest)
+            except (FileNotFoundError, IsADirectoryError):
+                result[rel_path] = None
+            except Exception:
+                result[rel_path] = ""
+        return result
+
+    async def _build_events(self, pending, moves):
+        self._pair_moves(pending, moves)
+        # 没有订阅者时不计算ETag，只记录事件供重连补发
+        missing = [
+            rel_path for rel_path, item in pending.items()
+            if not item["is_dir"] and item["type"] != "deleted" and item["etag"] is None
+        ] if self._subscribers else []
+        etags = await io_pool.run(self._file_etags, missing) if missing else {}
+
+        events = []
+        now = time.time()
+        for rel_path, item in pending.items():
+            etag = item["etag"]
+            if rel_path in etags:
+                etag = etags[rel_path]
+                if etag is None:
+                    # 文件已被删除，删除事件随后会到达
+                    continue
+                etag = etag or None
+            if item["type"] == "deleted":
+                self._etags.pop(rel_path, None)
+            elif not item["is_dir"] and etag is not None:
+                if item["type"] == "modified" and self._etags.get(rel_path) == etag:
+                    continue
+                self._etags[rel_path] = etag
+                self._etags.move_to_end(rel_path)
+                while len(self._etags) > 10000:
+                    self._etags.popitem(last=False)
+            if item["type"] == "moved":
+                self._etags.pop(item["from"], None)
+            self._seq += 1
+            event = {
+                "id": f"{self.epoch}-{self._seq}",
+                "type": item["type"],
+                "path": rel_path,
+                "is_dir": item["is_dir"],
+                "etag": etag,
+                "time": now
+            }
+            if item["type"] == "moved":
+                event["from"] = item["from"]
+            events.append(event)
+        return events
+
+    def _reset_event(self):
+        return {"id": f"{self.epoch}-{self._seq}", "type": "reset", "time": time.time()}
+
+    def _dispatch(self, events):
+        self._backlog.extend(events)
+        for subscriber in list(self._subscribers):
+            try:
+                subscriber.put_nowait(events)
+            except asyncio.QueueFull:
+                # 客户端处理太慢，丢弃积压的事件并通知其重新加载
+                while not subscriber.empty():
+                    subscriber.get_nowait()
+                subscriber.put_nowait([self._reset_event()])
+
+    # 订阅
+    def subscribe(self, since=None):
+        """返回 (事件队列, 需要补发的事件)；无法补发时补发一个reset事件，客户端应重新加载目录树"""
+        subscriber = asyncio.Queue(maxsize=CHANGE_FEED_QUEUE_SIZE)
+        self._subscribers.add(subscriber)
+        if not since:
+            return subscriber, []
+        epoch, _, seq = since.rpartition("-")
+        if epoch != self.epoch or not seq.isdigit() or int(seq) > self._seq:
+            return subscriber, [self._reset_event()]
+        seq = int(seq)
+        if seq == self._seq:
+            return subscriber, []
+        oldest = int(self._backlog[0]["id"].rpartition("-")[2]) if self._backlog else self._seq + 1
+        if seq + 1 < oldest:
+            return subscriber, [self._reset_event()]
+        return subscriber, [e for e in self._backlog if int(e["id"].rpartition("-")[2]) > seq]
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+
+    def stats(self):
+        return {"subscribers": len(self._subscribers), "last_id": f"{self.epoch}-{self._seq}"}
+
+change_feed = WorkspaceLocal("changes")
+
+@app.get("/api/events")
+async def workspace_events(request: Request, token: Optional[str] = None, since: Optional[str] = None):
+    """以Server-Sent Events推送工作区变化，支持Last-Event-ID断线续传"""
+    authenticate(request, token)
+    subscriber, replay = change_feed.subscribe(request.headers.get("last-event-id") or since)
+
+    def format_events(events):
+        return "".join(
+            f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+            for event in events
+        )
+
+    async def stream_events():
+        try:
+            yield "retry: 3000\n\n" + format_events(replay)
+            while True:
+                try:
+                    events = await asyncio.wait_for(subscriber.get(), CHANGE_FEED_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                yield format_events(events)
+        finally:
+            change_feed.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        stream_events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.websocket("/api/events/ws")
+async def workspace_events_websocket(websocket: WebSocket, token: Optional[str] = None, since: Optional[str] = None):
+    """以WebSocket推送工作区变化，每条消息为 {"events": [...]}"""
+    try:
+        authenticate(websocket, token)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    subscriber, replay = change_feed.subscribe(since)
+
+    async def receive_until_disconnect():
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+
+    async def send_events():
+        if replay:
+            await websocket.send_text(json.dumps({"events": replay}, ensure_ascii=False))
+        while True:
+            events = await subscriber.get()
+            await websocket.send_text(json.dumps({"events": events}, ensure_ascii=False))
+
+    tasks = [asyncio.ensure_future(receive_until_disconnect()), asyncio.ensure_future(send_events())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        change_feed.unsubscribe(subscriber)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            await websocket.close()
+        except RuntimeError:
+            pass
+
+@app.get("/api/files")
+async def list_files(
+    request: Request,
+    search: str = "",
+    scope: str = "name",
+    match: str = "substring",
+    offset: int = 0,
+    limit: int = SEARCH_DEFAULT_LIMIT,
+    token: dict = Depends(verify_token)
+):
+    """获取文件列表"""
+    workspace_dir = get_workspace_dir()
+    sys_workspace_dir = system_path(workspace_dir)
+    
+    try:
+        if not search:
+            # 从内存索引获取完整目录结构
+            if not os.path.isdir(sys_workspace_dir):
+                raise FileNotFoundError(f"工作目录不存在: {workspace_dir}")
+            if tree_index.ready:
+                etag, body = tree_index.snapshot()
+            else:
+                etag, body = await io_pool.run(tree_index.snapshot)
+            if request.headers.get("if-none-match") == etag:
+                return Response(status_code=304, headers={"ETag": etag})
+            return Response(content=body, media_type="application/json", headers={"ETag": etag, "Cache-Control": "no-cache"})
+        else:
+            # 通过搜索索引匹配文件名
+            total, items, _ = await io_pool.run(search_index.search, search, scope=scope, match=match, offset=offset, limit=limit)
+            files = [FileInfo(path=item["path"], name=item["name"], isDirectory=False) for item in items]
+            return JSONResponse(content=jsonable_encoder(files), headers={"X-Total-Count": str(total)})
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 按层分页列出目录
+DIR_PAGE_DEFAULT_LIMIT = 500
+DIR_PAGE_MAX_LIMIT = 5000
+
+def encode_dir_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key, ensure_ascii=False).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_dir_cursor(cursor):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return (bool(key[0]), str(key[1]), str(key[2]))
+    except Exception:
+        raise ValueError("无效的分页游标")
+
+def list_directory_page(rel_dir, after, limit):
+    keys, items = tree_index.list_dir(rel_dir)
+    # 游标记录上一页最后一项的排序键，期间目录有增删时也不会重复或遗漏
+    start = bisect.bisect_right(keys, after) if after else 0
+    page = items[start:start + limit]
+    end = start + len(page)
+    result = []
+    for name, is_dir in page:
+        child = f"{rel_dir}/{name}" if rel_dir else name
+        result.append({
+            "path": child,
+            "name": name,
+            "isDirectory": is_dir,
+            "childCount": tree_index.child_count(child) if is_dir else None
+        })
+    return {
+        "path": rel_dir,
+        "total": len(items),
+        "items": result,
+        "next_cursor": encode_dir_cursor(keys[end - 1]) if end < len(items) else None
+    }
+
+@app.get("/api/files/dir")
+async def list_directory(
+    path: str = "",
+    cursor: Optional[str] = None,
+    limit: int = DIR_PAGE_DEFAULT_LIMIT,
+    token: dict = Depends(verify_token)
+):
+    """只列出一层目录（目录在前，按名称排序），大目录通过cursor分页，子目录附带子项数量"""
+    try:
+        rel_dir, _ = resolve_workspace_path(path)
+        after = decode_dir_cursor(cursor) if cursor else None
+        limit = max(1, min(limit, DIR_PAGE_MAX_LIMIT))
+        return await io_pool.run(list_directory_page, rel_dir, after, limit)
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except (FileNotFoundError, NotADirectoryError):
+        raise HTTPException(status_code=404, detail=f"目录不存在：{path}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/search")
+async def search_files(
+    q: str,
+    scope: str = "name",
+    match: str = "substring",
+    offset: int = 0,
+    limit: int = SEARCH_DEFAULT_LIMIT,
+    token: dict = Depends(verify_token)
+):
+    """搜索文件名、路径、内容或YAML键路径（如 proxies[*].name=HK）"""
+    try:
+        total, items, exact = await io_pool.run(search_index.search, q, scope=scope, match=match, offset=offset, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "total": total,
+        "offset": offset,
+        "limit": limit,
+        # 索引尚未建完，或内容搜索只确认了当前页（total为估计值）
+        "partial": not exact or (not search_index.content_ready and scope in ("content", "key")),
+        "items": items
+    }
+
+# 引用查询（跳转定义、查找引用、影响分析）
+def refs_page(items, offset, limit):
+    limit = max(0, min(limit, REFS_MAX_LIMIT))
+    offset = max(0, offset)
+    return {
+        "total": len(items),
+        "offset": offset,
+        "limit": limit,
+        "partial": not refs_index.ready,
+        "items": items[offset:offset + limit]
+    }
+
+@app.get("/api/refs/definitions")
+async def find_definitions(name: str, kind: str = "proxy", path: Optional[str] = None, token: dict = Depends(verify_token)):
+    """跳转定义：查找代理、策略组、provider或sub-rule的定义位置，给出path时同一文件内的定义优先"""
+    try:
+        items = await io_pool.run(refs_index.definitions, name, kind, normalize_path(path) if path else None)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"partial": not refs_index.ready, "items": items}
+
+@app.get("/api/refs/usages")
+async def find_usages(
+    name: str,
+    kind: str = "proxy",
+    offset: int = 0,
+    limit: int = REFS_DEFAULT_LIMIT,
+    token: dict = Depends(verify_token)
+):
+    """查找引用：列出所有引用该名称的位置（策略组成员、规则目标、dialer-proxy等）"""
+    try:
+        items = await io_pool.run(refs_index.usages, name, kind)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return refs_page(items, offset, limit)
+
+@app.get("/api/refs/impact")
+async def rename_impact(name: str, kind: str = "proxy", new_name: Optional[str] = None, token: dict = Depends(verify_token)):
+    """重命名或删除的影响：需要修改的引用、涉及的文件、会变为空的策略组和新名称的冲突"""
+    try:
+        result = await io_pool.run(refs_index.impact, name, kind, new_name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {**result, "partial": not refs_index.ready}
+
+@app.get("/api/refs/dangling")
+async def find_dangling(
+    path: Optional[str] = None,
+    offset: int = 0,
+    limit: int = REFS_DEFAULT_LIMIT,
+    token: dict = Depends(verify_token)
+):
+    """找不到定义的引用，给出path时只检查该文件"""
+    items = await io_pool.run(refs_index.dangling, normalize_path(path) if path else None)
+    return refs_page(items, offset, limit)
+
+@app.get("/api/refs/graph")
+async def reference_graph(path: Optional[str] = None, token: dict = Depends(verify_token)):
+    """文件之间的依赖关系（引用的定义所在文件和provider的path），给出path时只返回该文件"""
+    files = await io_pool.run(refs_index.graph, normalize_path(path) if path else None)
+    return {"partial": not refs_index.ready, "files": files}
+
+# 文件流式读取
+RAW_CHUNK_SIZE = int(os.getenv("RAW_CHUNK_SIZE", str(256 * 1024)))  # 流式读取的块大小（字节）
+RAW_COMPRESSION = os.getenv("RAW_COMPRESSION", "true").lower() == "true"  # 是否按Accept-Encoding压缩
+RAW_COMPRESS_MIN_SIZE = 1024
+LINES_MAX_PAGE = int(os.getenv("LINES_MAX_PAGE", "5000"))  # 按行读取时每页最多行数
+LINE_INDEX_STRIDE = 1024  # 行索引每隔多少行记录一次字节偏移
+LINE_INDEX_CACHE_SIZE = 64
+
+def file_etag(st):
+    """根据mtime和大小生成ETag，不需要读取文件内容"""
+    return make_etag(st.st_mtime_ns, st.st_size)
+
+def make_etag(mtime_ns, size):
+    return f'"{mtime_ns:x}-{size:x}"'
+
+def etag_matches(header_value, etag):
+    """If-None-Match / If-Range 的弱比较"""
+    if not header_value:
+        return False
+    if header_value.strip() == "*":
+        return True
+    target = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header_value.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == target:
+            return True
+    return False
+
+def is_not_modified(request, etag, mtime):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def parse_range_header(range_header, size):
+    """
+    解析单段Range请求，返回 (start, end)（包含end）
+    多段范围返回 "ignore"（按完整内容响应），无法满足时返回None
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return "ignore"
+    start_str, _, end_str = spec.strip().partition("-")
+    try:
+        if start_str == "":
+            length = int(end_str)
+            if length <= 0:
+                return None
+            start = max(0, size - length)
+            end = size - 1
+        else:
+            start = int(start_str)
+            end = int(end_str) if end_str else size - 1
+            end = min(end, size - 1)
+    except ValueError:
+        return "ignore"
+    if start >= size or start > end:
+        return None
+    return start, end
+
+def choose_content_encoding(accept_encoding):
+    accepted = {item.split(";")[0].strip().lower() for item in accept_encoding.split(",")}
+    if "br" in accepted and brotli is not None:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+async def iter_file_chunks(f, length=None):
+    """分块读取已打开的文件，结束后关闭文件"""
+    try:
+        remaining = length
+        while remaining is None or remaining > 0:
+            size = RAW_CHUNK_SIZE if remaining is None else min(RAW_CHUNK_SIZE, remaining)
+            chunk = await io_pool.run(f.read, size)
+            if not chunk:
+                break
+            file_read_bytes.inc(len(chunk))
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+    finally:
+        await io_pool.run(f.close)
+
+async def compress_chunks(chunks, encoding):
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=5)
+        process, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        process, finish = compressor.compress, compressor.flush
+    async for chunk in chunks:
+        data = await io_pool.run(process, chunk)
+        if data:
+            yield data
+    yield finish()
+
+class LineIndex:
+    """
+    文件的稀疏行索引：每隔LINE_INDEX_STRIDE行记录一次字节偏移，
+    用于快速定位第N行而不必从头读取
+    """
+
+    def __init__(self, mtime_ns, size, offsets, total_lines):
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.offsets = offsets
+        self.total_lines = total_lines
+
+    @classmethod
+    def build(cls, sys_file_path):
+        st = os.stat(sys_file_path)
+        offsets = array.array("Q", [0])
+        line = 0
+        pos = 0
+        last_byte = b""
+        with open(sys_file_path, 'rb') as f:
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                count = chunk.count(b"\n")
+                if line // LINE_INDEX_STRIDE == (line + count) // LINE_INDEX_STRIDE:
+                    line += count
+                else:
+                    index = chunk.find(b"\n")
+                    while index != -1:
+                        line += 1
+                        if line % LINE_INDEX_STRIDE == 0:
+                            offsets.append(pos + index + 1)
+                        index = chunk.find(b"\n", index + 1)
+                pos += len(chunk)
+                last_byte = chunk[-1:]
+        if pos and last_byte != b"\n":
+            line += 1
+        return cls(st.st_mtime_ns, st.st_size, offsets, line)
+
+    def read_lines(self, sys_file_path, start, count):
+        """读取从第start行（从1开始）起的count行，返回原始字节"""
+        checkpoint = (start - 1) // LINE_INDEX_STRIDE
+        with open(sys_file_path, 'rb') as f:
+            f.seek(self.offsets[checkpoint])
+            for _ in range((start - 1) - checkpoint * LINE_INDEX_STRIDE):
+                if not f.readline():
+                    return b""
+            return b"".join(f.readline() for _ in range(count))
+
+_line_index_cache = collections.OrderedDict()
+_line_index_lock = threading.Lock()
+
+def get_line_index(sys_file_path):
+    """获取文件的行索引，文件未变化时复用缓存"""
+    st = os.stat(sys_file_path)
+    with _line_index_lock:
+        index = _line_index_cache.get(sys_file_path)
+        if index is not None and index.mtime_ns == st.st_mtime_ns and index.size == st.st_size:
+            _line_index_cache.move_to_end(sys_file_path)
+            return index
+    index = LineIndex.build(sys_file_path)
+    with _line_index_lock:
+        _line_index_cache[sys_file_path] = index
+        _line_index_cache.move_to_end(sys_file_path)
+        while len(_line_index_cache) > LINE_INDEX_CACHE_SIZE:
+            _line_index_cache.popitem(last=False)
+    return index
+
+def read_file_lines(sys_file_path, start, count):
+    index = get_line_index(sys_file_path)
+    data = index.read_lines(sys_file_path, start, count) if start <= index.total_lines else b""
+    return index, data
+
+# YAML增量校验
+VALIDATE_CHUNK_SIZE = int(os.getenv("VALIDATE_CHUNK_SIZE", str(8 * 1024)))  # 分块校验时每块的目标大小（字节）
+VALIDATE_CACHE_BYTES = int(os.getenv("VALIDATE_CACHE_BYTES", str(128 * 1024 * 1024)))  # 缓存的文档内容总大小上限
+VALIDATE_CHUNK_CACHE_SIZE = 50000  # 缓存的分块校验结果数量
+
+# 单行的映射键（普通、双引号或单引号键）后跟冒号
+_MAPPING_KEY = r'''(?:[^\s#\-?:,\[\]{}&*!|>'"%@`][^\n]*?|"(?:[^"\\\n]|\\.)*"|'(?:[^'\n]|'')*')[ \t]*:(?:[ \t]|$)'''
+_TOP_LEVEL_LINE = re.compile(r'^[^\s#]', re.M)
+_TOP_LEVEL_KEY = re.compile(r'^' + _MAPPING_KEY, re.M)
+_UNSPLITTABLE = re.compile(r'^(?:---|\.\.\.|[?:])(?:\s|$)|^%', re.M)  # 多文档、指令和复杂键只做整体解析
+_BLOCK_HEADER = re.compile(r'[^\n]*?:[ \t]*(?:#[^\n]*)?(?:\n|$)')
+_FIRST_CHILD = re.compile(r'^( *)[^\s#]', re.M)
+_ALIAS_TOKEN = re.compile(r'\*(?<=[\s\[{]\*)([^\s,\[\]{}]+)')
+_ANCHOR_TOKEN = re.compile(r'&(?<=[\s\[{]&)([^\s,\[\]{}]+)')
+_child_entry_patterns = {}
+_chunk_result_cache = collections.OrderedDict()
+_chunk_cache_lock = threading.Lock()
+
+def content_hash(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+def _child_entry_pattern(indent, kind):
+    # indent为0时是顶层序列或顶层键下的无缩进序列
+    pattern = _child_entry_patterns.get((indent, kind))
+    if pattern is None:
+        if kind == "-":
+            pattern = re.compile(r'^ {%d}-(?:[ \t]|$)' % indent, re.M)
+        else:
+            pattern = re.compile(r'^ {%d}' % indent + _MAPPING_KEY, re.M)
+        _child_entry_patterns[(indent, kind)] = pattern
+    return pattern
+
+def _yaml_diagnostic(e, text):
+    mark = getattr(e, "problem_mark", None) or getattr(e, "context_mark", None)
+    problem = getattr(e, "problem", None) or str(e)
+    if mark and 0 <= mark.index < len(text) and text[mark.index] == "\t":
+        # libyaml的错误信息里不包含具体字符
+        problem = problem.replace("found character", "found character '\\t'")
+    context = getattr(e, "context", None)
+    detail = f"{context}, {problem}" if context else problem
+    return {
+        "line": (mark.line + 1) if mark else None,
+        "column": (mark.column + 1) if mark else None,
+        "message": format_yaml_error(detail),
+        "detail": detail,
+        "severity": "error"
+    }
+
+def _parse_chunk(text):
+    """解析文本，返回 (诊断列表, 根节点类型)，根节点是序列时为"-"，映射时为":"，其他为None"""
+    try:
+        data = yaml.load(text, Loader=YAMLLoader)
+    except yaml.YAMLError as e:
+        return [_yaml_diagnostic(e, text)], None
+    return [], "-" if isinstance(data, list) else ":" if isinstance(data, dict) else None
+
+def _parse_diagnostics(text):
+    return _parse_chunk(text)[0]
+
+def _group_entries(text, start, end, pattern, parent, kind, chunks):
+    """从start开始按条目边界切出约VALIDATE_CHUNK_SIZE字节的块，kind为条目的类型（序列或映射）"""
+    while start < end:
+        boundary = pattern.search(text, min(start + VALIDATE_CHUNK_SIZE, end), end)
+        chunk_end = boundary.start() if boundary else end
+        chunks.append((start, chunk_end, parent, kind))
+        start = chunk_end
+
+def split_yaml_chunks(text):
+    """
+    按顶层条目及大块内的直接子条目把文档切分为可独立解析的块，
+    返回 [(起始偏移, 结束偏移, 父块编号, 子条目类型)]；无法安全切分时返回None。
+    子条目类型为None的块按映射解析
+    """
+    if _UNSPLITTABLE.search(text):
+        return None
+    first = _TOP_LEVEL_LINE.search(text)
+    if not first:
+        return [(0, len(text), 0, None)]
+    chunks = []
+    sequence_entry = _child_entry_pattern(0, "-")
+    if text[first.start()] == "-":
+        # 顶层是序列，行首出现其他内容时只能整体解析
+        for m in _TOP_LEVEL_LINE.finditer(text):
+            if not sequence_entry.match(text, m.start()):
+                return None
+        _group_entries(text, 0, len(text), sequence_entry, 0, "-", chunks)
+        return chunks
+
+    # 顶层是映射，行首的"- "属于上一个键的无缩进序列；游离的标量、流式集合等行只能整体解析
+    entries = []
+    for m in _TOP_LEVEL_LINE.finditer(text):
+        if _TOP_LEVEL_KEY.match(text, m.start()):
+            entries.append(m.start())
+        elif not sequence_entry.match(text, m.start()):
+            return None
+    if not entries:
+        return None
+    first_key = entries[0]
+    entries[0] = 0
+    bounds = entries + [len(text)]
+    for index in range(len(entries)):
+        start, end = bounds[index], bounds[index + 1]
+        if end - start <= VALIDATE_CHUNK_SIZE:
+            chunks.append((start, end, index, None))
+            continue
+        # 大块：键后面有行内值（锚点、标签等）时不切分
+        header_end = _BLOCK_HEADER.match(text, first_key if index == 0 else start, end)
+        child_match = _FIRST_CHILD.search(text, header_end.end(), end) if header_end else None
+        if not child_match:
+            chunks.append((start, end, index, None))
+            continue
+        indent = len(child_match.group(1))
+        kind = "-" if text.startswith("-", child_match.start() + indent) else ":"
+        pattern = _child_entry_pattern(indent, kind)
+        if not pattern.match(text, child_match.start(), end):
+            chunks.append((start, end, index, None))
+            continue
+        chunks.append((start, child_match.start(), index, None))
+        _group_entries(text, child_match.start(), end, pattern, index, kind, chunks)
+    return chunks
+
+def _needs_full_parse(text, chunks):
+    """别名引用了其他块中的锚点时，需要整体解析"""
+    aliases = [(m.start(1), m.group(1)) for m in _ALIAS_TOKEN.finditer(text)]
+    if not aliases:
+        return False
+    chunk_starts = [c[0] for c in chunks]
+    anchors = {}
+    for m in _ANCHOR_TOKEN.finditer(text):
+        anchors.setdefault(m.group(1), set()).add(bisect.bisect_right(chunk_starts, m.start(1)) - 1)
+    for pos, name in aliases:
+        if bisect.bisect_right(chunk_starts, pos) - 1 not in anchors.get(name, ()):
+            return True
+    return False
+
+def validate_yaml_text(text):
+    """
+    校验YAML文本，返回 {"valid", "diagnostics", "mode", "parsed_chunks", "total_chunks"}
+    未变化的块直接复用缓存的结果（在CPU池中执行）
+    """
+    chunks = split_yaml_chunks(text)
+    if chunks is None or _needs_full_parse(text, chunks):
+        diagnostics = _parse_diagnostics(text)
+        return {"valid": not diagnostics, "diagnostics": diagnostics, "mode": "full", "parsed_chunks": 1, "total_chunks": 1}
+
+    diagnostics = []
+    parsed = 0
+    line = 0
+    last_pos = 0
+    for start, end, _, kind in chunks:
+        line += text.count("\n", last_pos, start)
+        last_pos = start
+        chunk = text[start:end]
+        key = hashlib.blake2b(chunk.encode("utf-8"), digest_size=16).digest()
+        with _chunk_cache_lock:
+            result = _chunk_result_cache.get(key)
+            if result is not None:
+                _chunk_result_cache.move_to_end(key)
+        if result is None:
+            parsed += 1
+            result = _parse_chunk(chunk)
+            with _chunk_cache_lock:
+                _chunk_result_cache[key] = result
+                while len(_chunk_result_cache) > VALIDATE_CHUNK_CACHE_SIZE:
+                    _chunk_result_cache.popitem(last=False)
+        result, root_kind = result
+        # 块末尾的错误可能是切分导致的（如未闭合的引号），根节点类型与父节点不符时块本身不能代表原文，都交给整体解析确认
+        if (result and result[0]["line"] is not None and result[0]["line"] >= chunk.count("\n") and end != len(text)) \
+                or (not result and root_kind != (kind or ":")):
+            diagnostics = _parse_diagnostics(text)
+            return {"valid": not diagnostics, "diagnostics": diagnostics, "mode": "full", "parsed_chunks": parsed, "total_chunks": len(chunks)}
+        for item in result:
+            diagnostics.append({**item, "line": item["line"] + line if item["line"] is not None else None})
+    return {"valid": not diagnostics, "diagnostics": diagnostics, "mode": "incremental", "parsed_chunks": parsed, "total_chunks": len(chunks)}
+
+def apply_line_edits(text, edits):
+    """
+    按顺序应用行级编辑：每个编辑把第start_line到end_line行（从1开始，包含end_line；
+    end_line = start_line - 1 表示在start_line前插入）替换为text
+    """
+    lines = text.splitlines(keepends=True)
+    for edit in edits:
+        start = edit.start_line - 1
+        end = edit.end_line
+        if start < 0 or end < start or end > len(lines) or start > len(lines):
+            raise ValueError(f"编辑范围无效: {edit.start_line}-{edit.end_line}")
+        new_lines = edit.text.splitlines(keepends=True)
+        if new_lines and not new_lines[-1].endswith(("\n", "\r")) and end < len(lines):
+            new_lines[-1] += "\n"
+        lines[start:end] = new_lines
+    return "".join(lines)
+
+_HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+def apply_unified_diff(text, diff):
+    """把统一diff格式的补丁应用到文本上，上下文或删除行与原文不一致时抛出ValueError"""
+    lines = text.splitlines(keepends=True)
+    result = []
+    pos = 0
+    last_tag = None
+    diff_lines = diff.splitlines(keepends=True)
+    i = 0
+    while i < len(diff_lines):
+        header = _HUNK_HEADER.match(diff_lines[i])
+        i += 1
+        if not header:
+            # 跳过 ---/+++ 等文件头
+            continue
+        old_start, old_count = int(header.group(1)), int(header.group(2) or 1)
+        start = old_start if old_count == 0 else old_start - 1
+        if start < pos or start > len(lines):
+            raise ValueError(f"补丁块位置无效: {diff_lines[i - 1].strip()}")
+        result.extend(lines[pos:start])
+        pos = start
+        while i < len(diff_lines) and not diff_lines[i].startswith("@@"):
+            line = diff_lines[i]
+            i += 1
+            tag, body = line[:1], line[1:]
+            if tag in ("\r", "\n"):
+                # 部分工具会去掉空上下文行开头的空格
+                tag, body = " ", line
+            if tag in (" ", "-"):
+                if pos >= len(lines) or lines[pos].rstrip("\r\n") != body.rstrip("\r\n"):
+                    raise ValueError(f"补丁与第{pos + 1}行的内容不一致")
+                if tag == " ":
+                    result.append(lines[pos])
+                pos += 1
+            elif tag == "+":
+                result.append(body)
+            elif tag == "\\":
+                # "\ No newline at end of file"：上一行没有换行符
+                if last_tag == "+" and result:
+                    result[-1] = result[-1].rstrip("\r\n")
+                continue
+            else:
+                raise ValueError(f"无法识别的补丁行: {line.rstrip()}")
+            last_tag = tag
+    result.extend(lines[pos:])
+    return "".join(result)
+
+class YAMLValidationCache:
+    """
+    按内容哈希缓存的校验结果和文档内容（用于增量编辑的基准），按内容总大小LRU淘汰
+    """
+
+    def __init__(self, max_bytes=VALIDATE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # 哈希 -> (文本, 校验结果)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest):
+        """返回 (文本, 校验结果)，只缓存了内容尚未校验时校验结果为None"""
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return entry
+
+    def put(self, digest, text, result=None):
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                self._entries.move_to_end(digest)
+                if result is not None:
+                    self._entries[digest] = (entry[0], result)
+                return
+            self._entries[digest] = (text, result)
+            self._bytes += len(text)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, (old_text, _) = self._entries.popitem(last=False)
+                self._bytes -= len(old_text)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+validation_cache = YAMLValidationCache()
+
+async def validate_yaml_cached(text, digest=None):
+    """校验YAML文本，相同内容直接返回缓存结果；返回 (哈希, 结果, 是否命中缓存)"""
+    digest = digest or await io_pool.run(content_hash, text)
+    entry = validation_cache.get(digest)
+    if entry is not None and entry[1] is not None:
+        return digest, entry[1], True
+    started = time.perf_counter()
+    result = await cpu_pool.run(validate_yaml_text, text)
+    yaml_parse_seconds.observe(time.perf_counter() - started)
+    validation_cache.put(digest, text, result)
+    return digest, result, False
+
+# 文件内容的ETag（内容哈希），按mtime和大小缓存，未变化的文件不必重新读取和计算
+_file_digests = {}  # 系统路径 -> (mtime_ns, 大小, 内容哈希)
+
+def content_etag(digest):
+    return f'"{digest}"'
+
+def remember_file_content(sys_file_path, text, digest):
+    """记录刚写入或读取的文件内容，供后续的增量保存作为基准"""
+    if "\r" in text:
+        # 与以文本模式重新读取文件时的换行符转换保持一致
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+        digest = content_hash(text)
+    st = os.stat(sys_file_path)
+    _file_digests[sys_file_path] = (st.st_mtime_ns, st.st_size, digest)
+    validation_cache.put(digest, text)
+    return digest
+
+def load_file_content(sys_file_path):
+    """读取文件内容，返回 (内容哈希, 文本)；文件未变化且内容仍在缓存中时不读取磁盘"""
+    st = os.stat(sys_file_path)
+    cached = _file_digests.get(sys_file_path)
+    if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+        entry = validation_cache.get(cached[2])
+        if entry is not None:
+            return cached[2], entry[0]
+    text = read_text_file(sys_file_path)
+    return remember_file_content(sys_file_path, text, content_hash(text)), text
+
+_file_locks = weakref.WeakValueDictionary()  # 系统路径 -> asyncio.Lock
+
+def file_lock(sys_file_path):
+    """同一文件的写入串行执行，不同文件互不影响"""
+    lock = _file_locks.get(sys_file_path)
+    if lock is None:
+        lock = asyncio.Lock()
+        _file_locks[sys_file_path] = lock
+    return lock
+
+def yaml_error_detail(result):
+    """把校验结果中的第一个错误转换为接口返回的提示信息"""
+    error = result["diagnostics"][0]
+    detail = error["message"]
+    if error["line"] is not None:
+        detail += f"（第{error['line']}行，第{error['column']}列）"
+    return detail
+
+@app.post("/api/validate")
+async def validate_yaml(request: YAMLValidate, token: dict = Depends(verify_token)):
+    """校验YAML内容，可以只提交相对于上次校验内容（base_hash）的行级编辑"""
+    try:
+        if request.content is not None:
+            text = request.content
+        elif request.base_hash:
+            entry = validation_cache.get(request.base_hash)
+            if entry is None:
+                raise HTTPException(status_code=409, detail="基准内容已失效，请提交完整内容")
+            try:
+                text = await io_pool.run(apply_line_edits, entry[0], request.edits)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        else:
+            raise HTTPException(status_code=400, detail="请提供content或base_hash")
+
+        digest, result, cached = await validate_yaml_cached(text)
+        return {"hash": digest, "cached": cached, **result}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"服务器内部错误：{str(e)}")
+
+# 文件操作（单个文件接口和批量接口共用），出错时抛出HTTPException
+async def load_base_content(file_path, sys_file_path, base_etag):
+    """读取当前内容并与基准ETag比较，返回 (内容哈希, 文本)；文件已被修改时抛出409"""
+    try:
+        digest, text = await io_pool.run(load_file_content, sys_file_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"文件不存在：{file_path}")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="文件编码错误，请确保文件为UTF-8编码")
+    current_etag = content_etag(digest)
+    if not etag_matches(base_etag, current_etag):
+        raise HTTPException(
+            status_code=409,
+            detail="文件已被修改，请重新加载后再保存",
+            headers={"ETag": current_etag}
+        )
+    return digest, text
+
+async def read_workspace_file(file_path, sys_file_path):
+    """读取文件内容，返回 {"content", "etag"}"""
+    try:
+        digest, content = await io_pool.run(load_file_content, sys_file_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"文件不存在：{file_path}")
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="没有权限读取文件，请检查文件权限设置")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="文件编码错误，请确保文件为UTF-8编码")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"读取文件失败：{str(e)}")
+    
+    # ETag为内容哈希，增量保存时作为基准版本
+    return {"content": content, "etag": content_etag(digest)}
+
+async def _commit_file_content(file_path, sys_file_path, content, digest, journal):
+    """在文件锁内调用：记录历史版本并写入文件，返回 (历史版本信息, 内容哈希)；批量操作的历史版本在提交时才保存，此时返回None"""
+    if journal is not None:
+        await io_pool.run(journal.record_write, file_path, sys_file_path)
+        journal.record_history(file_path, content)
+        history_file = None
+    else:
+        # 保存历史文件
+        history_file = await io_pool.run(save_history_file, file_path, content)
+        if not history_file:
+            print("警告：历史文件保存失败")
+    
+    # 保存当前文件
+    try:
+        await io_pool.run(write_text_file, sys_file_path, content)
+        digest = await io_pool.run(remember_file_content, sys_file_path, content, digest)
+        change_feed.publish("modified", file_path, etag=content_etag(digest))
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="没有权限保存文件，请检查文件权限设置")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"保存文件失败：{str(e)}")
+    return history_file, digest
+
+async def write_workspace_file(file_path, sys_file_path, content, base_etag=None, journal=None):
+    """校验并保存文件内容，提供base_etag时只在文件未被修改时保存；返回 {"history_file", "etag"}"""
+    # 验证YAML格式
+    digest, result, _ = await validate_yaml_cached(content)
+    if not result["valid"]:
+        raise HTTPException(status_code=400, detail=yaml_error_detail(result))
+    
+    # 确保目录存在
+    try:
+        await io_pool.run(os.makedirs, os.path.dirname(sys_file_path), exist_ok=True)
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="没有权限创建目录，请检查文件权限设置")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"创建目录失败：{str(e)}")
+    
+    async with file_lock(sys_file_path):
+        if base_etag:
+            await load_base_content(file_path, sys_file_path, base_etag)
+        history_file, digest = await _commit_file_content(file_path, sys_file_path, content, digest, journal)
+    await io_pool.run(tree_index.refresh, file_path)
+    return {"history_file": history_file, "etag": content_etag(digest)}
+
+async def patch_workspace_file(file_path, sys_file_path, base_etag, diff=None, edits=None, journal=None):
+    """把统一diff或行级编辑应用到基准版本上并保存；返回 {"changed", "history_file", "etag"}"""
+    if (diff is None) == (edits is None):
+        raise HTTPException(status_code=400, detail="请提供diff或edits其中之一")
+    
+    async with file_lock(sys_file_path):
+        digest, text = await load_base_content(file_path, sys_file_path, base_etag)
+        try:
+            if diff is not None:
+                new_text = await io_pool.run(apply_unified_diff, text, diff)
+            else:
+                new_text = await io_pool.run(apply_line_edits, text, edits)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"补丁无法应用：{str(e)}")
+        
+        if new_text == text:
+            return {"changed": False, "history_file": None, "etag": content_etag(digest)}
+        
+        # 验证YAML格式，未修改的部分复用缓存的校验结果
+        digest, result, _ = await validate_yaml_cached(new_text)
+        if not result["valid"]:
+            raise HTTPException(status_code=400, detail=yaml_error_detail(result))
+        history_file, digest = await _commit_file_content(file_path, sys_file_path, new_text, digest, journal)
+    await io_pool.run(tree_index.refresh, file_path)
+    return {"changed": True, "history_file": history_file, "etag": content_etag(digest)}
+
+def trash_dir():
+    return os.path.join(tree_index.root, TRASH_DIR)
+
+def move_to_trash(sys_path):
+    """把文件或目录移入工作区的回收目录（同一文件系统内只需一次rename），跨设备时返回None"""
+    target = os.path.join(trash_dir(), uuid.uuid4().hex)
+    try:
+        move_path(sys_path, target, copy_fallback=False)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        return None
+    return target
+
+def purge_path(sys_path, job=None):
+    """自底向上逐个删除，每删除一项更新进度并检查是否已取消"""
+    if not os.path.isdir(sys_path) or os.path.islink(sys_path):
+        os.remove(sys_path)
+        if job is not None:
+            job.advance()
+        return
+    for dirpath, dirnames, filenames in os.walk(sys_path, topdown=False):
+        for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+            if job is not None:
+                job.check_cancelled()
+            os.remove(os.path.join(dirpath, name))
+            if job is not None:
+                job.advance()
+        os.rmdir(dirpath)
+        if job is not None:
+            job.advance()
+
+def count_entries(sys_path):
+    """purge_path要删除的项数（用于进度）"""
+    if not os.path.isdir(sys_path) or os.path.islink(sys_path):
+        return 1
+    return sum(
+        1 + len(filenames) + sum(1 for d in dirnames if os.path.islink(os.path.join(dirpath, d)))
+        for dirpath, dirnames, filenames in os.walk(sys_path)
+    )
+
+def remove_if_exists(sys_path):
+    if os.path.lexists(sys_path):
+        remove_path(sys_path)
+
+async def delete_workspace_path(file_path, sys_file_path, journal=None, job=None):
+    """
+    删除文件或目录；在批量事务中移入回收目录，提交时才真正删除
+    否则先整体移入回收目录（路径立即消失，目录树索引只需刷新一次），再逐项删除回收目录中的内容
+    """
+    if not file_path:
+        raise HTTPException(status_code=400, detail="不能删除工作目录")
+    try:
+        async with file_lock(sys_file_path):
+            if journal is not None:
+                await io_pool.run(journal.trash, file_path, sys_file_path)
+            else:
+                if not await io_pool.run(os.path.lexists, sys_file_path):
+                    raise FileNotFoundError(sys_file_path)
+                trashed = await io_pool.run(move_to_trash, sys_file_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"要删除的文件或目录不存在：{file_path}")
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="没有权限删除文件或目录，请检查权限设置")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"删除失败：{str(e)}")
+    if journal is not None:
+        await io_pool.run(tree_index.refresh, file_path)
+        return {}
+
+    # 跨设备（源在挂载到工作区内的其他文件系统上）时原地删除
+    purge_target = trashed or sys_file_path
+    if job is not None:
+        job.total = await io_pool.run(count_entries, purge_target)
+        job.current = file_path
+    if trashed:
+        await io_pool.run(tree_index.refresh, file_path)
+    try:
+        await io_pool.run(purge_path, purge_target, job)
+    except JobCancelled:
+        # 取消时回收目录中尚未删除的内容放回原处
+        if trashed and not await io_pool.run(os.path.lexists, sys_file_path):
+            await io_pool.run(move_path, trashed, sys_file_path)
+        raise
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="没有权限删除文件或目录，请检查权限设置")
+    finally:
+        if not trashed or (job is not None and job.cancelled):
+            await io_pool.run(tree_index.refresh, file_path)
+    return {"path": file_path, "deleted": job.done if job is not None else None}
+
+async def copy_tree(sys_source_path, sys_target_path, job=None):
+    """
+    复制文件或目录：先创建全部目录，再把文件分成复制块在IO池中并行复制，
+    同时进行的复制块不超过COPY_PARALLEL；失败或取消时删除已复制的内容
+    """
+    dirs, files, total = await io_pool.run(plan_copy, sys_source_path)
+    if job is not None:
+        job.total = max(total, 1)
+
+    def make_dirs():
+        if dirs or os.path.isdir(sys_source_path):
+            os.makedirs(sys_target_path)
+        else:
+            os.makedirs(os.path.dirname(sys_target_path), exist_ok=True)
+        for rel_dir in sorted(dirs):
+            os.makedirs(os.path.join(sys_target_path, system_path(rel_dir)), exist_ok=True)
+
+    await io_pool.run(make_dirs)
+    chunks = copy_chunks(files)
+    pending = set()
+    try:
+        while True:
+            while len(pending) < max(1, COPY_PARALLEL) and not (job is not None and job.cancelled):
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.add(asyncio.ensure_future(io_pool.run(copy_files, sys_source_path, sys_target_path, chunk, job)))
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        if job is not None:
+            job.check_cancelled()
+            if total == 0:
+                job.done = job.total
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        await io_pool.run(remove_if_exists, sys_target_path)
+        raise
+    return total
+
+def check_transfer(source_path, sys_source_path, target_path, sys_target_path):
+    """
+    移动/复制前的检查：目标是已存在的目录时移动到该目录下（与mv相同），
+    返回最终的 (目标相对路径, 目标系统路径, 源是否目录)
+    """
+    if not source_path:
+        raise HTTPException(status_code=400, detail="不能移动或复制工作目录本身")
+    if not os.path.lexists(sys_source_path):
+        raise HTTPException(status_code=404, detail="源文件不存在")
+    if os.path.isdir(sys_target_path) and not os.path.islink(sys_target_path) and target_path != source_path:
+        name = posixpath.basename(source_path)
+        target_path = f"{target_path}/{name}" if target_path else name
+        sys_target_path = os.path.join(sys_target_path, system_path(name))
+    if target_path == source_path or target_path.startswith(source_path + "/"):
+        raise HTTPException(status_code=400, detail="不能移动或复制到自身或其子目录中")
+    is_dir = os.path.isdir(sys_source_path) and not os.path.islink(sys_source_path)
+    if os.path.lexists(sys_target_path) and (is_dir or os.path.isdir(sys_target_path)):
+        raise HTTPException(status_code=409, detail=f"目标已存在：{target_path}")
+    return target_path, sys_target_path, is_dir
+
+async def move_workspace_path(source_path, sys_source_path, target_path, sys_target_path, journal=None, job=None):
+    """
+    移动文件或目录：同一文件系统内用一次os.rename完成，跨设备时并行复制后删除源；
+    目录树索引和历史版本清单随后各改写一次，历史跟随文件移动
+    """
+    target_path, sys_target_path, is_dir = await io_pool.run(
+        check_transfer, source_path, sys_source_path, target_path, sys_target_path
+    )
+    change_feed.announce_move(source_path, target_path)
+    mode = "rename"
+    try:
+        await io_pool.run(move_path, sys_source_path, sys_target_path, False)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        mode = "copy"
+        await copy_tree(sys_source_path, sys_target_path, job)
+        if job is not None:
+            job.committed = True
+        await io_pool.run(remove_path, sys_source_path)
+    if job is not None:
+        job.committed = True
+        if mode == "rename":
+            job.total = job.done = 1
+    if journal is not None:
+        journal.record_move(source_path, sys_source_path, target_path, sys_target_path)
+    await io_pool.run(tree_index.move, source_path, target_path)
+    history_moved = await io_pool.run(history_store.move, source_path, target_path, is_dir)
+    return {"source": source_path, "target": target_path, "mode": mode, "history_moved": history_moved}
+
+async def copy_workspace_path(source_path, sys_source_path, target_path, sys_target_path, job=None):
+    """复制文件或目录（不复制历史版本）"""
+    target_path, sys_target_path, _ = await io_pool.run(
+        check_transfer, source_path, sys_source_path, target_path, sys_target_path
+    )
+    if await io_pool.run(os.path.lexists, sys_target_path):
+        raise HTTPException(status_code=409, detail=f"目标已存在：{target_path}")
+    copied = await copy_tree(sys_source_path, sys_target_path, job)
+    await io_pool.run(tree_index.refresh, target_path)
+    return {"source": source_path, "target": target_path, "bytes": copied}
+
+@app.get("/api/file/{file_path:path}")
+async def read_file(file_path: str, token: dict = Depends(verify_token)):
+    """读取文件内容"""
+    try:
+        # 规范化路径并验证文件是否在工作目录内
+        file_path, sys_file_path = resolve_workspace_path(file_path)
+        
+        result = await read_workspace_file(file_path, sys_file_path)
+        return JSONResponse(content=result, headers={"ETag": result["etag"]})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"服务器内部错误：{str(e)}")
+
+@app.get("/api/raw/{file_path:path}")
+async def read_file_raw(file_path: str, request: Request, token: dict = Depends(verify_token)):
+    """以原始字节流读取文件，支持条件请求、Range分段和gzip/brotli压缩"""
+    # 规范化路径并验证文件是否在工作目录内
+    file_path, sys_file_path = resolve_workspace_path(file_path)
+    
+    try:
+        f = await io_pool.run(open, sys_file_path, 'rb')
+    except (FileNotFoundError, IsADirectoryError):
+        raise HTTPException(status_code=404, detail=f"文件不存在：{file_path}")
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="没有权限读取文件，请检查文件权限设置")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"读取文件失败：{str(e)}")
     
     try:
-        if not search:
-            # 获取完整目录结构
-            files = get_directory_structure(sys_workspace_dir, sys_workspace_dir)
-            return files
+        st = await io_pool.run(os.fstat, f.fileno())
+        size = st.st_size
+        etag = file_etag(st)
+        headers = {
+            "ETag": etag,
+            "Last-Modified": email.utils.formatdate(st.st_mtime, usegmt=True),
+            "Accept-Ranges": "bytes",
+            "Cache-Control": "no-cache"
+        }
+        media_type = "application/yaml; charset=utf-8"
+        
+        if is_not_modified(request, etag, st.st_mtime):
+            await io_pool.run(f.close)
+            return Response(status_code=304, headers=headers)
+        
+        # Range请求（If-Range不匹配时返回完整内容）
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        if range_header and (not if_range or etag_matches(if_range, etag)):
+            byte_range = parse_range_header(range_header, size)
+            if byte_range is None:
+                await io_pool.run(f.close)
+                return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+            if byte_range != "ignore":
+                start, end = byte_range
+                await io_pool.run(f.seek, start)
+                headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+                headers["Content-Length"] = str(end - start + 1)
+                return StreamingResponse(
+                    iter_file_chunks(f, end - start + 1), status_code=206, headers=headers, media_type=media_type
+                )
+        
+        encoding = None
+        if RAW_COMPRESSION and size >= RAW_COMPRESS_MIN_SIZE:
+            encoding = choose_content_encoding(request.headers.get("accept-encoding", ""))
+        if encoding:
+            headers["Content-Encoding"] = encoding
+            headers["Vary"] = "Accept-Encoding"
+            headers["ETag"] = "W/" + etag
+            return StreamingResponse(compress_chunks(iter_file_chunks(f), encoding), headers=headers, media_type=media_type)
+        
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(iter_file_chunks(f, size), headers=headers, media_type=media_type)
+    except Exception as e:
+        await io_pool.run(f.close)
+        raise HTTPException(status_code=500, detail=f"读取文件失败：{str(e)}")
+
+@app.get("/api/lines/{file_path:path}")
+async def read_file_lines_page(
+    file_path: str,
+    request: Request,
+    start: int = 1,
+    count: int = 1000,
+    token: dict = Depends(verify_token)
+):
+    """按行分页读取文件（行号从1开始），用于编辑器渐进加载大文件"""
+    try:
+        # 规范化路径并验证文件是否在工作目录内
+        file_path, sys_file_path = resolve_workspace_path(file_path)
+        
+        if start < 1 or count < 1:
+            raise HTTPException(status_code=400, detail="start和count必须为正整数")
+        count = min(count, LINES_MAX_PAGE)
+        
+        try:
+            index, data = await io_pool.run(read_file_lines, sys_file_path, start, count)
+            content = data.decode("utf-8")
+        except (FileNotFoundError, IsADirectoryError):
+            raise HTTPException(status_code=404, detail=f"文件不存在：{file_path}")
+        except PermissionError:
+            raise HTTPException(status_code=403, detail="没有权限读取文件，请检查文件权限设置")
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=400, detail="文件编码错误，请确保文件为UTF-8编码")
+        
+        etag = make_etag(index.mtime_ns, index.size)
+        returned = content.count("\n") + (1 if content and not content.endswith("\n") else 0)
+        end = start + returned - 1
+        return JSONResponse(
+            content={
+                "start": start,
+                "end": end,
+                "total_lines": index.total_lines,
+                "eof": end >= index.total_lines,
+                "content": content
+            },
+            headers={"ETag": etag, "Cache-Control": "no-cache"}
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"服务器内部错误：{str(e)}")
+
+# YAML结构化查询
+QUERY_CACHE_BYTES = int(os.getenv("QUERY_CACHE_BYTES", str(256 * 1024 * 1024)))  # 解析后文档缓存的内存上限（估算值，字节）
+QUERY_DEFAULT_LIMIT = 1000
+QUERY_MAX_LIMIT = 100000
+QUERY_MAX_DEPTH = 64  # 递归查找的最大深度，防止自引用的锚点形成死循环
+
+_QUERY_SIMPLE_KEY = re.compile(r'^[A-Za-z_][\w-]*$')
+_QUERY_FILTER = re.compile(r'^(?:@\.?)?(?P<key>[^=!~\s]*)\s*(?:(?P<op>==|=|!=|~=)\s*(?P<value>.*?))?$')
+
+def _unquote(text):
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in "'\"":
+        return text[1:-1]
+    return text
+
+def _read_query_name(expr, i):
+    end = i
+    while end < len(expr) and expr[end] not in ".[":
+        end += 1
+    if end == i:
+        raise ValueError(f"查询表达式不完整（位置 {i + 1}）")
+    return expr[i:end], end
+
+def _query_bracket_end(expr, i):
+    quote = None
+    for j in range(i + 1, len(expr)):
+        c = expr[j]
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in "'\"":
+            quote = c
+        elif c == "]":
+            return j
+    raise ValueError("查询表达式缺少 ]")
+
+def _parse_query_bracket(content):
+    if content == "*":
+        return ("wildcard",)
+    if content.startswith("?"):
+        condition = content[1:].strip()
+        if condition.startswith("(") and condition.endswith(")"):
+            condition = condition[1:-1].strip()
+        match = _QUERY_FILTER.match(condition)
+        if not match:
+            raise ValueError(f"无法解析过滤条件：{content}")
+        key = tuple(part for part in match.group("key").split(".") if part)
+        op = match.group("op")
+        value = _unquote(match.group("value").strip()) if op else None
+        return ("filter", key, "=" if op == "==" else op, value)
+    if re.fullmatch(r'-?\d+', content):
+        return ("index", int(content))
+    match = re.fullmatch(r'(-?\d*):(-?\d*)', content)
+    if match:
+        start, stop = match.groups()
+        return ("slice", int(start) if start else None, int(stop) if stop else None)
+    return ("key", _unquote(content))
+
+@functools.lru_cache(maxsize=256)
+def parse_query(expr):
+    """
+    把查询表达式解析为步骤元组，支持JSONPath的常用子集：
+    $ 根；a.b 键；['a.b'] 含特殊字符的键；[0] [-1] 下标；[1:3] 切片；* 或 [*] 通配；
+    ..name 递归查找；[?name=HK] 或 [?(@.name == 'HK')] 按子键过滤（=、!=、~= 包含，不写运算符表示键存在）
+    """
+    expr = expr.strip()
+    if expr.startswith("$"):
+        expr = expr[1:]
+    steps = []
+    i = 0
+    while i < len(expr):
+        if expr.startswith("..", i):
+            i += 2
+            if i < len(expr) and expr[i] == "[":
+                steps.append(("descend", None))
+                continue
+            name, i = _read_query_name(expr, i)
+            steps.append(("descend", None if name == "*" else name))
+        elif expr[i] == ".":
+            name, i = _read_query_name(expr, i + 1)
+            steps.append(("wildcard",) if name == "*" else ("key", name))
+        elif expr[i] == "[":
+            end = _query_bracket_end(expr, i)
+            steps.append(_parse_query_bracket(expr[i + 1:end].strip()))
+            i = end + 1
+        elif i == 0:
+            # 开头的键名可以省略点
+            name, i = _read_query_name(expr, i)
+            steps.append(("wildcard",) if name == "*" else ("key", name))
+        else:
+            raise ValueError(f"无法解析查询表达式（位置 {i + 1}）")
+    return tuple(steps)
+
+def format_query_path(path):
+    """路径在查询过程中以 (父路径, 键) 的链表形式保存，只为返回的结果拼接成字符串"""
+    keys = []
+    while path is not None:
+        path, key = path
+        keys.append(key)
+    parts = ["$"]
+    for key in reversed(keys):
+        if isinstance(key, int):
+            parts.append(f"[{key}]")
+        elif _QUERY_SIMPLE_KEY.match(str(key)):
+            parts.append(f".{key}")
+        else:
+            parts.append(f"['{key}']")
+    return "".join(parts)
+
+def _children(path, node):
+    if isinstance(node, dict):
+        return [((path, key), value) for key, value in node.items()]
+    if isinstance(node, list):
+        return [((path, index), value) for index, value in enumerate(node)]
+    return []
+
+def _scalar_text(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if value is None:
+        return "null"
+    return str(value)
+
+def _filter_accepts(node, key, op, value):
+    for part in key:
+        if not isinstance(node, dict) or part not in node:
+            return False
+        node = node[part]
+    if op is None:
+        return True
+    if isinstance(node, (dict, list)):
+        return False
+    text = _scalar_text(node)
+    if op == "=":
+        return text == value
+    if op == "!=":
+        return text != value
+    return value.lower() in text.lower()
+
+def _descend(path, node, name, matched):
+    """深度优先遍历节点自身及其所有子孙；name为None时收集全部节点，否则收集名为name的子键"""
+    stack = [(path, node, 0)]
+    while stack:
+        path, node, depth = stack.pop()
+        if name is None:
+            matched.append((path, node))
+        elif isinstance(node, dict) and name in node:
+            matched.append(((path, name), node[name]))
+        if depth < QUERY_MAX_DEPTH and isinstance(node, (dict, list)):
+            children = node.items() if isinstance(node, dict) else enumerate(node)
+            stack.extend(
+                ((path, key), child, depth + 1) for key, child in reversed(list(children))
+                if isinstance(child, (dict, list)) or name is None
+            )
+
+def run_query(document, steps, limit):
+    """在解析后的文档上执行查询，返回 (匹配总数, [(路径, 值)]) ，最多返回limit个"""
+    current = [(None, document)]
+    for step in steps:
+        kind = step[0]
+        matched = []
+        for path, node in current:
+            if kind == "key":
+                if isinstance(node, dict) and step[1] in node:
+                    matched.append(((path, step[1]), node[step[1]]))
+                elif isinstance(node, list) and step[1].isdigit() and int(step[1]) < len(node):
+                    matched.append(((path, int(step[1])), node[int(step[1])]))
+            elif kind == "index":
+                if isinstance(node, list) and -len(node) <= step[1] < len(node):
+                    index = step[1] % len(node)
+                    matched.append(((path, index), node[index]))
+            elif kind == "slice":
+                if isinstance(node, list):
+                    for index in range(*slice(step[1], step[2]).indices(len(node))):
+                        matched.append(((path, index), node[index]))
+            elif kind == "wildcard":
+                matched.extend(_children(path, node))
+            elif kind == "filter":
+                matched.extend(
+                    (child_path, child) for child_path, child in _children(path, node)
+                    if _filter_accepts(child, *step[1:])
+                )
+            elif kind == "descend":
+                _descend(path, node, step[1], matched)
+        current = matched
+    return len(current), [(format_query_path(path), value) for path, value in current[:limit]]
+
+def estimate_object_size(obj):
+    """粗略估算解析后的对象占用的内存（字节），锚点引用的共享对象只计一次"""
+    seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set)):
+            stack.extend(item)
+    return total
+
+def parse_yaml_document(sys_file_path):
+    """读取并解析YAML文件，返回 ((mtime, 大小), 文档, 估算的内存占用)"""
+    with open(sys_file_path, 'r', encoding='utf-8') as f:
+        st = os.fstat(f.fileno())
+        text = f.read()
+    file_read_bytes.inc(st.st_size)
+    document = yaml.load(text, Loader=YAMLLoader)
+    return (st.st_mtime_ns, st.st_size), document, estimate_object_size(document)
+
+class YAMLDocumentCache:
+    """
+    解析后的YAML文档缓存，按 (mtime, 大小) 判断是否过期，
+    按估算的内存占用做LRU淘汰，重复查询同一个大文件时不必重新读取和解析
+    """
+
+    def __init__(self, max_bytes=QUERY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # 系统路径 -> ((mtime, 大小), 文档, 内存占用)
+        self._bytes = 0
+        self._loading = {}  # (系统路径, (mtime, 大小)) -> Future，同一文件并发未命中时只解析一次
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, sys_file_path, stat_key):
+        """返回 (是否命中, 文档)"""
+        with self._lock:
+            entry = self._entries.get(sys_file_path)
+            if entry is None or entry[0] != stat_key:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(sys_file_path)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, sys_file_path, stat_key, document, cost):
+        with self._lock:
+            old = self._entries.pop(sys_file_path, None)
+            if old is not None:
+                self._bytes -= old[2]
+            if cost > self.max_bytes:
+                return
+            self._entries[sys_file_path] = (stat_key, document, cost)
+            self._bytes += cost
+            while self._bytes > self.max_bytes:
+                _, (_, _, old_cost) = self._entries.popitem(last=False)
+                self._bytes -= old_cost
+
+    async def load(self, sys_file_path, stat_key):
+        """解析文件并放入缓存，返回 ((mtime, 大小), 文档)"""
+        loading_key = (sys_file_path, stat_key)
+        future = self._loading.get(loading_key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self._loading[loading_key] = future
+        try:
+            actual_key, document, cost = await cpu_pool.run(parse_yaml_document, sys_file_path)
+            self.put(sys_file_path, actual_key, document, cost)
+            future.set_result((actual_key, document))
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免"exception was never retrieved"警告
+            future.exception()
+            raise
+        finally:
+            del self._loading[loading_key]
+        return actual_key, document
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+
+document_cache = YAMLDocumentCache()
+
+def query_cached_document(sys_file_path, steps, limit):
+    """缓存命中时直接执行查询，返回 ((mtime, 大小), 查询结果或None)"""
+    st = os.stat(sys_file_path)
+    if not os.path.isfile(sys_file_path):
+        raise IsADirectoryError(sys_file_path)
+    stat_key = (st.st_mtime_ns, st.st_size)
+    hit, document = document_cache.get(sys_file_path, stat_key)
+    if not hit:
+        return stat_key, None
+    return stat_key, run_query(document, steps, limit)
+
+def render_query_matches(matches, output):
+    if output == "yaml":
+        return [
+            {"path": path, "yaml": yaml.dump(value, allow_unicode=True, sort_keys=False, default_flow_style=False)}
+            for path, value in matches
+        ]
+    return [{"path": path, "value": value} for path, value in matches]
+
+@app.get("/api/query/{file_path:path}")
+async def query_yaml_file(
+    file_path: str,
+    request: Request,
+    q: str = "$",
+    limit: int = QUERY_DEFAULT_LIMIT,
+    output: str = "json",
+    token: dict = Depends(verify_token)
+):
+    """
+    在服务端对YAML文件执行结构化查询，只返回匹配的子树
+    例如 q=proxy-groups[?name=auto].proxies 或 q=..server；output=yaml 时每个结果附带YAML文本
+    """
+    try:
+        # 规范化路径并验证文件是否在工作目录内
+        file_path, sys_file_path = resolve_workspace_path(file_path)
+        
+        if output not in ("json", "yaml"):
+            raise HTTPException(status_code=400, detail="output只支持json或yaml")
+        limit = max(1, min(limit, QUERY_MAX_LIMIT))
+        try:
+            steps = parse_query(q)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"查询表达式错误：{e}")
+        
+        try:
+            stat_key, result = await io_pool.run(query_cached_document, sys_file_path, steps, limit)
+            if result is None:
+                stat_key, document = await document_cache.load(sys_file_path, stat_key)
+                result = await io_pool.run(run_query, document, steps, limit)
+        except (FileNotFoundError, IsADirectoryError):
+            raise HTTPException(status_code=404, detail=f"文件不存在：{file_path}")
+        except PermissionError:
+            raise HTTPException(status_code=403, detail="没有权限读取文件，请检查文件权限设置")
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=400, detail="文件编码错误，请确保文件为UTF-8编码")
+        except yaml.YAMLError as e:
+            raise HTTPException(status_code=400, detail=format_yaml_error(str(e)))
+        
+        etag = make_etag(*stat_key)
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        
+        total, matches = result
+        items = await io_pool.run(render_query_matches, matches, output)
+        return JSONResponse(
+            content=jsonable_encoder({
+                "query": q,
+                "total": total,
+                "truncated": total > len(matches),
+                "matches": items
+            }),
+            headers={"ETag": etag, "Cache-Control": "no-cache"}
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"服务器内部错误：{str(e)}")
+
+# YAML格式化
+FORMAT_CACHE_BYTES = int(os.getenv("FORMAT_CACHE_BYTES", str(64 * 1024 * 1024)))  # 格式化结果缓存的内容总大小上限（字节）
+FORMAT_MAX_PENDING_LINES = 10000  # 等待决定缩进的连续注释/空行上限，超出后按原缩进输出
+
+_FORMAT_SEQ_ITEM = re.compile(r'-(?:[ \t]+|$)')
+_FORMAT_KEY_SPACING = re.compile(
+    r'^((?:[^\s#\'"{\[\]},&*!|>%@`?:-]|[?:-](?=\S))[^#\n]*?|"(?:[^"\\]|\\.)*"|\'(?:[^\']|\'\')*\'):[ \t]{2,}(?=\S)'
+)
+_FORMAT_OPENS_BLOCK = re.compile(r'(?:^|:)(?:[ \t]+[&!]\S*)*$')
+_FORMAT_BLOCK_SCALAR = re.compile(r'(?:^|[ \t])[|>][0-9+-]{0,2}$')
+_FORMAT_FLOW_CHARS = re.compile(r'[\[{\'"]')
+_FORMAT_BARE_BLOCK_SCALAR = re.compile(r'(?:[&!]\S*[ \t]+)*[|>]')
+
+def _scan_flow(text, depth=0, quote=None):
+    """
+    扫描一行（不含缩进），返回行尾仍未闭合的流式集合深度和引号，
+    用于识别跨多行的 [..] / {..} 和多行引号字符串
+    """
+    if not depth and not quote and not _FORMAT_FLOW_CHARS.search(text):
+        return 0, None
+    i = 0
+    n = len(text)
+    value_start = True  # 当前位置可以开始一个新的键或值
+    while i < n:
+        c = text[i]
+        if quote == "'":
+            j = text.find("'", i)
+            if j < 0:
+                return depth, quote
+            if text.startswith("''", j):
+                i = j + 2
+                continue
+            quote = None
+            i = j + 1
+            value_start = False
+            continue
+        if quote == '"':
+            j = i
+            while j < n and text[j] != '"':
+                j += 2 if text[j] == "\\" else 1
+            if j >= n:
+                return depth, quote
+            quote = None
+            i = j + 1
+            value_start = False
+            continue
+        if c in " \t":
+            i += 1
+            continue
+        if c == "#" and (i == 0 or text[i - 1] in " \t"):
+            break
+        if value_start and c in "'\"":
+            quote = c
+            i += 1
+            continue
+        if value_start and c in "&!":
+            # 锚点或标签，之后仍是值的开始
+            while i < n and text[i] not in " \t":
+                i += 1
+            continue
+        if depth == 0:
+            if value_start and c in "[{":
+                depth = 1
+                i += 1
+                continue
+            if value_start and c in "-?" and (i + 1 == n or text[i + 1] in " \t"):
+                i += 1
+                continue
+            # 普通标量：遇到 ": " 时后面是值，否则到行尾（或注释）为止
+            j = i
+            while j < n:
+                if text[j] == ":" and (j + 1 == n or text[j + 1] in " \t"):
+                    break
+                if text[j] == "#" and j > i and text[j - 1] in " \t":
+                    return depth, quote
+                j += 1
+            if j >= n:
+                return depth, quote
+            i = j + 1
+            value_start = True
+            continue
+        if c in "[{":
+            depth += 1
+            value_start = True
+        elif c in "]}":
+            depth -= 1
+            value_start = False
+        elif c == ",":
+            value_start = True
+        elif c == ":" and (i + 1 == n or text[i + 1] in " \t,[]{}"):
+            value_start = True
+        else:
+            value_start = False
+        i += 1
+    return depth, quote
+
+def _strip_comment(text):
+    """去掉行尾注释（引号内的 # 不算）"""
+    start = 0
+    while True:
+        pos = text.find("#", start)
+        if pos < 0:
+            return text
+        if (pos == 0 or text[pos - 1] in " \t") and not _scan_flow(text[:pos])[1]:
+            return text[:pos]
+        start = pos + 1
+
+class YAMLLineFormatter:
+    """
+    逐行流式处理的YAML格式化器，只调整空白而不重新生成文档，因此注释、锚点、引号风格和键顺序都原样保留：
+    - 块结构的缩进统一为indent个空格，序列项写作 "- "，"key:   value" 收紧为 "key: value"
+    - 去掉行尾空白和多余的连续空行，统一使用LF换行
+    - 块标量（| >）和跨行的流式集合、引号字符串整体平移，内容不变
+    indent_sequences为None时保持每个序列原有的缩进风格，True/False时统一为缩进/不缩进
+    给出start_line/end_line（从1开始）时只格式化该范围，范围末尾未结束的子块会一并处理，其余行原样输出
+    """
+
+    def __init__(self, indent=2, indent_sequences=None, max_blank_lines=1, start_line=None, end_line=None):
+        self.step = indent
+        self.indent_sequences = indent_sequences
+        self.max_blank_lines = max_blank_lines
+        self.ranged = start_line is not None or end_line is not None
+        self.start_line = start_line or 1
+        self.end_line = end_line
+        self.stack = []          # [原缩进, 新缩进, 是否只匹配序列项, 是否在格式化范围内]
+        self.pending = []        # 等待下一个内容行决定缩进的注释和空行：(原始行, 是否确定在范围内)
+        self.block = None        # 块标量：(父节点原缩进, 位移, 是否在范围内)
+        self.flow = None         # 跨行的流式集合或引号：(深度, 引号, 位移, 是否在范围内)
+        self.opened_at = None    # 上一个内容行以 "key:" 结尾时该键的原缩进
+        self.blank_run = 0
+        self.seen_content = False
+        self.lineno = 0
+        self.extending = True    # 范围之后的行是否仍可能属于范围内的块
+        self.last_line = 0
+        self.changed_lines = 0
+
+    def stats(self):
+        return {
+            "changed_lines": self.changed_lines,
+            "start_line": self.start_line if self.ranged else 1,
+            "end_line": self.last_line,
+        }
+
+    def _in_range(self, lineno):
+        if not self.ranged:
+            return True
+        return lineno >= self.start_line and (self.end_line is None or lineno <= self.end_line)
+
+    def _emit(self, raw, text):
+        """输出一行，text为None时原样输出"""
+        if text is None:
+            return raw
+        if text != raw.rstrip("\r\n"):
+            self.changed_lines += 1
+        self.last_line = max(self.last_line, self.lineno)
+        return text + "\n"
+
+    def _flush_pending(self, orig=None, new=None, in_range=False):
+        output = []
+        shift = 0 if orig is None else new - orig
+        for raw, definite in self.pending:
+            if not (definite or in_range):
+                self.blank_run = 0
+                output.append(raw)
+                continue
+            body = raw.rstrip("\r\n")
+            stripped = body.strip()
+            if not stripped:
+                self.blank_run += 1
+                if (not self.ranged and (not self.seen_content or orig is None)) or self.blank_run > self.max_blank_lines:
+                    # 文档开头、末尾和超出上限的空行直接删除
+                    self.changed_lines += 1
+                    continue
+                output.append(self._emit(raw, ""))
+            else:
+                self.blank_run = 0
+                comment_indent = len(body) - len(body.lstrip(" "))
+                comment_indent = 0 if comment_indent == 0 else max(0, comment_indent + shift)
+                output.append(self._emit(raw, " " * comment_indent + stripped))
+        self.pending = []
+        return output
+
+    def feed(self, raw):
+        """处理一行（含换行符），返回输出的行列表"""
+        self.lineno += 1
+        line = raw.rstrip("\r\n")
+
+        if self.block is not None:
+            parent, shift, in_range = self.block
+            indent = len(line) - len(line.lstrip(" "))
+            if not line.strip() or indent > parent:
+                if not in_range:
+                    return [raw]
+                if not line.strip():
+                    return [self._emit(raw, " " * max(0, len(line) + shift) if line else "")]
+                return [self._emit(raw, " " * (indent + shift) + line[indent:])]
+            self.block = None
+
+        if self.flow is not None:
+            depth, quote, shift, in_range = self.flow
+            depth, quote = _scan_flow(line.lstrip(" "), depth, quote)
+            self.flow = (depth, quote, shift, in_range) if depth > 0 or quote else None
+            if not in_range:
+                return [raw]
+            indent = len(line) - len(line.lstrip(" "))
+            return [self._emit(raw, " " * max(0, indent + shift) + line[indent:])]
+
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#"):
+            in_range = self._in_range(self.lineno)
+            if self.ranged and not in_range and (self.lineno < self.start_line or not self.extending):
+                return [raw]
+            self.pending.append((raw, in_range))
+            if len(self.pending) > FORMAT_MAX_PENDING_LINES:
+                return self._flush_pending()
+            return []
+
+        orig = len(line) - len(line.lstrip(" "))
+        body = line[orig:]
+        in_range = self._in_range(self.lineno)
+        is_marker = orig == 0 and (body.startswith("%") or (body[:3] in ("---", "...") and (len(body) == 3 or body[3] in " \t")))
+        is_seq = _FORMAT_SEQ_ITEM.match(body) is not None
+        if is_marker:
+            self.stack = []
+            new = 0
+        else:
+            while self.stack and (
+                self.stack[-1][0] > orig
+                or (self.stack[-1][0] == orig and self.stack[-1][2] and not is_seq)
+            ):
+                self.stack.pop()
+            top = self.stack[-1] if self.stack else None
+            if not in_range and self.extending and self.lineno > self.start_line and self.end_line is not None:
+                # 范围之后的行：父节点在范围内时一并处理，保证同一块内的兄弟节点缩进一致
+                if top is not None and top[0] == orig:
+                    parent = self.stack[-2] if len(self.stack) > 1 else None
+                else:
+                    parent = top
+                in_range = parent is not None and parent[3]
+                self.extending = in_range
+            if not in_range:
+                new = orig
+                if top is not None and top[0] == orig:
+                    self.stack[-1] = [orig, new, top[2], False]
+                else:
+                    self.stack.append([orig, new, False, False])
+            elif top is not None and top[0] == orig:
+                new = top[1]
+                parent_in_range, top[3] = top[3], True
+                if is_seq and self.indent_sequences is True and self.opened_at == orig and parent_in_range:
+                    # "key:" 下不缩进的序列改为缩进
+                    new = top[1] + self.step
+                    self.stack.append([orig, new, True, True])
+            elif top is not None:
+                if not top[3]:
+                    new = orig  # 父节点不在格式化范围内时保持原缩进，与范围外的兄弟节点对齐
+                elif is_seq and self.indent_sequences is False and self.opened_at == top[0]:
+                    new = top[1]
+                else:
+                    new = top[1] + self.step
+                self.stack.append([orig, new, False, True])
+            else:
+                new = orig if self.ranged else 0
+                self.stack.append([orig, new, False, True])
+
+        output = self._flush_pending(orig, new, in_range)
+        self.seen_content = True
+        self.blank_run = 0
+
+        # 拆出序列项的 "- " 前缀，项内的内容列作为子节点的对齐基准
+        prefix = ""
+        rest = body
+        col_orig, col_new = orig, new
+        dash_orig, dash_new = orig, new
+        while not is_marker:
+            match = _FORMAT_SEQ_ITEM.match(rest)
+            if match is None:
+                break
+            dash_orig, dash_new = col_orig, col_new
+            width = match.end()
+            rest = rest[width:]
+            if not rest or rest.startswith("#"):
+                prefix += "-" + (" " if rest else "")
+                break
+            col_orig += width
+            col_new += 2 if in_range else width
+            prefix += "- " if in_range else match.group(0)
+            self.stack.append([col_orig, col_new, False, in_range])
+
+        depth, quote = _scan_flow(rest)
+        if in_range:
+            if not quote:
+                rest = rest.rstrip()  # 多行引号字符串的行尾空白可能是转义内容，保持不变
+            if not is_marker and (":  " in rest or ":\t" in rest):
+                rest = _FORMAT_KEY_SPACING.sub(r"\1: ", rest, count=1)
+            text = " " * new + prefix + rest
+            output.append(self._emit(raw, text))
+        else:
+            output.append(raw)
+
+        # 记录这一行是否打开了块标量、跨行的流式集合或新的块
+        without_comment = _strip_comment(rest).rstrip()
+        if depth > 0 or quote:
+            self.flow = (depth, quote, col_new - col_orig if in_range else 0, in_range)
+        elif _FORMAT_BLOCK_SCALAR.search(without_comment):
+            if _FORMAT_BARE_BLOCK_SCALAR.match(without_comment):
+                parent, shift = dash_orig, dash_new - dash_orig  # "- |"：父节点是序列
+            else:
+                parent, shift = col_orig, col_new - col_orig
+            self.block = (parent if prefix or not is_marker else -1, shift if in_range else 0, in_range)
+        self.opened_at = col_orig if _FORMAT_OPENS_BLOCK.search(without_comment) else None
+        return output
+
+    def finish(self):
+        """输入结束，输出剩余的注释（文档末尾的空行被删除）"""
+        return self._flush_pending()
+
+    def run(self, lines):
+        for raw in lines:
+            yield from self.feed(raw)
+        yield from self.finish()
+
+def _event_signature(event):
+    return (
+        type(event),
+        getattr(event, "anchor", None),
+        getattr(event, "tag", None),
+        getattr(event, "value", None),
+        getattr(event, "implicit", None),
+    )
+
+def yaml_events_equal(a, b):
+    """
+    逐个比较两个YAML流（文本或文件对象）的解析事件，忽略位置和空白，
+    用于确认格式化没有改变文档数据；解析是流式的，内存占用与文档大小无关
+    """
+    events_a = yaml.parse(a, Loader=YAMLLoader)
+    events_b = yaml.parse(b, Loader=YAMLLoader)
+    for event_a, event_b in itertools.zip_longest(events_a, events_b):
+        if event_a is None or event_b is None or _event_signature(event_a) != _event_signature(event_b):
+            return False
+    return True
+
+def yaml_event_source(f):
+    """包装打开的文件供yaml.parse流式读取，错误信息中不出现系统路径"""
+    return types.SimpleNamespace(read=f.read)
+
+def check_yaml_syntax(stream):
+    """只解析事件、不构建文档地检查YAML语法，出错时抛出yaml.YAMLError"""
+    for _ in yaml.parse(stream, Loader=YAMLLoader):
+        pass
+
+class FormatOptions(BaseModel):
+    indent: int = 2
+    indent_sequences: Optional[bool] = None  # None：保持原有风格
+    max_blank_lines: int = 1
+    verify: bool = True                      # 用解析事件确认数据未改变
+
+class YAMLFormat(FormatOptions):
+    content: str
+    start_line: Optional[int] = None
+    end_line: Optional[int] = None
+
+class FileFormat(FormatOptions):
+    base_etag: Optional[str] = None
+    dry_run: bool = False
+
+def format_options(options):
+    if not 1 <= options.indent <= 8:
+        raise HTTPException(status_code=400, detail="indent必须在1到8之间")
+    if options.max_blank_lines < 0:
+        raise HTTPException(status_code=400, detail="max_blank_lines不能为负数")
+    return {"indent": options.indent, "indent_sequences": options.indent_sequences, "max_blank_lines": options.max_blank_lines}
+
+class FormatCache:
+    """按 (内容哈希, 格式化参数) 缓存格式化结果，按保存的文本总大小LRU淘汰"""
+
+    def __init__(self, max_bytes=FORMAT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # 键 -> (结果, 文本大小)
+        self._bytes = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, result):
+        size = len(result.get("content") or "")
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (result, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self._bytes -= old_size
+
+format_cache = FormatCache()
+
+def format_yaml_text(text, options, start_line=None, end_line=None, verify=True):
+    """格式化文本，返回 {"content", "changed", "changed_lines", "start_line", "end_line"}；验证失败时抛出ValueError"""
+    formatter = YAMLLineFormatter(start_line=start_line, end_line=end_line, **options)
+    content = "".join(formatter.run(text.splitlines(keepends=True)))
+    changed = content != text
+    if verify:
+        if not changed:
+            check_yaml_syntax(text)
+        elif not yaml_events_equal(text, content):
+            raise ValueError("格式化后的文档与原文档数据不一致，已取消")
+    return {"content": content, "changed": changed, **formatter.stats()}
+
+def format_yaml_file(sys_file_path, tmp_path, options, verify=True):
+    """
+    逐行读取文件并把格式化结果写入临时文件，内存占用与文件大小无关；
+    返回 {"source_hash", "hash", "changed", "changed_lines"}
+    """
+    formatter = YAMLLineFormatter(**options)
+    source_hash = hashlib.blake2b(digest_size=16)
+    result_hash = hashlib.blake2b(digest_size=16)
+
+    def source_lines(f):
+        for line in f:
+            source_hash.update(line.encode("utf-8"))
+            yield line
+
+    with open(sys_file_path, 'r', encoding='utf-8') as src, open(tmp_path, 'w', encoding='utf-8', newline='') as dst:
+        file_read_bytes.inc(os.fstat(src.fileno()).st_size)
+        for line in formatter.run(source_lines(src)):
+            result_hash.update(line.encode("utf-8"))
+            dst.write(line)
+    result = {
+        "source_hash": source_hash.hexdigest(),
+        "hash": result_hash.hexdigest(),
+        "changed_lines": formatter.changed_lines,
+    }
+    result["changed"] = result["hash"] != result["source_hash"]
+    if verify:
+        with open(sys_file_path, 'r', encoding='utf-8') as a, open(tmp_path, 'r', encoding='utf-8') as b:
+            if not result["changed"]:
+                check_yaml_syntax(yaml_event_source(a))
+            elif not yaml_events_equal(yaml_event_source(a), yaml_event_source(b)):
+                raise ValueError("格式化后的文档与原文档数据不一致，已取消")
+    return result
+
+@app.post("/api/format")
+async def format_yaml(request: YAMLFormat, token: dict = Depends(verify_token)):
+    """格式化YAML文本（保留注释、锚点和键顺序），可只格式化start_line~end_line范围"""
+    try:
+        options = format_options(request)
+        if request.start_line is not None and request.start_line < 1:
+            raise HTTPException(status_code=400, detail="start_line必须为正整数")
+        if request.start_line and request.end_line is not None and request.end_line < request.start_line:
+            raise HTTPException(status_code=400, detail="end_line不能小于start_line")
+        
+        digest = await io_pool.run(content_hash, request.content)
+        key = (digest, tuple(sorted(options.items())), request.start_line, request.end_line, request.verify)
+        result = format_cache.get(key)
+        cached = result is not None
+        if result is None:
+            try:
+                result = await cpu_pool.run(
+                    format_yaml_text, request.content, options, request.start_line, request.end_line, request.verify
+                )
+            except yaml.YAMLError as e:
+                raise HTTPException(status_code=400, detail=format_yaml_error(str(e)))
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=str(e))
+            result["hash"] = await io_pool.run(content_hash, result["content"]) if result["changed"] else digest
+            format_cache.put(key, result)
+        return {**result, "cached": cached}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"格式化失败：{str(e)}")
+
+@app.post("/api/format/{file_path:path}")
+async def format_file(file_path: str, request: FileFormat, token: dict = Depends(verify_token)):
+    """流式格式化工作区中的文件并保存（记录历史版本），dry_run时只返回会修改的行数"""
+    try:
+        # 规范化路径并验证文件是否在工作目录内
+        file_path, sys_file_path = resolve_workspace_path(file_path)
+        
+        options = format_options(request)
+        option_key = tuple(sorted(options.items()))
+        async with file_lock(sys_file_path):
+            # 内容哈希已知（文件读写过且未变化）并且上次格式化结果是"无需修改"时直接返回
+            try:
+                st = await io_pool.run(os.stat, sys_file_path)
+            except FileNotFoundError:
+                raise HTTPException(status_code=404, detail=f"文件不存在：{file_path}")
+            known = _file_digests.get(sys_file_path)
+            if known and known[:2] == (st.st_mtime_ns, st.st_size):
+                if request.base_etag and not etag_matches(request.base_etag, content_etag(known[2])):
+                    raise HTTPException(status_code=409, detail="文件已被修改，请重新加载后再保存", headers={"ETag": content_etag(known[2])})
+                cached = format_cache.get((known[2], option_key, "file"))
+                if cached is not None and not cached["changed"]:
+                    return {"changed": False, "changed_lines": 0, "etag": content_etag(known[2]), "cached": True}
+            
+            tmp_path = f"{sys_file_path}.{uuid.uuid4().hex}.format.tmp"
+            try:
+                try:
+                    result = await cpu_pool.run(format_yaml_file, sys_file_path, tmp_path, options, request.verify)
+                except FileNotFoundError:
+                    raise HTTPException(status_code=404, detail=f"文件不存在：{file_path}")
+                except PermissionError:
+                    raise HTTPException(status_code=403, detail="没有权限读取文件，请检查文件权限设置")
+                except UnicodeDecodeError:
+                    raise HTTPException(status_code=400, detail="文件编码错误，请确保文件为UTF-8编码")
+                except yaml.YAMLError as e:
+                    raise HTTPException(status_code=400, detail=format_yaml_error(str(e)))
+                except ValueError as e:
+                    raise HTTPException(status_code=422, detail=str(e))
+                
+                source_etag = content_etag(result["source_hash"])
+                if request.base_etag and not etag_matches(request.base_etag, source_etag):
+                    raise HTTPException(status_code=409, detail="文件已被修改，请重新加载后再保存", headers={"ETag": source_etag})
+                if request.verify:
+                    # 只缓存经过解析确认的结果，之后未修改的文件可以直接返回
+                    format_cache.put((result["source_hash"], option_key, "file"), {"changed": result["changed"]})
+                if not result["changed"] or request.dry_run:
+                    return {"changed": result["changed"], "changed_lines": result["changed_lines"], "etag": source_etag, "cached": False}
+                
+                # 历史版本需要完整内容，保存时读入格式化后的文本
+                content = await io_pool.run(read_text_file, tmp_path)
+                history_file, digest = await _commit_file_content(file_path, sys_file_path, content, result["hash"], None)
+                if request.verify:
+                    format_cache.put((digest, option_key, "file"), {"changed": False})
+            finally:
+                if os.path.exists(tmp_path):
+                    await io_pool.run(os.remove, tmp_path)
+        await io_pool.run(tree_index.refresh, file_path)
+        return {
+            "changed": True,
+            "changed_lines": result["changed_lines"],
+            "history_file": history_file,
+            "etag": content_etag(digest),
+            "cached": False
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"格式化失败：{str(e)}")
+
+# 后台任务
+JOB_HISTORY_SIZE = int(os.getenv("JOB_HISTORY_SIZE", "100"))  # 保留的已结束任务数
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    """后台任务的状态和进度，cancel()只设置标记，由任务在处理下一项前检查"""
+
+    def __init__(self, kind, params, workspace=DEFAULT_WORKSPACE):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.workspace = workspace
+        self.status = "pending"  # pending / running / completed / failed / cancelled
+        self.total = 0
+        self.done = 0
+        self.current = None      # 正在处理的文件
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._cancel_event = threading.Event()  # 线程池中执行的步骤也可以检查
+        self._progress_lock = threading.Lock()   # 多个线程可能同时更新进度
+        self.committed = False   # 已完成不可撤销的步骤，之后的取消请求不再影响结果
+        self._error = None
+        self._task = None
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    @property
+    def finished(self):
+        return self.status in ("completed", "failed", "cancelled")
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+
+    def advance(self, count=1, current=None):
+        with self._progress_lock:
+            self.done += count
+        if current is not None:
+            self.current = current
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "workspace": self.workspace,
+            "status": self.status,
+            "params": self.params,
+            "total": self.total,
+            "done": self.done,
+            "progress": round(self.done / self.total, 4) if self.total else (1.0 if self.finished else 0.0),
+            "current": self.current,
+            "cancel_requested": self.cancelled,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "result": self.result
+        }
+
+class JobManager:
+    """
+    在事件循环中运行后台任务并保留最近的任务状态，
+    相同key的任务正在运行时直接返回已有任务，不重复启动
+    任务属于提交时所在的工作区，运行期间该工作区不会被卸载
+    """
+
+    def __init__(self, history_size=JOB_HISTORY_SIZE):
+        self.history_size = history_size
+        self._jobs = collections.OrderedDict()  # 任务ID -> Job
+        self._active = {}                       # key -> 运行中的Job
+
+    def submit(self, kind, params, fn, key=None):
+        """创建任务并在后台执行 await fn(job)，fn的返回值作为任务结果"""
+        workspace = current_workspace()
+        if key is not None:
+            key = (workspace.name, key)
+            job = self._active.get(key)
+            if job is not None and not job.finished:
+                return job
+        job = Job(kind, params, workspace.name)
+        self._jobs[job.id] = job
+        if key is not None:
+            self._active[key] = job
+        self._prune()
+        workspace.hold()
+        # 任务在复制的上下文中运行，current_workspace() 仍指向提交时的工作区
+        job._task = asyncio.ensure_future(self._run(job, fn, key, workspace))
+        return job
+
+    async def _run(self, job, fn, key, workspace):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            job.result = await fn(job)
+            job.status = "cancelled" if job.cancelled and not job.committed else "completed"
+        except (JobCancelled, asyncio.CancelledError):
+            job.status = "cancelled"
+        except HTTPException as e:
+            job.status = "failed"
+            job.error = e.detail
+            job._error = e
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            print(f"后台任务失败（{job.kind}）: {e}")
+        finally:
+            job.finished_at = time.time()
+            job.current = None
+            workspace.release()
+            if key is not None and self._active.get(key) is job:
+                del self._active[key]
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(self._jobs) - self.history_size)]:
+            del self._jobs[job_id]
+
+    async def wait(self, job):
+        """
+        等待任务结束并返回结果，请求断开时任务继续在后台运行；
+        失败时抛出任务中的HTTPException（其他异常为500），被取消时返回409
+        """
+        await asyncio.shield(job._task)
+        if job.status == "failed":
+            raise job._error or HTTPException(status_code=500, detail=job.error)
+        if job.status == "cancelled":
+            raise HTTPException(status_code=409, detail="任务已取消")
+        return job.result
+
+    def get(self, job_id, workspace=None):
+        job = self._jobs.get(job_id)
+        if job is not None and workspace is not None and job.workspace != workspace:
+            return None
+        return job
+
+    def list(self, kind=None, workspace=None):
+        return [
+            job for job in reversed(self._jobs.values())
+            if (kind is None or job.kind == kind) and (workspace is None or job.workspace == workspace)
+        ]
+
+    def stats(self):
+        running = sum(1 for job in self._jobs.values() if not job.finished)
+        return {"jobs": len(self._jobs), "running": running}
+
+    async def shutdown(self):
+        tasks = []
+        for job in self._jobs.values():
+            if not job.finished:
+                job.cancel()
+                if job._task is not None:
+                    tasks.append(job._task)
+        if tasks:
+            await asyncio.wait(tasks, timeout=5)
+
+job_manager = JobManager()
+
+@app.on_event("shutdown")
+async def stop_jobs():
+    await job_manager.shutdown()
+
+@app.get("/api/jobs")
+async def list_jobs(kind: Optional[str] = None, token: dict = Depends(verify_token)):
+    """列出当前工作区最近的后台任务（新任务在前）"""
+    return {"jobs": [job.to_dict() for job in job_manager.list(kind, current_workspace().name)]}
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str, token: dict = Depends(verify_token)):
+    """获取后台任务的状态、进度和结果"""
+    job = job_manager.get(job_id, current_workspace().name)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    return job.to_dict()
+
+@app.post("/api/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str, token: dict = Depends(verify_token)):
+    """取消后台任务，正在处理的文件完成后停止"""
+    job = job_manager.get(job_id, current_workspace().name)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    if not job.finished:
+        job.cancel()
+    return job.to_dict()
+
+# 工作区批量校验
+VALIDATE_JOB_BATCH = int(os.getenv("VALIDATE_JOB_BATCH", "32"))  # 每次交给工作进程的文件数
+
+MIHOMO_TOP_KEYS = frozenset({
+    "proxies", "proxy-groups", "proxy-providers", "rule-providers", "rules", "sub-rules",
+    "port", "socks-port", "mixed-port", "redir-port", "tproxy-port", "mode", "dns", "tun",
+})
+MIHOMO_PROXY_TYPES = frozenset({
+    "ss", "ssr", "vmess", "vless", "trojan", "hysteria", "hysteria2", "tuic", "wireguard",
+    "socks5", "http", "snell", "ssh", "mieru", "anytls", "direct", "dns",
+})
+MIHOMO_GROUP_TYPES = frozenset({"select", "url-test", "fallback", "load-balance", "relay"})
+MIHOMO_RULE_TYPES = frozenset({
+    "DOMAIN", "DOMAIN-SUFFIX", "DOMAIN-KEYWORD", "DOMAIN-REGEX", "DOMAIN-WILDCARD", "GEOSITE", "GEOIP",
+    "IP-CIDR", "IP-CIDR6", "IP-SUFFIX", "IP-ASN", "SRC-GEOIP", "SRC-IP-ASN", "SRC-IP-CIDR", "SRC-IP-SUFFIX",
+    "DST-PORT", "SRC-PORT", "IN-PORT", "IN-TYPE", "IN-USER", "IN-NAME", "PROCESS-PATH", "PROCESS-PATH-REGEX",
+    "PROCESS-NAME", "PROCESS-NAME-REGEX", "UID", "NETWORK", "DSCP", "RULE-SET", "AND", "OR", "NOT",
+    "SUB-RULE", "MATCH",
+})
+MIHOMO_PORT_KEYS = ("port", "socks-port", "mixed-port", "redir-port", "tproxy-port")
+MIHOMO_CHOICES = {
+    "mode": ("rule", "global", "direct"),
+    "log-level": ("silent", "error", "warning", "info", "debug"),
+}
+
+def lint_mihomo_document(root):
+    """按Mihomo配置的结构检查已组合的YAML节点，返回诊断列表；不像Mihomo配置的文档不检查"""
+    diagnostics = []
+    top = _node_map(root)
+    if not MIHOMO_TOP_KEYS.intersection(top):
+        return diagnostics
+
+    def report(node, message, detail, severity="error"):
+        mark = node.start_mark if node is not None else None
+        diagnostics.append({
+            "line": (mark.line + 1) if mark else None,
+            "column": (mark.column + 1) if mark else None,
+            "message": message,
+            "detail": detail,
+            "severity": severity,
+            "source": "schema"
+        })
+
+    def check_port(node, detail, owner=None):
+        """owner不为空时端口为必填项，缺少时报告在owner节点上"""
+        if node is None:
+            if owner is not None:
+                report(owner, "缺少端口(port)", detail)
+            return
+        value = _node_scalar(node)
+        if value is None or not value.isdigit() or not 0 < int(value) < 65536:
+            report(node, "端口必须是1到65535之间的整数", detail)
+
+    def check_sequence(key):
+        node = top.get(key)
+        if node is not None and not isinstance(node, yaml.SequenceNode):
+            report(node, f"{key}必须是列表", key)
+            return []
+        return _node_seq(node)
+
+    for key in MIHOMO_PORT_KEYS:
+        check_port(top.get(key), key)
+    for key, choices in MIHOMO_CHOICES.items():
+        value = _node_scalar(top.get(key))
+        if value is not None and value.lower() not in choices:
+            report(top[key], f"{key}的取值应为 {' / '.join(choices)}", key, "warning")
+
+    names = {}
+    for i, proxy in enumerate(check_sequence("proxies")):
+        detail = f"proxies[{i}]"
+        fields = _node_map(proxy)
+        if not isinstance(proxy, yaml.MappingNode):
+            report(proxy, "代理必须是映射", detail)
+            continue
+        name = _node_scalar(fields.get("name"))
+        if name is None:
+            report(proxy, "代理缺少名称(name)", detail)
+        elif name in names:
+            report(fields["name"], f"代理名称重复：{name}", detail)
+        else:
+            names[name] = "proxy"
+        proxy_type = _node_scalar(fields.get("type"))
+        if proxy_type is None:
+            report(proxy, "代理缺少类型(type)", detail)
+        elif proxy_type not in MIHOMO_PROXY_TYPES:
+            report(fields["type"], f"未知的代理类型：{proxy_type}", detail, "warning")
+        if proxy_type not in ("direct", "dns"):
+            if _node_scalar(fields.get("server")) is None:
+                report(proxy, "代理缺少服务器地址(server)", detail)
+            check_port(fields.get("port"), detail, owner=proxy)
+
+    for i, group in enumerate(check_sequence("proxy-groups")):
+        detail = f"proxy-groups[{i}]"
+        fields = _node_map(group)
+        if not isinstance(group, yaml.MappingNode):
+            report(group, "策略组必须是映射", detail)
+            continue
+        name = _node_scalar(fields.get("name"))
+        if name is None:
+            report(group, "策略组缺少名称(name)", detail)
+        elif name in names:
+            report(fields["name"], f"策略组名称与已有的{'代理' if names[name] == 'proxy' else '策略组'}重复：{name}", detail)
+        else:
+            names[name] = "group"
+        group_type = _node_scalar(fields.get("type"))
+        if group_type is None:
+            report(group, "策略组缺少类型(type)", detail)
+        elif group_type not in MIHOMO_GROUP_TYPES:
+            report(fields["type"], f"未知的策略组类型：{group_type}", detail)
+        include_all = any(
+            (_node_scalar(fields.get(key)) or "").lower() == "true"
+            for key in ("include-all", "include-all-proxies", "include-all-providers")
+        )
+        if not (_node_seq(fields.get("proxies")) or _node_seq(fields.get("use")) or include_all):
+            report(group, "策略组没有任何成员（proxies、use或include-all）", detail)
+        if name is not None and name in (_node_scalar(m) for m in _node_seq(fields.get("proxies"))):
+            report(group, f"策略组不能包含自身：{name}", detail)
+
+    for key, allowed_types in (("proxy-providers", ("http", "file", "inline")), ("rule-providers", ("http", "file", "inline"))):
+        providers = top.get(key)
+        if providers is not None and not isinstance(providers, yaml.MappingNode):
+            report(providers, f"{key}必须是映射", key)
+            continue
+        for name_node, provider in _node_pairs(providers):
+            detail = f"{key}.{name_node.value}"
+            fields = _node_map(provider)
+            provider_type = _node_scalar(fields.get("type"))
+            if provider_type not in allowed_types:
+                report(fields.get("type") or name_node, f"provider类型应为 {' / '.join(allowed_types)}", detail)
+            elif provider_type == "http" and _node_scalar(fields.get("url")) is None:
+                report(name_node, "http类型的provider缺少url", detail)
+            elif provider_type == "file" and _node_scalar(fields.get("path")) is None:
+                report(name_node, "file类型的provider缺少path", detail)
+            if key == "rule-providers" and _node_scalar(fields.get("behavior")) not in ("domain", "ipcidr", "classical"):
+                report(fields.get("behavior") or name_node, "rule-provider的behavior应为 domain / ipcidr / classical", detail)
+
+    def check_rules(rules, context):
+        match_seen = None
+        for i, rule in enumerate(rules):
+            detail = f"{context}[{i}]"
+            text = _node_scalar(rule)
+            if text is None:
+                report(rule, "规则必须是字符串", detail)
+                continue
+            parts = split_rule(text)
+            rule_type = parts[0].upper()
+            if rule_type not in MIHOMO_RULE_TYPES:
+                report(rule, f"未知的规则类型：{parts[0]}", detail, "warning")
+            elif len(parts) < (2 if rule_type == "MATCH" else 3):
+                report(rule, "规则缺少匹配内容或目标策略", detail)
+            if match_seen is not None:
+                report(rule, f"规则位于MATCH（第{match_seen}行）之后，永远不会生效", detail, "warning")
+            elif rule_type == "MATCH":
+                match_seen = rule.start_mark.line + 1
+
+    check_rules(check_sequence("rules"), "rules")
+    for name_node, rules in _node_pairs(top.get("sub-rules")):
+        check_rules(_node_seq(rules), f"sub-rules.{name_node.value}")
+    return diagnostics
+
+def check_workspace_file(abs_path, known=None):
+    """
+    校验单个文件的YAML语法和Mihomo结构（在工作进程中执行）
+    known为上次结果的 (mtime, 大小, 内容哈希)：mtime和大小未变化时不读取文件，内容哈希未变化时不重新校验；
+    返回 (状态, mtime, 大小, 内容哈希, 诊断列表)，状态为 unchanged / checked / missing
+    """
+    try:
+        st = os.stat(abs_path)
+    except OSError:
+        return "missing", None, None, None, None
+    if known and known[:2] == (st.st_mtime_ns, st.st_size):
+        return "unchanged", st.st_mtime_ns, st.st_size, known[2], None
+    try:
+        with open(abs_path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    except UnicodeDecodeError:
+        return "checked", st.st_mtime_ns, st.st_size, None, [{
+            "line": None, "column": None, "message": "文件编码错误，请确保文件为UTF-8编码",
+            "detail": "UnicodeDecodeError", "severity": "error", "source": "syntax"
+        }]
+    except OSError:
+        return "missing", None, None, None, None
+    digest = content_hash(text)
+    if known and known[2] == digest:
+        return "unchanged", st.st_mtime_ns, st.st_size, digest, None
+    try:
+        diagnostics = []
+        for root in yaml.compose_all(text, Loader=YAMLLoader):
+            diagnostics.extend(lint_mihomo_document(root))
+    except yaml.YAMLError as e:
+        diagnostics = [{**_yaml_diagnostic(e, text), "source": "syntax"}]
+    return "checked", st.st_mtime_ns, st.st_size, digest, diagnostics
+
+def check_workspace_files(root, items):
+    """批量校验 [(相对路径, 上次结果)]，减少与工作进程之间的往返"""
+    return [(rel_path,) + check_workspace_file(os.path.join(root, system_path(rel_path)), known) for rel_path, known in items]
+
+class WorkspaceValidationReport:
+    """最近一次批量校验得到的每个文件的诊断结果，按文件内容哈希判断是否需要重新校验"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = {}  # 相对路径 -> (mtime, 大小, 内容哈希, 诊断列表, 校验时间)
+
+    def known(self, rel_path):
+        with self._lock:
+            entry = self._files.get(rel_path)
+        return entry[:3] if entry and entry[2] else None
+
+    def update(self, rel_path, status, mtime, size, digest, diagnostics):
+        with self._lock:
+            if status == "missing":
+                self._files.pop(rel_path, None)
+            elif status == "unchanged":
+                old = self._files.get(rel_path)
+                if old is not None:
+                    self._files[rel_path] = (mtime, size, digest, old[3], old[4])
+            else:
+                self._files[rel_path] = (mtime, size, digest, diagnostics, time.time())
+
+    def retain(self, rel_dir, paths):
+        """删除范围内已不存在的文件的结果"""
+        prefix = rel_dir + "/" if rel_dir else ""
+        paths = set(paths)
+        with self._lock:
+            for rel_path in [p for p in self._files if p.startswith(prefix) and p not in paths]:
+                del self._files[rel_path]
+
+    def files(self, rel_dir=""):
+        prefix = rel_dir + "/" if rel_dir else ""
+        with self._lock:
+            return sorted(
+                (rel_path, entry) for rel_path, entry in self._files.items()
+                if not rel_dir or rel_path == rel_dir or rel_path.startswith(prefix)
+            )
+
+validation_report = WorkspaceLocal("validation")
+
+def report_item(rel_path, entry):
+    """报告中的单个文件：缓存的语法/结构诊断加上引用索引中找不到定义的引用"""
+    mtime, size, digest, diagnostics, checked_at = entry
+    diagnostics = list(diagnostics)
+    for usage in refs_index.dangling(rel_path):
+        diagnostics.append({
+            "line": usage["line"],
+            "column": usage["column"],
+            "message": f"引用的{'代理或策略组' if usage['kind'] == 'proxy' else usage['kind']}未定义：{usage['name']}",
+            "detail": usage["context"],
+            "severity": "warning",
+            "source": "reference"
+        })
+    return {
+        "path": rel_path,
+        "valid": not any(d["severity"] == "error" for d in diagnostics),
+        "errors": sum(1 for d in diagnostics if d["severity"] == "error"),
+        "warnings": sum(1 for d in diagnostics if d["severity"] == "warning"),
+        "checked_at": checked_at,
+        "diagnostics": diagnostics
+    }
+
+def changed_since_check(rel_path, entry):
+    """校验之后文件是否已被修改或删除"""
+    try:
+        st = os.stat(os.path.join(tree_index.root, system_path(rel_path)))
+    except OSError:
+        return True
+    return (st.st_mtime_ns, st.st_size) != entry[:2]
+
+def validation_scope(path):
+    """校验范围：工作区中的目录或文件，返回 (规范化的相对路径, 文件列表)"""
+    rel_path, sys_path = resolve_workspace_path(path)
+    tree_index.ensure_built()
+    if rel_path and tree_index.is_file(rel_path):
+        return rel_path, [rel_path]
+    files = tree_index.iter_files(rel_path)
+    if rel_path and not files and not os.path.isdir(sys_path):
+        raise HTTPException(status_code=404, detail=f"路径不存在：{path}")
+    return rel_path, files
+
+async def run_validation_job(job, path, force):
+    rel_path, files = await io_pool.run(validation_scope, path)
+    files.sort()
+    job.total = len(files)
+    items = [(f, None if force else validation_report.known(f)) for f in files]
+    batches = [items[i:i + VALIDATE_JOB_BATCH] for i in range(0, len(items), VALIDATE_JOB_BATCH)]
+    counts = {"checked": 0, "unchanged": 0, "missing": 0}
+
+    # 同时提交的批次不超过工作进程数的两倍，取消时只需等待已提交的批次
+    window = bulk_pool.max_workers * 2
+    pending = set()
+    next_batch = 0
+    try:
+        while True:
+            while not job.cancelled and next_batch < len(batches) and len(pending) < window:
+                pending.add(asyncio.ensure_future(bulk_pool.run(check_workspace_files, tree_index.root, batches[next_batch])))
+                next_batch += 1
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                results = task.result()
+                for rel_file, status, mtime, size, digest, diagnostics in results:
+                    validation_report.update(rel_file, status, mtime, size, digest, diagnostics)
+                    counts[status] += 1
+                job.advance(len(results), results[-1][0])
+    finally:
+        for task in pending:
+            task.cancel()
+    if not job.cancelled:
+        validation_report.retain(rel_path, files)
+
+    summary = {"path": rel_path, "files": len(files), **counts, "errors": 0, "warnings": 0, "invalid_files": 0}
+
+    def summarize():
+        # report_item要查引用索引，大工作区耗时较长，不在事件循环中执行
+        for rel_file, entry in validation_report.files(rel_path):
+            item = report_item(rel_file, entry)
+            summary["errors"] += item["errors"]
+            summary["warnings"] += item["warnings"]
+            summary["invalid_files"] += 0 if item["valid"] else 1
+
+    await io_pool.run(summarize)
+    return summary
+
+class WorkspaceValidate(BaseModel):
+    path: str = ""       # 目录或文件，默认整个工作区
+    force: bool = False  # 忽略上次的结果，全部重新校验
+
+@app.post("/api/validate/workspace")
+async def validate_workspace(request: WorkspaceValidate, token: dict = Depends(verify_token)):
+    """启动批量校验任务（YAML语法和Mihomo结构），内容未变化的文件沿用上次的结果"""
+    rel_path = posixpath.normpath(normalize_path(request.path or "")).strip("/")
+    job = job_manager.submit(
+        "validate",
+        {"path": request.path, "force": request.force},
+        lambda job: run_validation_job(job, request.path, request.force),
+        key=("validate", rel_path, request.force)
+    )
+    return job.to_dict()
+
+@app.get("/api/validate/report")
+async def get_validation_report(
+    path: str = "",
+    include_valid: bool = False,
+    offset: int = 0,
+    limit: int = SEARCH_DEFAULT_LIMIT,
+    token: dict = Depends(verify_token)
+):
+    """批量校验的结果，默认只列出有诊断信息的文件；stale表示校验之后文件已被修改"""
+    rel_path = posixpath.normpath(normalize_path(path)).strip("/")
+    if rel_path == ".":
+        rel_path = ""
+    limit = max(0, min(limit, SEARCH_MAX_LIMIT))
+    offset = max(0, offset)
+
+    def build():
+        items = [(report_item(rel_file, entry), entry) for rel_file, entry in validation_report.files(rel_path)]
+        if not include_valid:
+            items = [(item, entry) for item, entry in items if item["diagnostics"]]
+        page = []
+        # 只对当前页检查文件是否在校验后被修改
+        for item, entry in items[offset:offset + limit]:
+            item["stale"] = changed_since_check(item["path"], entry)
+            page.append(item)
+        return len(items), page
+
+    total, items = await io_pool.run(build)
+    return {"total": total, "offset": offset, "limit": limit, "items": items}
+
+# 多工作区
+WORKSPACE_MAX_LOADED = int(os.getenv("WORKSPACE_MAX_LOADED", "16"))  # 同时加载（索引常驻内存）的工作区数量上限
+WORKSPACE_IDLE_SECONDS = float(os.getenv("WORKSPACE_IDLE_SECONDS", "1800"))  # 工作区空闲多久后卸载，0表示不卸载
+WORKSPACE_MEMORY_BUDGET = int(os.getenv("WORKSPACE_MEMORY_BUDGET", "0"))  # 已加载工作区索引的估算内存上限（MB），0表示不限制
+WORKSPACE_CHECK_INTERVAL = 30  # 检查空闲工作区和内存预算的间隔（秒）
+WORKSPACE_NAME_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$')
+
+class Workspace:
+    """
+    一个工作区及其独立的路径解析缓存、目录树索引、搜索索引、引用索引、历史版本存储、变化推送和校验结果
+    由WorkspaceRegistry按需加载，空闲或超出内存预算时卸载，卸载不影响磁盘上的文件
+    """
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.root = system_path(path)
+        self.tree = WorkspaceTreeIndex(self.root, ignored={f"history/{HISTORY_STORE_DIR}", TRASH_DIR})
+        self.paths = WorkspacePathResolver(self.root)
+        self.tree.add_listener(self.paths.on_tree_event)
+        self.search = WorkspaceSearchIndex(self.tree)
+        self.refs = MihomoReferenceIndex(self.tree)
+        self.history = HistoryStore(self.root)
+        self.changes = ChangeFeed(self.root)
+        self.tree.add_listener(self.changes.on_tree_event)
+        self.validation = WorkspaceValidationReport()
+        self.loaded_at = time.time()
+        self.last_used = time.monotonic()
+        self.holds = 0         # 正在运行的后台任务数，大于0时不卸载
+        self.started = False
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+    def hold(self):
+        self.holds += 1
+        self.touch()
+
+    def release(self):
+        self.holds = max(0, self.holds - 1)
+        self.touch()
+
+    @property
+    def busy(self):
+        return self.holds > 0 or self.changes.stats()["subscribers"] > 0
+
+    def _start_indexes(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.tree.start()
+            self.search.start()
+            self.refs.start()
+
+    def _stop_indexes(self):
+        with self._lock:
+            self.closed = True
+            self.refs.stop()
+            self.search.stop()
+            self.tree.stop()
+
+    def start(self):
+        """在事件循环中调用：启动变化推送，并在后台线程中构建索引"""
+        if self.started or self.closed:
+            return
+        self.started = True
+        self.changes.start()
+        asyncio.ensure_future(io_pool.run(self._start_indexes))
+
+    async def close(self):
+        self.closed = True
+        if self.started:
+            await io_pool.run(self._stop_indexes)
+            await self.changes.stop()
+        # 内容哈希缓存按系统路径保存，一并清理该工作区的条目
+        prefix = os.path.join(self.root, "")
+        for sys_file_path in [key for key in list(_file_digests) if key.startswith(prefix)]:
+            _file_digests.pop(sys_file_path, None)
+
+    def memory_estimate(self):
+        """索引和缓存大约占用的字节数"""
+        return (
+            self.tree.memory_estimate() + self.search.memory_estimate()
+            + self.refs.memory_estimate() + self.history.memory_estimate()
+        )
+
+    def to_dict(self, memory=False):
+        info = {
+            "name": self.name,
+            "path": self.path,
+            "loaded": True,
+            "indexed": self.search.content_ready,
+            "jobs": self.holds,
+            "subscribers": self.changes.stats()["subscribers"],
+            "idle_seconds": round(time.monotonic() - self.last_used, 1),
+        }
+        if memory:
+            info["memory_bytes"] = self.memory_estimate()
+        return info
+
+class WorkspaceRegistry:
+    """
+    工作区名称 -> 目录的映射来自配置（"workspaces"），默认工作区为 /api/config/workspace 设置的目录，
+    工作区在第一次被请求时加载，按最近使用顺序保留，
+    超过 WORKSPACE_MAX_LOADED、WORKSPACE_MEMORY_BUDGET 或空闲超过 WORKSPACE_IDLE_SECONDS 时卸载最久未用的，
+    正在运行后台任务或有推送订阅者的工作区以及默认工作区不会被卸载
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = collections.OrderedDict()  # 名称 -> Workspace，最近使用的在后
+        self._config = None
+        self._definitions = {}
+        self._loop = None
+        self._task = None
+        self.unloads = 0
+
+    def definitions(self):
+        """所有已配置的工作区 {名称: 目录}，配置未变化时直接返回缓存"""
+        config = get_config()
+        if config is not self._config:
+            definitions = {DEFAULT_WORKSPACE: default_workspace_dir()}
+            for name, path in (config.get("workspaces") or {}).items():
+                if name != DEFAULT_WORKSPACE:
+                    definitions[name] = normalize_path(path)
+            self._definitions, self._config = definitions, config
+        return self._definitions
+
+    def get(self, name=DEFAULT_WORKSPACE):
+        """返回已加载的工作区，未加载（或目录已修改）时加载"""
+        path = self.definitions().get(name)
+        if path is None:
+            raise HTTPException(status_code=404, detail=f"工作区不存在: {name}")
+        with self._lock:
+            workspace = self._loaded.get(name)
+            if workspace is not None and workspace.path == path:
+                self._loaded.move_to_end(name)
+                workspace.touch()
+                return workspace
+            if workspace is not None:
+                self._unload(name)
+            workspace = Workspace(name, path)
+            self._loaded[name] = workspace
+            self._schedule(workspace.start)
+            self._evict_over_count()
+            return workspace
+
+    def loaded(self):
+        with self._lock:
+            return list(self._loaded.values())
+
+    def _schedule(self, fn):
+        # 启动前（没有事件循环）加载的工作区在startup时统一启动
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            fn()
         else:
-            # 搜索文件
-            files = []
-            search_lower = search.lower()
-            
-            for root, dirs, filenames in os.walk(sys_workspace_dir):
-                for filename in filenames:
-                    if filename.endswith(('.yaml', '.yml')) and search_lower in filename.lower():
-                        rel_path = os.path.relpath(os.path.join(root, filename), sys_workspace_dir)
-                        # 规范化相对路径
-                        rel_path = normalize_path(rel_path)
-                        files.append(FileInfo(
-                            path=rel_path,
-                            name=filename,
-                            isDirectory=False
-                        ))
-            
-            return files
+            loop.call_soon_threadsafe(fn)
+
+    def _unload(self, name):
+        workspace = self._loaded.pop(name, None)
+        if workspace is None:
+            return
+        self.unloads += 1
+        workspace.closed = True
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(workspace.close(), self._loop)
+
+    def unload(self, name):
+        with self._lock:
+            self._unload(name)
+
+    def _evictable(self, keep=()):
+        return [
+            name for name, workspace in self._loaded.items()
+            if name != DEFAULT_WORKSPACE and name not in keep and not workspace.busy
+        ]
+
+    def _evict_over_count(self):
+        with self._lock:
+            excess = len(self._loaded) - WORKSPACE_MAX_LOADED
+            # 刚加载的工作区（最后一个）不参与淘汰
+            for name in self._evictable(keep=list(self._loaded)[-1:])[:max(0, excess)]:
+                self._unload(name)
+
+    def maintain(self):
+        """卸载空闲的工作区，并按最近使用顺序卸载工作区直到估算内存不超过预算"""
+        now = time.monotonic()
+        with self._lock:
+            if WORKSPACE_IDLE_SECONDS > 0:
+                for name in self._evictable():
+                    if now - self._loaded[name].last_used > WORKSPACE_IDLE_SECONDS:
+                        self._unload(name)
+            if WORKSPACE_MEMORY_BUDGET <= 0:
+                return
+            budget = WORKSPACE_MEMORY_BUDGET * 1024 * 1024
+            usage = {name: workspace.memory_estimate() for name, workspace in self._loaded.items()}
+            total = sum(usage.values())
+            for name in self._evictable(keep=list(self._loaded)[-1:]):
+                if total <= budget:
+                    break
+                total -= usage[name]
+                self._unload(name)
+
+    async def _maintain_loop(self):
+        while True:
+            await asyncio.sleep(WORKSPACE_CHECK_INTERVAL)
+            try:
+                await io_pool.run(self.maintain)
+            except Exception as e:
+                print(f"检查工作区失败: {e}")
+
+    def startup(self):
+        self._loop = asyncio.get_running_loop()
+        self.get()
+        for workspace in self.loaded():
+            workspace.start()
+        self._task = asyncio.ensure_future(self._maintain_loop())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        with self._lock:
+            loaded = list(self._loaded.values())
+            self._loaded.clear()
+        await asyncio.gather(*(workspace.close() for workspace in loaded), return_exceptions=True)
+        self._loop = None
+
+    def stats(self):
+        with self._lock:
+            return {"defined": len(self.definitions()), "loaded": len(self._loaded), "unloads": self.unloads}
+
+workspaces = WorkspaceRegistry()
+
+def select_workspace(connection, payload):
+    """
+    按令牌中绑定的工作区、X-Workspace请求头、workspace查询参数的顺序选择本次请求的工作区，
+    绑定了工作区的令牌不能访问其他工作区
+    """
+    bound = payload.get("workspace")
+    requested = connection.headers.get("x-workspace") or connection.query_params.get("workspace")
+    if bound and requested and requested != bound:
+        raise HTTPException(status_code=403, detail=f"当前登录只能访问工作区: {bound}")
+    workspace = workspaces.get(bound or requested or DEFAULT_WORKSPACE)
+    _current_workspace.set(workspace)
+    return workspace
+
+def require_unbound(token):
+    if token.get("workspace"):
+        raise HTTPException(status_code=403, detail="绑定了工作区的登录不能管理工作区")
+
+@app.on_event("startup")
+async def start_workspaces():
+    workspaces.startup()
+
+@app.on_event("shutdown")
+async def stop_workspaces():
+    await workspaces.shutdown()
+
+class WorkspaceDefinition(BaseModel):
+    name: str
+    path: str
+
+@app.get("/api/workspaces")
+async def list_workspaces(token: dict = Depends(verify_token)):
+    """列出已配置的工作区及其加载状态，令牌绑定了工作区时只返回该工作区"""
+    bound = token.get("workspace")
+
+    def build():
+        loaded = {workspace.name: workspace for workspace in workspaces.loaded()}
+        items = []
+        for name, path in sorted(workspaces.definitions().items()):
+            if bound and name != bound:
+                continue
+            workspace = loaded.get(name)
+            if workspace is not None and workspace.path == path:
+                items.append(workspace.to_dict(memory=True))
+            else:
+                items.append({"name": name, "path": path, "loaded": False})
+        return items
+
+    items = await io_pool.run(build)
+    return {
+        "current": current_workspace().name,
+        "max_loaded": WORKSPACE_MAX_LOADED,
+        "memory_budget": WORKSPACE_MEMORY_BUDGET * 1024 * 1024 or None,
+        "workspaces": items
+    }
+
+@app.post("/api/workspaces")
+async def add_workspace(request: WorkspaceDefinition, token: dict = Depends(verify_token)):
+    """添加工作区或修改已有工作区的目录（默认工作区请使用 /api/config/workspace）"""
+    try:
+        require_unbound(token)
+        name = request.name.strip()
+        if not WORKSPACE_NAME_PATTERN.match(name):
+            raise HTTPException(status_code=400, detail="工作区名称只能包含字母、数字、下划线、点和横线，最长64个字符")
+        if name == DEFAULT_WORKSPACE:
+            raise HTTPException(status_code=400, detail="默认工作区的目录请通过 /api/config/workspace 设置")
+        path = normalize_path(request.path)
+        if not os.path.isdir(system_path(path)):
+            raise HTTPException(status_code=400, detail=f"目录不存在: {path}")
+
+        def apply(config):
+            defined = dict(config.get("workspaces") or {})
+            defined[name] = path
+            config["workspaces"] = defined
+
+        await io_pool.run(config_store.modify, apply)
+        return {"message": "工作区已保存", "name": name, "path": path}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/file/{file_path:path}")
-async def read_file(file_path: str, token: dict = Depends(verify_token)):
-    """读取文件内容"""
+@app.delete("/api/workspaces/{name}")
+async def remove_workspace(name: str, token: dict = Depends(verify_token)):
+    """删除工作区配置并卸载其索引，目录中的文件不受影响"""
     try:
-        # 规范化输入路径
-        file_path = normalize_path(file_path)
-        workspace_dir = get_workspace_dir()
-        
-        # 构建系统路径用于文件操作
-        sys_workspace_dir = system_path(workspace_dir)
-        sys_file_path = system_path(os.path.join(sys_workspace_dir, file_path))
-        
-        # 验证文件是否在工作目录内
-        if not os.path.abspath(sys_file_path).startswith(os.path.abspath(sys_workspace_dir)):
-            raise HTTPException(status_code=403, detail="出于安全考虑，不允许访问工作目录之外的文件")
+        require_unbound(token)
+        if name == DEFAULT_WORKSPACE:
+            raise HTTPException(status_code=400, detail="不能删除默认工作区")
+        if name not in workspaces.definitions():
+            raise HTTPException(status_code=404, detail=f"工作区不存在: {name}")
+
+        def apply(config):
+            defined = dict(config.get("workspaces") or {})
+            defined.pop(name, None)
+            config["workspaces"] = defined
+
+        await io_pool.run(config_store.modify, apply)
+        workspaces.unload(name)
+        return {"message": "工作区已删除", "name": name}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def file_job_response(job, background, message):
+    """background为true时立即返回任务（202），否则等待任务完成后返回结果"""
+    if background:
+        return JSONResponse(status_code=202, content=job.to_dict())
+    result = await job_manager.wait(job)
+    return {"message": message, "job": job.id, **(result or {})}
+
+# 需要在 /api/file/{file_path:path} 之前注册，否则会被当作保存名为move的文件
+@app.post("/api/file/move")
+async def move_file(file_move: FileMove, background: bool = False, token: dict = Depends(verify_token)):
+    """移动文件或目录（后台任务），background为true时立即返回任务，进度见 /api/jobs/{id}"""
+    try:
+        # 规范化路径并验证源路径和目标路径都在工作目录内
+        source_path, sys_source_path = resolve_workspace_path(file_move.source_path, 400, "源文件路径必须在工作目录内")
+        target_path, sys_target_path = resolve_workspace_path(file_move.target_path, 400, "目标文件路径必须在工作目录内")
         
-        if not os.path.exists(sys_file_path):
-            raise HTTPException(status_code=404, detail=f"文件不存在：{file_path}")
+        job = job_manager.submit(
+            "move",
+            {"source": source_path, "target": target_path},
+            lambda job: move_workspace_path(source_path, sys_source_path, target_path, sys_target_path, job=job),
+            key=("move", source_path)
+        )
+        return await file_job_response(job, background, "文件移动成功")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/file/copy")
+async def copy_file(file_copy: FileMove, background: bool = False, token: dict = Depends(verify_token)):
+    """复制文件或目录（后台任务），大文件分段、多个文件并行复制"""
+    try:
+        # 规范化路径并验证源路径和目标路径都在工作目录内
+        source_path, sys_source_path = resolve_workspace_path(file_copy.source_path, 400, "源文件路径必须在工作目录内")
+        target_path, sys_target_path = resolve_workspace_path(file_copy.target_path, 400, "目标文件路径必须在工作目录内")
         
-        try:
-            with open(sys_file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-        except PermissionError:
-            raise HTTPException(status_code=403, detail="没有权限读取文件，请检查文件权限设置")
-        except UnicodeDecodeError:
-            raise HTTPException(status_code=400, detail="文件编码错误，请确保文件为UTF-8编码")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"读取文件失败：{str(e)}")
-            
-        return {"content": content}
+        job = job_manager.submit(
+            "copy",
+            {"source": source_path, "target": target_path},
+            lambda job: copy_workspace_path(source_path, sys_source_path, target_path, sys_target_path, job=job),
+            key=("copy", source_path, target_path)
+        )
+        return await file_job_response(job, background, "复制成功")
     except HTTPException:
         raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"服务器内部错误：{str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/file/{file_path:path}")
 async def save_file(file_path: str, content: YAMLContent, token: dict = Depends(verify_token)):
     """保存文件内容"""
     try:
-        # 验证YAML格式
-        try:
-            yaml.safe_load(content.content)
-        except yaml.YAMLError as e:
-            error_msg = str(e)
-            if "found character '\\t'" in error_msg:
-                error_msg = "YAML文件中不能使用制表符(Tab)，请使用空格进行缩进"
-            elif "found unknown escape character" in error_msg:
-                error_msg = "YAML文件中包含无效的转义字符"
-            elif "could not find expected ':'" in error_msg:
-                error_msg = "YAML格式错误：缺少冒号(:)，请检查键值对格式"
-            elif "mapping values are not allowed here" in error_msg:
-                error_msg = "YAML格式错误：缩进不正确或在不允许的位置使用了冒号"
-            else:
-                error_msg = f"YAML格式错误：{error_msg}"
-            raise HTTPException(status_code=400, detail=error_msg)
-        
-        # 规范化输入路径
-        file_path = normalize_path(file_path)
-        workspace_dir = get_workspace_dir()
-        
-        # 构建系统路径用于文件操作
-        sys_workspace_dir = system_path(workspace_dir)
-        sys_file_path = system_path(os.path.join(sys_workspace_dir, file_path))
-        
-        # 验证文件是否在工作目录内
-        if not os.path.abspath(sys_file_path).startswith(os.path.abspath(sys_workspace_dir)):
-            raise HTTPException(status_code=403, detail="出于安全考虑，不允许访问工作目录之外的文件")
-        
-        # 确保目录存在
-        try:
-            os.makedirs(os.path.dirname(sys_file_path), exist_ok=True)
-        except PermissionError:
-            raise HTTPException(status_code=403, detail="没有权限创建目录，请检查文件权限设置")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"创建目录失败：{str(e)}")
+        # 规范化路径并验证文件是否在工作目录内
+        file_path, sys_file_path = resolve_workspace_path(file_path)
         
-        # 保存历史文件
-        history_file = save_history_file(file_path, content.content)
-        if not history_file:
-            print("警告：历史文件保存失败")
+        result = await write_workspace_file(file_path, sys_file_path, content.content)
+        return JSONResponse(content={"message": "文件保存成功", **result}, headers={"ETag": result["etag"]})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"服务器内部错误：{str(e)}")
+
+@app.patch("/api/file/{file_path:path}")
+async def patch_file(file_path: str, patch: FilePatch, request: Request, token: dict = Depends(verify_token)):
+    """增量保存文件：把统一diff或行级编辑应用到基准版本上，基准已过期时返回409"""
+    try:
+        base_etag = request.headers.get("if-match") or patch.base_etag
+        if not base_etag:
+            raise HTTPException(status_code=428, detail="请通过If-Match请求头或base_etag提供基准ETag")
         
-        # 保存当前文件
-        try:
-            with open(sys_file_path, 'w', encoding='utf-8') as f:
-                f.write(content.content)
-        except PermissionError:
-            raise HTTPException(status_code=403, detail="没有权限保存文件，请检查文件权限设置")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"保存文件失败：{str(e)}")
+        # 规范化路径并验证文件是否在工作目录内
+        file_path, sys_file_path = resolve_workspace_path(file_path)
         
-        return {
-            "message": "文件保存成功",
-            "history_file": history_file
-        }
+        result = await patch_workspace_file(file_path, sys_file_path, base_etag, patch.diff, patch.edits)
+        changed = result.pop("changed")
+        return JSONResponse(
+            content={"message": "文件保存成功" if changed else "文件内容未变化", **result},
+            headers={"ETag": result["etag"]}
+        )
     except HTTPException:
         raise
     except Exception as e:
@@ -555,76 +6660,144 @@ async def save_file(file_path: str, content: YAMLContent, token: dict = Depends(
 async def get_history(file_path: str = None, token: dict = Depends(verify_token)):
     """获取历史文件列表"""
     try:
-        history_files = get_history_files(file_path)
+        history_files = await io_pool.run(get_history_files, file_path)
         return history_files
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def diff_history_versions(sys_file_path, file_path, from_version, to_version, context):
+    """计算历史版本与另一版本（或当前文件）之间的unified diff"""
+    from_content, from_info = history_store.read_version(file_path, from_version)
+    if to_version == "current":
+        to_content = read_text_file(sys_file_path)
+        to_label = f"{file_path} (当前)"
+    else:
+        to_content, to_info = history_store.read_version(file_path, int(to_version))
+        to_label = f"{file_path} ({to_info['timestamp']})"
+    diff_lines = list(difflib.unified_diff(
+        from_content.splitlines(keepends=True),
+        to_content.splitlines(keepends=True),
+        fromfile=f"{file_path} ({from_info['timestamp']})",
+        tofile=to_label,
+        n=context
+    ))
+    added = sum(1 for line in diff_lines if line.startswith("+") and not line.startswith("+++"))
+    removed = sum(1 for line in diff_lines if line.startswith("-") and not line.startswith("---"))
+    return {
+        "file_path": file_path,
+        "from": from_version,
+        "to": to_version,
+        "added": added,
+        "removed": removed,
+        "diff": "".join(line if line.endswith("\n") else line + "\n" for line in diff_lines)
+    }
+
+def restore_history_version(sys_file_path, file_path, version):
+    """把文件恢复为指定历史版本，恢复后的内容记录为新的历史版本"""
+    content, _ = history_store.read_version(file_path, version)
+    os.makedirs(os.path.dirname(sys_file_path), exist_ok=True)
+    write_text_file(sys_file_path, content)
+    history_file = save_history_file(file_path, content)
+    tree_index.refresh(file_path)
+    change_feed.publish("modified", file_path)
+    return history_file
+
+@app.get("/api/history/diff")
+async def diff_history(
+    file_path: str,
+    from_version: int = Query(..., alias="from"),
+    to_version: str = Query("current", alias="to"),
+    context: int = 3,
+    token: dict = Depends(verify_token)
+):
+    """比较历史版本，to为版本号或current（当前文件）"""
+    try:
+        # 规范化路径并验证文件是否在工作目录内
+        file_path, sys_file_path = resolve_workspace_path(file_path)
+        
+        if to_version != "current" and not to_version.isdigit():
+            raise HTTPException(status_code=400, detail="to必须为版本号或current")
+        
+        return await io_pool.run(
+            diff_history_versions, sys_file_path, file_path, from_version, to_version, max(0, context)
+        )
+    except HTTPException:
+        raise
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"比较历史版本失败：{str(e)}")
+
+@app.post("/api/history/restore")
+async def restore_history(restore: HistoryRestore, token: dict = Depends(verify_token)):
+    """恢复文件到指定历史版本"""
+    try:
+        # 规范化路径并验证文件是否在工作目录内
+        file_path, sys_file_path = resolve_workspace_path(restore.file_path)
+        
+        async with file_lock(sys_file_path):
+            history_file = await io_pool.run(restore_history_version, sys_file_path, file_path, restore.version)
+        return {
+            "message": "历史版本恢复成功",
+            "history_file": history_file
+        }
+    except HTTPException:
+        raise
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="没有权限保存文件，请检查文件权限设置")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"恢复历史版本失败：{str(e)}")
+
 @app.get("/api/history/{file_path:path}")
 async def read_history_file(file_path: str, token: dict = Depends(verify_token)):
     """读取历史文件内容"""
     try:
-        # 规范化输入路径
-        file_path = normalize_path(file_path)
-        workspace_dir = get_workspace_dir()
+        # 规范化路径并验证文件是否在工作目录内
+        file_path, sys_file_path = resolve_workspace_path(file_path, 400, "文件路径必须在工作目录内")
         
-        # 构建系统路径用于文件操作
-        sys_workspace_dir = system_path(workspace_dir)
-        sys_file_path = system_path(os.path.join(sys_workspace_dir, file_path))
+        store_version = HistoryStore.parse_history_path(file_path)
+        if store_version:
+            content, version = await io_pool.run(history_store.read, *store_version)
+            return {
+                "content": content,
+                "name": version["name"],
+                "timestamp": version["timestamp"]
+            }
         
-        # 验证文件是否在工作目录内
-        if not os.path.abspath(sys_file_path).startswith(os.path.abspath(sys_workspace_dir)):
-            raise HTTPException(status_code=400, detail="文件路径必须在工作目录内")
-        
-        with open(sys_file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        content = await io_pool.run(read_text_file, sys_file_path)
         
         # 解析文件名获取原始文件名和时间戳
         file_name = os.path.basename(file_path)
-        parts = os.path.splitext(file_name)[0].split('_')
-        timestamp_str = parts[-2] + "_" + parts[-1] if len(parts) >= 2 else ""
+        _, timestamp_str = _parse_legacy_history_name(file_name)
         
         return {
             "content": content,
             "name": file_name,
             "timestamp": timestamp_str
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=404, detail=str(e))
 
 @app.delete("/api/file/{file_path:path}")
-async def delete_file(file_path: str, token: dict = Depends(verify_token)):
-    """删除文件"""
+async def delete_file(file_path: str, background: bool = False, token: dict = Depends(verify_token)):
+    """删除文件或目录（后台任务），background为true时立即返回任务，取消时尚未删除的内容保留"""
     try:
-        # 规范化输入路径
-        file_path = normalize_path(file_path)
-        workspace_dir = get_workspace_dir()
-        
-        # 构建系统路径用于文件操作
-        sys_workspace_dir = system_path(workspace_dir)
-        sys_file_path = system_path(os.path.join(sys_workspace_dir, file_path))
-        
-        # 验证文件是否在工作目录内
-        if not os.path.abspath(sys_file_path).startswith(os.path.abspath(sys_workspace_dir)):
-            raise HTTPException(status_code=403, detail="出于安全考虑，不允许访问工作目录之外的文件")
-        
-        if not os.path.exists(sys_file_path):
-            raise HTTPException(status_code=404, detail=f"要删除的文件或目录不存在：{file_path}")
-        
-        try:
-            if os.path.isdir(sys_file_path):
-                if os.listdir(sys_file_path):
-                    shutil.rmtree(sys_file_path)
-                else:
-                    os.rmdir(sys_file_path)
-            else:
-                os.remove(sys_file_path)
-        except PermissionError:
-            raise HTTPException(status_code=403, detail="没有权限删除文件或目录，请检查权限设置")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"删除失败：{str(e)}")
+        # 规范化路径并验证文件是否在工作目录内
+        file_path, sys_file_path = resolve_workspace_path(file_path)
         
-        return {"message": "删除成功"}
+        job = job_manager.submit(
+            "delete",
+            {"path": file_path},
+            lambda job: delete_workspace_path(file_path, sys_file_path, job=job),
+            key=("delete", file_path)
+        )
+        return await file_job_response(job, background, "删除成功")
     except HTTPException:
         raise
     except Exception as e:
@@ -634,87 +6807,342 @@ async def delete_file(file_path: str, token: dict = Depends(verify_token)):
 async def create_directory(path: DirectoryConfig, token: dict = Depends(verify_token)):
     """创建目录"""
     try:
-        # 规范化输入路径
-        dir_path = normalize_path(path.path)
-        workspace_dir = get_workspace_dir()
-        
-        # 构建系统路径用于文件操作
-        sys_workspace_dir = system_path(workspace_dir)
-        sys_dir_path = system_path(os.path.join(sys_workspace_dir, dir_path))
+        # 规范化路径并验证路径是否在工作目录内
+        dir_path, sys_dir_path = resolve_workspace_path(path.path, 400, "目录路径必须在工作目录内")
         
-        # 验证路径是否在工作目录内
-        if not os.path.abspath(sys_dir_path).startswith(os.path.abspath(sys_workspace_dir)):
-            raise HTTPException(status_code=400, detail="目录路径必须在工作目录内")
-        
-        os.makedirs(sys_dir_path, exist_ok=True)
+        await io_pool.run(os.makedirs, sys_dir_path, exist_ok=True)
+        await io_pool.run(tree_index.refresh, dir_path)
         return {"message": "目录创建成功"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/file/move")
-async def move_file(file_move: FileMove, token: dict = Depends(verify_token)):
-    """移动文件"""
+# 批量文件操作
+BATCH_MAX_OPERATIONS = int(os.getenv("BATCH_MAX_OPERATIONS", "1000"))  # 单次批量请求的操作数上限
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))  # 单次批量请求内并发执行的操作数
+BATCH_OPERATIONS = ("read", "save", "patch", "delete", "move")
+
+_batch_tasks = set()  # 执行中的批量任务，客户端断开后也会执行完（atomic时保证撤销）
+
+class BatchJournal:
+    """
+    全部成功或全部撤销的批量操作日志：修改前记录撤销方式，
+    有操作失败时按相反顺序撤销已完成的修改；删除的文件先移入回收目录，提交后才真正删除。
+    保存产生的历史版本也在提交时才写入，撤销的修改不会留下历史
+    """
+
+    def __init__(self, sys_workspace_dir):
+        self.trash_dir = os.path.join(sys_workspace_dir, TRASH_DIR, uuid.uuid4().hex)
+        self._lock = threading.Lock()
+        self._entries = []
+
+    def _add(self, entry):
+        with self._lock:
+            self._entries.append(entry)
+
+    def record_write(self, rel_path, sys_path):
+        try:
+            with open(sys_path, 'rb') as f:
+                previous = f.read()
+        except FileNotFoundError:
+            previous = None
+        self._add(("write", (rel_path,), sys_path, previous))
+
+    def trash(self, rel_path, sys_path):
+        if not os.path.lexists(sys_path):
+            raise FileNotFoundError(sys_path)
+        os.makedirs(self.trash_dir, exist_ok=True)
+        trash_path = os.path.join(self.trash_dir, uuid.uuid4().hex)
+        os.rename(sys_path, trash_path)
+        self._add(("delete", (rel_path,), sys_path, trash_path))
+
+    def record_move(self, source_path, sys_source_path, target_path, sys_target_path):
+        self._add(("move", (source_path, target_path), sys_source_path, sys_target_path))
+
+    def record_history(self, rel_path, content):
+        self._add(("history", (rel_path,), None, content))
+
+    def rollback(self):
+        """撤销已完成的修改，返回受影响的相对路径"""
+        affected = []
+        with self._lock:
+            entries, self._entries = self._entries, []
+        for kind, rel_paths, sys_path, undo in reversed(entries):
+            if kind == "history":
+                continue
+            try:
+                if kind == "write":
+                    if undo is None:
+                        os.remove(sys_path)
+                    else:
+                        atomic_write(sys_path, undo)
+                elif kind == "delete":
+                    os.makedirs(os.path.dirname(sys_path), exist_ok=True)
+                    os.rename(undo, sys_path)
+                elif kind == "move":
+                    move_path(undo, sys_path)
+                    history_store.move(rel_paths[1], rel_paths[0], os.path.isdir(sys_path))
+            except Exception as e:
+                print(f"撤销批量操作失败({kind} {rel_paths}): {e}")
+            affected.extend(rel_paths)
+        self.discard()
+        return affected
+
+    def commit(self):
+        """全部成功：按顺序保存历史版本（之后被同一批次移动的文件记在移动后的路径下），清理回收目录"""
+        with self._lock:
+            entries, self._entries = self._entries, []
+        for index, (kind, rel_paths, _, content) in enumerate(entries):
+            if kind != "history":
+                continue
+            rel_path = rel_paths[0]
+            for later_kind, later_paths, _, _ in entries[index + 1:]:
+                if later_kind == "move":
+                    source, target = later_paths
+                    if rel_path == source or rel_path.startswith(source + "/"):
+                        rel_path = target + rel_path[len(source):]
+            if not save_history_file(rel_path, content):
+                print("警告：历史文件保存失败")
+        self.discard()
+
+    def discard(self):
+        shutil.rmtree(self.trash_dir, ignore_errors=True)
+
+async def execute_batch_operation(operation, journal):
+    file_path, sys_file_path = resolve_workspace_path(operation.path)
+    if operation.op == "read":
+        return await read_workspace_file(file_path, sys_file_path)
+    if operation.op == "save":
+        return await write_workspace_file(file_path, sys_file_path, operation.content, operation.base_etag, journal)
+    if operation.op == "patch":
+        if not operation.base_etag:
+            raise HTTPException(status_code=428, detail="请提供基准ETag（base_etag）")
+        return await patch_workspace_file(
+            file_path, sys_file_path, operation.base_etag, operation.diff, operation.edits, journal
+        )
+    if operation.op == "delete":
+        await delete_workspace_path(file_path, sys_file_path, journal)
+        return {}
+    target_path, sys_target_path = resolve_workspace_path(operation.target)
+    result = await move_workspace_path(file_path, sys_file_path, target_path, sys_target_path, journal)
+    return {"source": result["source"], "target": result["target"]}
+
+async def run_batch(batch, sys_workspace_dir, results):
+    """
+    并发执行批量操作，每个操作完成后把结果放入results队列，最后放入汇总
+    涉及相同路径的操作按提交顺序依次执行
+    """
+    journal = BatchJournal(sys_workspace_dir) if batch.atomic else None
+    semaphore = asyncio.Semaphore(max(1, min(batch.concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY)))
+    aborted = asyncio.Event()
+    counts = collections.Counter()
+
+    async def run_one(index, operation, previous):
+        if previous:
+            await asyncio.gather(*previous, return_exceptions=True)
+        item = {"index": index, "id": operation.id, "op": operation.op, "path": operation.path}
+        async with semaphore:
+            if aborted.is_set():
+                item.update(status=424, error="批量操作中已有操作失败，已跳过")
+            else:
+                try:
+                    item.update(status=200, result=await execute_batch_operation(operation, journal))
+                except HTTPException as e:
+                    item.update(status=e.status_code, error=e.detail)
+                except Exception as e:
+                    item.update(status=500, error=f"服务器内部错误：{str(e)}")
+                if item["status"] != 200 and journal is not None:
+                    aborted.set()
+        counts["succeeded" if item["status"] == 200 else "failed"] += 1
+        await results.put(item)
+
+    last_task = {}
+    tasks = []
+    for index, operation in enumerate(batch.operations):
+        paths = {normalize_path(operation.path)}
+        if operation.target:
+            paths.add(normalize_path(operation.target))
+        previous = [last_task[p] for p in paths if p in last_task]
+        task = asyncio.ensure_future(run_one(index, operation, previous))
+        for p in paths:
+            last_task[p] = task
+        tasks.append(task)
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    summary = {
+        "done": True,
+        "total": len(batch.operations),
+        "succeeded": counts["succeeded"],
+        "failed": counts["failed"],
+        "rolled_back": False
+    }
     try:
-        # 规范化输入路径
-        source_path = normalize_path(file_move.source_path)
-        target_path = normalize_path(file_move.target_path)
-        workspace_dir = get_workspace_dir()
-        
-        # 构建系统路径用于文件操作
-        sys_workspace_dir = system_path(workspace_dir)
-        sys_source_path = system_path(os.path.join(sys_workspace_dir, source_path))
-        sys_target_path = system_path(os.path.join(sys_workspace_dir, target_path))
-        
-        # 验证源路径是否在工作目录内
-        if not os.path.abspath(sys_source_path).startswith(os.path.abspath(sys_workspace_dir)):
-            raise HTTPException(status_code=400, detail="源文件路径必须在工作目录内")
-        
-        # 验证目标路径是否在工作目录内
-        if not os.path.abspath(sys_target_path).startswith(os.path.abspath(sys_workspace_dir)):
-            raise HTTPException(status_code=400, detail="目标文件路径必须在工作目录内")
-        
-        # 检查源文件是否存在
-        if not os.path.exists(sys_source_path):
-            raise HTTPException(status_code=404, detail="源文件不存在")
+        if journal is not None:
+            if counts["failed"]:
+                for rel_path in await io_pool.run(journal.rollback):
+                    await io_pool.run(tree_index.refresh, rel_path)
+                    change_feed.publish("modified", rel_path)
+                summary["rolled_back"] = True
+            else:
+                await io_pool.run(journal.commit)
+    except Exception as e:
+        print(f"批量操作提交或撤销失败: {e}")
+        summary["error"] = str(e)
+    await results.put(summary)
+
+@app.post("/api/batch")
+async def batch_operations(batch: BatchRequest, token: dict = Depends(verify_token)):
+    """
+    批量执行文件操作，以NDJSON逐行返回每个操作的结果（按完成顺序，index为操作序号），最后一行为汇总
+    atomic为true时任一操作失败则撤销本批次的全部修改，尚未开始的操作不再执行
+    """
+    try:
+        if not batch.operations:
+            raise HTTPException(status_code=400, detail="请提供要执行的操作")
+        if len(batch.operations) > BATCH_MAX_OPERATIONS:
+            raise HTTPException(status_code=400, detail=f"单次最多执行{BATCH_MAX_OPERATIONS}个操作")
+        for index, operation in enumerate(batch.operations):
+            if operation.op not in BATCH_OPERATIONS:
+                raise HTTPException(status_code=400, detail=f"第{index + 1}个操作类型无效：{operation.op}")
+            if operation.op == "save" and operation.content is None:
+                raise HTTPException(status_code=400, detail=f"第{index + 1}个操作缺少content")
+            if operation.op == "move" and not operation.target:
+                raise HTTPException(status_code=400, detail=f"第{index + 1}个操作缺少target")
         
-        # 确保目标目录存在
-        os.makedirs(os.path.dirname(sys_target_path), exist_ok=True)
+        sys_workspace_dir = system_path(get_workspace_dir())
+        results = asyncio.Queue()
+        task = asyncio.ensure_future(run_batch(batch, sys_workspace_dir, results))
+        _batch_tasks.add(task)
+        task.add_done_callback(_batch_tasks.discard)
         
-        # 移动文件
-        shutil.move(sys_source_path, sys_target_path)
+        async def stream_results():
+            while True:
+                item = await results.get()
+                yield json.dumps(jsonable_encoder(item), ensure_ascii=False) + "\n"
+                if item.get("done"):
+                    break
         
-        return {"message": "文件移动成功", "source": source_path, "target": target_path}
+        return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise HTTPException(status_code=500, detail=f"服务器内部错误：{str(e)}")
+
+# Prometheus指标接口
+def workspace_samples(fn):
+    return lambda: [((workspace.name,), fn(workspace)) for workspace in workspaces.loaded()]
+
+metrics.gauge("workspaces_loaded", "已加载的工作区数", lambda: workspaces.stats()["loaded"])
+metrics.gauge("workspaces_unloaded_total", "因空闲、数量或内存预算被卸载的工作区数", lambda: workspaces.unloads, kind="counter")
+metrics.gauge("workspace_memory_bytes", "工作区索引和缓存的估算内存占用", workspace_samples(lambda w: w.memory_estimate()), ("workspace",))
+metrics.gauge("path_cache_hits_total", "路径解析缓存命中次数", workspace_samples(lambda w: w.paths.hits), ("workspace",), kind="counter")
+metrics.gauge("path_cache_misses_total", "路径解析缓存未命中次数", workspace_samples(lambda w: w.paths.misses), ("workspace",), kind="counter")
+metrics.gauge("history_store_objects", "历史版本存储中的对象数", workspace_samples(lambda w: w.history.usage()["objects"]), ("workspace",))
+metrics.gauge("history_store_bytes", "历史版本存储占用的字节数", workspace_samples(lambda w: w.history.usage()["bytes"]), ("workspace",))
+metrics.gauge("mihomo_streams_in_flight", "正在转发的Mihomo HTTP流和WebSocket连接数", lambda: mihomo_client.in_flight)
+metrics.gauge("mihomo_streams_rejected_total", "因达到上限被拒绝的Mihomo转发请求数", lambda: mihomo_client.rejected, kind="counter")
+metrics.gauge("validation_cache_bytes", "YAML校验缓存中保存的文档大小", lambda: validation_cache.stats()["bytes"])
+metrics.gauge("auth_cache_tokens", "已缓存的已验证令牌数", lambda: token_cache.stats()["size"])
+metrics.gauge("auth_cache_hits_total", "令牌缓存命中次数", lambda: token_cache.hits, kind="counter")
+metrics.gauge("auth_cache_misses_total", "令牌缓存未命中次数", lambda: token_cache.misses, kind="counter")
+metrics.gauge("change_feed_subscribers", "工作区变化推送的订阅者数", workspace_samples(lambda w: w.changes.stats()["subscribers"]), ("workspace",))
+metrics.gauge("query_cache_bytes", "查询用的已解析文档缓存的估算内存占用", lambda: document_cache.stats()["bytes"])
+metrics.gauge("jobs_running", "正在运行的后台任务数", lambda: job_manager.stats()["running"])
+metrics.gauge("refs_index_symbols", "引用索引中已定义的名称数", workspace_samples(lambda w: w.refs.stats()["symbols"]), ("workspace",))
+
+@app.get("/metrics")
+async def prometheus_metrics(request: Request):
+    """以Prometheus文本格式输出运行指标"""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="指标未启用")
+    bearer = bearer_token(request.headers)
+    if not (METRICS_TOKEN and bearer and hmac.compare_digest(bearer, METRICS_TOKEN)):
+        authenticate(request)
+    # 首次统计历史存储占用需要遍历目录，放到I/O线程池中执行
+    body = await io_pool.run(metrics.render)
+    return Response(body, media_type="text/plain; version=0.0.4")
 
 # 认证相关模型
 class LoginRequest(BaseModel):
     password: str
+    workspace: Optional[str] = None  # 指定时令牌只能访问该工作区
 
 class Token(BaseModel):
     access_token: str
     token_type: str
+    expires_in: Optional[int] = None
+
+def issue_session(response: Response, request: Request, sub: str, workspace: Optional[str] = None):
+    """签发新令牌，并在启用时写入会话Cookie（值即签名后的JWT）"""
+    data = {"sub": sub}
+    if workspace:
+        data["workspace"] = workspace
+    access_token = create_access_token(data=data)
+    expires_in = int(JWT_EXPIRATION * 3600)
+    if SESSION_COOKIE:
+        secure = request.url.scheme == "https" or request.headers.get("x-forwarded-proto") == "https"
+        response.set_cookie(
+            SESSION_COOKIE_NAME,
+            access_token,
+            max_age=expires_in,
+            path=SESSION_COOKIE_PATH,
+            httponly=True,
+            secure=secure,
+            samesite="strict"
+        )
+    return {"access_token": access_token, "token_type": "bearer", "expires_in": expires_in}
 
 # 登录端点
 @app.post("/api/login", response_model=Token)
-async def login(request: LoginRequest):
+async def login(request: LoginRequest, http_request: Request, response: Response):
     if request.password != APP_PASSWORD:
         raise HTTPException(
             status_code=401,
             detail="密码错误，请重试"
         )
     
+    if request.workspace and request.workspace not in workspaces.definitions():
+        raise HTTPException(status_code=404, detail=f"工作区不存在: {request.workspace}")
+    
     try:
-        access_token = create_access_token(
-            data={"sub": "user"}
-        )
-        return {"access_token": access_token, "token_type": "bearer"}
+        return issue_session(response, http_request, "user", request.workspace)
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail="登录失败，请稍后重试"
         )
 
+@app.post("/api/token/refresh", response_model=Token)
+async def refresh_token(request: Request, response: Response, token: dict = Depends(verify_token)):
+    """用未过期的令牌换取新令牌，换出的旧令牌随即吊销"""
+    try:
+        session = issue_session(response, request, token.get("sub", "user"), token.get("workspace"))
+        raw_token = bearer_token(request.headers)
+        if raw_token and not SKIP_AUTH:
+            await io_pool.run(revoke_token, raw_token, token)
+        return session
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"刷新登录失败: {str(e)}")
+
+@app.post("/api/logout")
+async def logout(request: Request, response: Response):
+    """吊销当前令牌并清除会话Cookie"""
+    try:
+        # Cookie只发给Mihomo代理路径，这里收不到；登录和刷新时Cookie与请求头中的是同一个令牌
+        raw_token = bearer_token(request.headers)
+        if raw_token and not SKIP_AUTH:
+            try:
+                payload = decode_access_token(raw_token)
+            except HTTPException:
+                payload = None
+            if payload is not None:
+                await io_pool.run(revoke_token, raw_token, payload)
+        response.delete_cookie(SESSION_COOKIE_NAME, path=SESSION_COOKIE_PATH)
+        return {"message": "已退出登录"}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"退出登录失败: {str(e)}")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# main在导入时会创建工作目录，测试使用临时目录
+os.environ.setdefault("WORKSPACE_DIR", tempfile.mkdtemp(prefix="yamleditor-test-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
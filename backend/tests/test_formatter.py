@@ -0,0 +1,135 @@
+import pytest
+
+import main
+
+
+def fmt(text, **options):
+    return "".join(main.YAMLLineFormatter(**options).run(text.splitlines(keepends=True)))
+
+
+CASES = {
+    "comments": (
+        "# 头部注释\n"
+        "a:    1   # 行尾注释\n"
+        "b:\n"
+        "      # 子节点前的注释\n"
+        "      c: 2\n"
+        "\n\n\n"
+        "      d: 3\n"
+        "# 结尾注释\n"
+    ),
+    "block_scalars": (
+        "script: |\n"
+        "    line 1\n"
+        "      indented\n"
+        "\n"
+        "    line 3\n"
+        "folded: >-\n"
+        "   one\n"
+        "   two\n"
+        "list:\n"
+        "    - |\n"
+        "      item\n"
+        "    - key: |+\n"
+        "        keep\n"
+        "\n"
+        "next: 1\n"
+    ),
+    "flow_spanning_lines": (
+        "proxies: [a, b,\n"
+        "     c, d]\n"
+        "map: {x: 1,\n"
+        "  y: [1,\n"
+        "    2], z: 'q # not comment'}\n"
+        "quoted: \"multi\n"
+        "  line\"\n"
+        "after:\n"
+        "      k: v\n"
+    ),
+    "indentless_sequences": (
+        "proxy-groups:\n"
+        "- name: auto\n"
+        "  type: select\n"
+        "  proxies:\n"
+        "  - HK\n"
+        "  - JP\n"
+        "rules:\n"
+        "    - DOMAIN,a.com,DIRECT\n"
+        "    -   MATCH,auto\n"
+    ),
+    "nested_sequences": (
+        "- - a\n"
+        "  - b\n"
+        "-   - c\n"
+        "    - d: 1\n"
+        "      e: 2\n"
+    ),
+    "anchors_and_tags": (
+        "base: &base\n"
+        "     x: 1\n"
+        "other:\n"
+        "     <<: *base\n"
+        "     tagged: !!str 123\n"
+    ),
+    "documents": (
+        "%YAML 1.1\n"
+        "---\n"
+        "a:\n"
+        "    b: 1\n"
+        "---\n"
+        "- x\n"
+        "...\n"
+    ),
+}
+
+
+@pytest.mark.parametrize("indent_sequences", [None, True, False])
+@pytest.mark.parametrize("indent", [2, 4])
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_round_trip(name, indent, indent_sequences):
+    text = CASES[name]
+    options = {"indent": indent, "indent_sequences": indent_sequences}
+    once = fmt(text, **options)
+    assert main.yaml_events_equal(text, once)
+    assert fmt(once, **options) == once
+
+
+def test_normalizes_whitespace():
+    text = "a:    1   \nb:\n      c: 2\r\n\n\n\nd:\n- x\n"
+    assert fmt(text) == "a: 1\nb:\n  c: 2\n\nd:\n- x\n"
+
+
+def test_comments_are_kept():
+    result = fmt(CASES["comments"])
+    for comment in ("# 头部注释", "# 行尾注释", "# 子节点前的注释", "# 结尾注释"):
+        assert comment in result
+
+
+def test_indent_sequences_option():
+    text = "a:\n- x\n- y\n"
+    assert fmt(text, indent_sequences=True) == "a:\n  - x\n  - y\n"
+    assert fmt("a:\n  - x\n  - y\n", indent_sequences=False) == text
+
+
+def test_range_only_touches_selected_lines():
+    text = "a:\n      b: 1\n      c: 2\nd:\n      e: 3\n      f: 4\n"
+    result = fmt(text, start_line=4, end_line=4)
+    assert result.splitlines()[:3] == text.splitlines()[:3]
+    assert result.endswith("d:\n  e: 3\n  f: 4\n")
+    assert main.yaml_events_equal(text, result)
+    assert fmt(result, start_line=4, end_line=4) == result
+
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_range_round_trip(name):
+    text = CASES[name]
+    lines = text.count("\n")
+    for start in range(1, lines + 1, 2):
+        result = fmt(text, start_line=start, end_line=min(lines, start + 1))
+        assert main.yaml_events_equal(text, result), (start, result)
+
+
+def test_format_yaml_text_reports_changes():
+    result = main.format_yaml_text("a:    1\n", {"indent": 2, "indent_sequences": None, "max_blank_lines": 1})
+    assert result["content"] == "a: 1\n"
+    assert result["changed"] and result["changed_lines"] == 1
@@ -0,0 +1,30 @@
+import difflib
+
+import pytest
+
+import main
+
+
+def unified_diff(old, new):
+    return "".join(difflib.unified_diff(old.splitlines(keepends=True), new.splitlines(keepends=True), "a", "b"))
+
+
+@pytest.mark.parametrize("old, new", [
+    ("a: 1\nb: 2\nc: 3\n", "a: 1\nb: 20\nc: 3\n"),
+    ("a: 1\n", "x: 0\na: 1\ny: 2\n"),
+    ("a: 1\nb: 2\n", ""),
+    ("".join(f"k{i}: {i}\n" for i in range(50)), "".join(f"k{i}: {i * (i % 7 != 0)}\n" for i in range(50) if i != 25)),
+])
+def test_apply_unified_diff(old, new):
+    assert main.apply_unified_diff(old, unified_diff(old, new)) == new
+
+
+def test_apply_unified_diff_no_newline_at_end():
+    diff = "@@ -1 +1 @@\n-a: 1\n+a: 2\n\\ No newline at end of file\n"
+    assert main.apply_unified_diff("a: 1\n", diff) == "a: 2"
+
+
+def test_apply_unified_diff_rejects_mismatched_context():
+    diff = unified_diff("a: 1\nb: 2\n", "a: 1\nb: 3\n")
+    with pytest.raises(ValueError):
+        main.apply_unified_diff("a: 1\nb: 5\n", diff)
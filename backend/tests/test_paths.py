@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    root = tmp_path / "ws"
+    (root / "sub").mkdir(parents=True)
+    (root / "sub" / "a.yaml").write_text("a: 1\n")
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    (outside / "s.yaml").write_text("s: 1\n")
+    os.symlink("sub", root / "inner")
+    os.symlink(str(outside), root / "outer")
+    os.symlink(str(root / "sub"), root / "absolute_inner")
+    return str(root)
+
+
+def resolved(resolver, path):
+    return resolver.resolve(path)[0]
+
+
+@pytest.mark.parametrize("path, expected", [
+    ("", ""),
+    (".", ""),
+    ("sub/a.yaml", "sub/a.yaml"),
+    ("sub\\a.yaml", "sub/a.yaml"),
+    ("./sub/../sub/a.yaml", "sub/a.yaml"),
+    ("sub/missing/new.yaml", "sub/missing/new.yaml"),
+    ("../x.yaml", None),
+    ("sub/../../x.yaml", None),
+    ("/etc/passwd", None),
+    ("a\x00b", None),
+])
+def test_resolver_normalizes_paths(workspace, path, expected):
+    assert resolved(main.WorkspacePathResolver(workspace, policy="deny"), path) == expected
+
+
+def test_resolver_absolute_path_inside_workspace(workspace):
+    resolver = main.WorkspacePathResolver(workspace)
+    rel_path, sys_path = resolver.resolve(os.path.join(workspace, "sub", "a.yaml"))
+    assert rel_path == "sub/a.yaml"
+    assert sys_path == os.path.join(workspace, "sub", "a.yaml")
+
+
+@pytest.mark.parametrize("path, deny, internal, follow", [
+    ("inner/a.yaml", False, True, True),
+    ("absolute_inner/a.yaml", False, True, True),
+    ("outer/s.yaml", False, False, True),
+    ("outer", False, False, True),
+])
+def test_resolver_symlink_policies(workspace, path, deny, internal, follow):
+    for policy, allowed in (("deny", deny), ("internal", internal), ("follow", follow)):
+        rel_path = resolved(main.WorkspacePathResolver(workspace, policy=policy), path)
+        assert (rel_path is not None) == allowed, policy
+
+
+def test_resolver_cache_is_cleared_on_tree_events(workspace):
+    resolver = main.WorkspacePathResolver(workspace, policy="internal")
+    assert resolved(resolver, "late/a.yaml") == "late/a.yaml"
+    os.symlink(os.path.dirname(workspace), os.path.join(workspace, "late"))
+    assert resolved(resolver, "late/a.yaml") == "late/a.yaml"  # 缓存命中
+    resolver.on_tree_event("created", "late", True)
+    assert resolved(resolver, "late/a.yaml") is None
+    assert resolver.stats()["hits"] == 1
@@ -0,0 +1,53 @@
+import pytest
+import yaml
+
+import main
+
+
+DOCUMENT = yaml.safe_load("""
+proxies:
+  - {name: HK, type: ss, server: hk.example.com}
+  - {name: JP, type: vmess, server: jp.example.com}
+proxy-groups:
+  - name: auto
+    proxies: [HK, JP]
+  - name: manual
+    proxies: [JP]
+a.b: dotted
+""")
+
+
+@pytest.mark.parametrize("expr, steps", [
+    ("$", ()),
+    ("proxies[0].name", (("key", "proxies"), ("index", 0), ("key", "name"))),
+    ("$.proxies[-1]", (("key", "proxies"), ("index", -1))),
+    ("proxies[1:]", (("key", "proxies"), ("slice", 1, None))),
+    ("proxies[*]", (("key", "proxies"), ("wildcard",))),
+    ("..server", (("descend", "server"),)),
+    ("['a.b']", (("key", "a.b"),)),
+    ("proxies[?name=HK]", (("key", "proxies"), ("filter", ("name",), "=", "HK"))),
+    ("proxies[?(@.type != 'ss')]", (("key", "proxies"), ("filter", ("type",), "!=", "ss"))),
+    ("proxies[?server]", (("key", "proxies"), ("filter", ("server",), None, None))),
+])
+def test_parse_query(expr, steps):
+    assert main.parse_query(expr) == steps
+
+
+@pytest.mark.parametrize("expr", ["proxies[0", "proxies.", "a..", "proxies[0]x"])
+def test_parse_query_rejects_invalid(expr):
+    with pytest.raises(ValueError):
+        main.parse_query(expr)
+
+
+@pytest.mark.parametrize("expr, expected", [
+    ("proxies[0].name", [("$.proxies[0].name", "HK")]),
+    ("proxy-groups[?name=auto].proxies[*]", [("$.proxy-groups[0].proxies[0]", "HK"), ("$.proxy-groups[0].proxies[1]", "JP")]),
+    ("proxies[?type~=mess].name", [("$.proxies[1].name", "JP")]),
+    ("..server", [("$.proxies[0].server", "hk.example.com"), ("$.proxies[1].server", "jp.example.com")]),
+    ("['a.b']", [("$['a.b']", "dotted")]),
+    ("proxies[5]", []),
+])
+def test_run_query(expr, expected):
+    total, matches = main.run_query(DOCUMENT, main.parse_query(expr), 100)
+    assert total == len(expected)
+    assert matches == expected
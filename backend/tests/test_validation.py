@@ -0,0 +1,81 @@
+import pytest
+import yaml
+
+import main
+
+
+def full_valid(text):
+    try:
+        yaml.safe_load(text)
+        return True
+    except yaml.YAMLError:
+        return False
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    # 让很短的文档也会被切分成多个块
+    monkeypatch.setattr(main, "VALIDATE_CHUNK_SIZE", 8)
+
+
+@pytest.mark.parametrize("text", [
+    "a: 1\ngarbage\nb: 2\n",
+    "a: 1\n[1, 2]\nb: 2\n",
+    "a: 1\n\"x\"\nb: 2\n",
+    "a: 1\nfoo bar\nb: 2\n",
+    "a: 1\nb: 2\ngarbage\n",
+    "- a\nfoo: 1\n- b\n",
+    "- a\n- b\ngarbage\n",
+    "key:\n  a: 1\n  garbage\n  b: 2\n",
+    "key:\n  a: 1\n  b: 2\n  garbage\n",
+    "key:\n  - a\n  - b\n  c: 1\n",
+    "key:\n  - a\n  - b\n  - c\n  x\n",
+    "a: \"unclosed\nb: 2\n",
+])
+def test_incremental_rejects_invalid(text):
+    assert not full_valid(text)
+    assert main.validate_yaml_text(text)["valid"] is False
+
+
+@pytest.mark.parametrize("text", [
+    "a: 1\nb: 2\nc: 3\n",
+    "# comment\na: 1\n\nb:\n  - x\n  - y\nc: 3\n",
+    "a:\n- x\n- y\nb: 2\n",
+    "\"quoted key\": 1\n'single': 2\nplain: 3\n",
+    "- a\n- b\n- c: 1\n  d: 2\n",
+    "key:\n  a: 1\n  b: 2\n  c:\n    d: 3\n",
+    "key:\n  - a\n  - b\n  - c\n",
+    "base: &b\n  x: 1\nother:\n  <<: *b\n",
+    "text: |\n  line\n  more\nnext: 1\n",
+])
+def test_incremental_matches_full_parse(text):
+    assert full_valid(text)
+    result = main.validate_yaml_text(text)
+    assert result["valid"] is True
+    assert result["diagnostics"] == []
+
+
+def test_large_document_is_split():
+    text = "".join(f"k{i}: {i}\n" for i in range(100))
+    result = main.validate_yaml_text(text)
+    assert result["mode"] == "incremental"
+    assert result["total_chunks"] > 1
+    assert result["valid"] is True
+
+
+def test_error_line_is_absolute():
+    text = "".join(f"k{i}: {i}\n" for i in range(20)) + "bad: [1\nk99: 1\n"
+    result = main.validate_yaml_text(text)
+    assert not result["valid"]
+    assert result["diagnostics"][0]["line"] >= 21
+
+
+@pytest.mark.parametrize("text", [
+    "a: [1,\n2]\nb: 1\n",
+    "a: 1\n~\nb: 2\n",
+    "a: 1\n-foo: 2\n",
+    "a: 1\n!tag x: 2\n",
+    "- a\n-\n- b\n",
+])
+def test_incremental_agrees_with_full_parse(text):
+    assert main.validate_yaml_text(text)["valid"] == full_valid(text)